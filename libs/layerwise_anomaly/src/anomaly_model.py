@@ -6,6 +6,9 @@
 ############
 
 
+import hashlib
+import pickle
+
 import sklearn.mixture
 import numpy as np
 from numpy import ndarray
@@ -16,6 +19,37 @@ import settings
 INCLUDE_SPECIAL_TOKENS: bool = False
 
 
+class SurpriseCache:
+    """Cache of per-token surprise scores, shared by all the anomaly models of a run.
+    Entries are keyed by (anomaly model fingerprint, sentence), so that two different models never share their scores,
+    while the same sentence is encoded and scored only once for each model.
+    """
+
+    def __init__(self):
+        self.__entries: dict[tuple[str, str], tuple[list, np.ndarray]] = {}
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        return key in self.__entries
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def get(self, fingerprint: str, sentence: str) -> tuple[list, np.ndarray]:
+        return self.__entries[(fingerprint, sentence)]
+
+    def put(self, fingerprint: str, sentence: str, tokens: list, scores: np.ndarray) -> None:
+        # The cached scores are shared between callers, thus they're protected against accidental writes
+        scores.setflags(write=False)
+        self.__entries[(fingerprint, sentence)] = (tokens, scores)
+
+    def clear(self) -> None:
+        self.__entries.clear()
+
+
+# The cache lives outside the models, so that it's not serialized together with them
+SURPRISE_CACHE: SurpriseCache = SurpriseCache()
+
+
 class AnomalyModel:
     """Model that uses GMM on embeddings generated by BERT for finding syntactic
     or semantic anomalies.
@@ -57,32 +91,27 @@ class AnomalyModel:
             # (e.g. for BERT, => 13 GMMs)
             self.gmms.append(gmm)
 
+    @property
+    def fingerprint(self) -> str:
+        """
+        An identifier of the trained model, used as a key for the surprise cache.
+        It's computed from the encoder name and the fitted distribution models, thus it's stable for a de-serialized model.
+        """
+        # The attribute may be missing in models serialized before its introduction
+        if getattr(self, '_fingerprint', None) is None:
+            digest = hashlib.sha1(self.enc.model_name.encode())
+            digest.update(pickle.dumps(self.gmms))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
     def compute_sentence_surprise_per_tokens(self, sentence: str) -> tuple[list, np.ndarray]:
         """
         Computes the surprise for a single sentence.
         :param sentence: The sentence to analyze.
         :return: The scores as a NumPy ndarray of dimensions (#layers, #tokens)
         """
-        # Here I did a bad thing: I pass to the encoder a list with a single item, and I take the single item returned.
-        # That's because the encoder method works with list, but I'm working on a single sentence here
-        tokens, vecs = self.enc.contextual_token_vecs([sentence], special_tokens=INCLUDE_SPECIAL_TOKENS)
-        tokens: list = tokens[0]
-        vecs: ndarray = vecs[0]
-        assert len(tokens) == vecs.shape[0]
-
-        sentence_scores: np.ndarray = np.zeros(shape=(self.num_encoder_layers, len(tokens)))
-        # For each layer of the encoder model
-        for layer in range(self.num_encoder_layers):
-            current_gmm = self.gmms[layer]
-            # Extracting the embeddings for each token, but for one single layer
-            embeddings = vecs[:, layer, :]
-            # Scoring the tokens via their embeddings, for the current layer
-            layer_scores = current_gmm.score_samples(embeddings)
-            # Returns an array of (#tokens) = (#samples) scores
-            sentence_scores[layer] = layer_scores
-
-        # In the end, the sentence_scores are returned
-        return tokens, sentence_scores
+        all_tokens, all_scores = self.compute_sentences_list_surprise_per_tokens([sentence])
+        return all_tokens[0], all_scores[0]
 
     def compute_sentences_pair_surprise_per_tokens(self, pair: tuple[str, str]) -> dict:
         """
@@ -93,10 +122,8 @@ class AnomalyModel:
                 each item is a NumPy ndarray of dimensions (#layers, #tokens)
             - The difference between the scores
         """
-        left_sentence = pair[0]
-        right_sentence = pair[1]
-        tokens_l, scores_l = self.compute_sentence_surprise_per_tokens(left_sentence)
-        tokens_r, scores_r = self.compute_sentence_surprise_per_tokens(right_sentence)
+        # Both the sentences are scored together, within the same encoding batch
+        (tokens_l, tokens_r), (scores_l, scores_r) = self.compute_sentences_list_surprise_per_tokens(list(pair))
         scores_diff = np.abs(scores_l - scores_r)
         result = {
             "tokens": (tokens_l, tokens_r),
@@ -105,44 +132,58 @@ class AnomalyModel:
         }
         return result
 
+    def __score_token_vecs(self, vecs: np.ndarray) -> np.ndarray:
+        """
+        Scores the embeddings of the tokens of a single sentence, for every layer.
+        :param vecs: The embeddings of the tokens, as a np.array(sentence length, 13, 768)
+        :return: The scores as a NumPy ndarray of dimensions (#layers, #tokens)
+        """
+        sentence_scores: np.ndarray = np.zeros(shape=(self.num_encoder_layers, vecs.shape[0]))
+        # For each layer of the encoder model
+        for layer in range(self.num_encoder_layers):
+            # Extracting the current GMM
+            current_gmm = self.gmms[layer]
+            # Extracting the embeddings for each token, but for one single layer
+            embeddings = vecs[:, layer, :]
+            # Scoring the tokens via their embeddings, for the current layer
+            # The method <score_samples> computes the log-likelihood of each sample of the list
+            # The input list is an array of shape (#samples, #features), i.e. a list of (embeddings)
+            sentence_scores[layer] = current_gmm.score_samples(embeddings)
+        return sentence_scores
+
     def compute_sentences_list_surprise_per_tokens(self, sentences_list: list[str]):
         """
         Given a list of sentences, computes the surprise for each token of each sentence.
+        The results are stored in the surprise cache: repeated sentences, both within the list and across different
+        calls on the same model, are encoded and scored only once.
         :param sentences_list: The list of sentences to evaluate
         :return: (all_tokens, all_scores), where
             all_tokens is List[List[token]]
             all_scores is List[np.array(#layers, #tokens)]
         """
-        # Extracting the tokens from the sentences, already encoded
-        all_tokens, all_vecs = self.enc.contextual_token_vecs(sentences_list, special_tokens=INCLUDE_SPECIAL_TOKENS)
-        #   all_tokens  is a List[List[tokens]], one list for each sentence.
-        #   all_vecs    is a List[np.array(sentence length, 13, 768)], one array for each sentence.
+        fingerprint = self.fingerprint
+        # Selecting the distinct sentences that have never been scored by this model
+        # (a dictionary keeps the insertion order, unlike a set)
+        missing_sentences = list(dict.fromkeys(
+            sent for sent in sentences_list if (fingerprint, sent) not in SURPRISE_CACHE))
+
+        if len(missing_sentences) > 0:
+            # Extracting the tokens from the sentences, already encoded
+            missing_tokens, missing_vecs = self.enc.contextual_token_vecs(
+                missing_sentences, special_tokens=INCLUDE_SPECIAL_TOKENS)
+            #   missing_tokens  is a List[List[tokens]], one list for each sentence.
+            #   missing_vecs    is a List[np.array(sentence length, 13, 768)], one array for each sentence.
+            for sent, tokens, vecs in zip(missing_sentences, missing_tokens, missing_vecs):
+                assert len(tokens) == vecs.shape[0]     # Asserting the #tokens == sentence length
+                SURPRISE_CACHE.put(fingerprint, sent, tokens, self.__score_token_vecs(vecs))
+
+        # Every sentence is now in the cache
+        all_tokens = []
         all_scores = []
-
-        for sent_ix in range(len(sentences_list)):
-            # <sent_ix> is the index
-            # Now we're getting the tokens and embeddings for a specific sentence
-            tokens = all_tokens[sent_ix]            # is a List[token]
-            vecs = all_vecs[sent_ix]                # is a np.array(sentence length, 13, 768)
-            assert len(tokens) == vecs.shape[0]     # Asserting the #tokens == sentence length
-
-            sentence_scores = []
-            # For each layer of the encoder model
-            for layer in range(self.num_encoder_layers):
-                # Extracting the current GMM
-                current_gmm = self.gmms[layer]
-                # Extracting the embeddings for each token, but for one single layer
-                embeddings = vecs[:, layer, :]
-                # Scoring the tokens via their embeddings, for the current layer
-                # The method <score_samples> computes the log-likelihood of each sample of the list
-                # The input list is an array of shape (#samples, #features), i.e. a list of (embeddings)
-                layer_scores = current_gmm.score_samples(embeddings)
-                # Returns an array of (#samples) scores
-                sentence_scores.append(layer_scores)
-
-            # In the end, the sentence scores are appended in the all_scores array
-            all_scores.append(np.array(sentence_scores))
-
+        for sent in sentences_list:
+            tokens, scores = SURPRISE_CACHE.get(fingerprint, sent)
+            all_tokens.append(tokens)
+            all_scores.append(scores)
         return all_tokens, all_scores
 
     @staticmethod
@@ -159,9 +200,10 @@ class AnomalyModel:
         """
         # Unzipping the list of pairs
         left_sentences, right_sentences = AnomalyModel.unzip(sentences_pairs)
-        # Computing surprise scores
-        left_scores_per_tokens = self.compute_sentences_list_surprise_per_tokens(left_sentences)[1]
-        right_scores_per_tokens = self.compute_sentences_list_surprise_per_tokens(right_sentences)[1]
+        # Computing surprise scores for all the sentences at once, so that duplicates are scored only once
+        all_scores = self.compute_sentences_list_surprise_per_tokens(left_sentences + right_sentences)[1]
+        left_scores_per_tokens = all_scores[:len(left_sentences)]
+        right_scores_per_tokens = all_scores[len(left_sentences):]
         # Re-zipping the surprise scores
         pairs_scores = list(zip(left_scores_per_tokens, right_scores_per_tokens))
         # This is quite stupid, but it's due to the previous structure of the code...
@@ -173,14 +215,10 @@ class AnomalyModel:
         :param sentences_pairs: The sentences pairs to evaluate, a list[(str, str)]
         :return: The list of scores pairs: List[(score for the left sentence, score for the right sentence)]
         """
-        # Unzipping the list of pairs
-        left_sentences, right_sentences = AnomalyModel.unzip(sentences_pairs)
         # Computing surprise scores per tokens
-        left_scores_per_tokens = self.compute_sentences_list_surprise_per_tokens(left_sentences)[1]
-        right_scores_per_tokens = self.compute_sentences_list_surprise_per_tokens(right_sentences)[1]
+        pairs_scores_per_tokens = self.compute_sentence_pairs_list_surprise_per_tokens(sentences_pairs)
         # Summing scores of each token and dividing by the number of tokens
-        left_scores_per_sentence = [np.average(sentence_scores, axis=1) for sentence_scores in left_scores_per_tokens]
-        right_scores_per_sentence = [np.average(sentence_scores, axis=1) for sentence_scores in right_scores_per_tokens]
-        # Re-zipping the surprise scores
-        pairs_scores: list[tuple[ndarray, ndarray]] = list(zip(left_scores_per_sentence, right_scores_per_sentence))
+        pairs_scores: list[tuple[ndarray, ndarray]] = [
+            (np.average(left_scores, axis=1), np.average(right_scores, axis=1))
+            for left_scores, right_scores in pairs_scores_per_tokens]
         return pairs_scores
@@ -10,6 +10,7 @@ from src.experiments import embeddings_gender_subspace_detection_finetuned
 from src.experiments import embeddings_contextual_analysis
 from src.experiments import embeddings_gender_classification_contextual
 from src.experiments import embeddings_gender_classification_classifiers_comparison
+from src.experiments import embeddings_gender_weat
 from src.experiments import anomaly_detection_surprise
 from src.experiments import mlm_gender_prediction
 from src.experiments import mlm_gender_prediction_finetuned
@@ -24,6 +25,7 @@ if __name__ == '__main__':
     # embeddings_gender_subspace_detection_finetuned.launch()
     embeddings_gender_subspace_detection_pca.launch()
     # embeddings_gender_classification_classifiers_comparison.launch()
+    # embeddings_gender_weat.launch()
 
     # Anomaly Detection
     # anomaly_detection_surprise.launch()
@@ -32,5 +34,6 @@ if __name__ == '__main__':
     # mlm_gender_prediction_finetuned.launch()
     # mlm_gender_prediction_finetuned.launch()
     # mlm_gender_perplexity.launch()
+    # mlm_gender_prediction.launch_top_k()
 
     pass
@@ -27,6 +27,9 @@ pt_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # Machine Learning
 TRAIN_TEST_SPLIT_PERCENTAGE = 0.2
 
+# Number of worker processes for the data-parallel MLM evaluation (0 = evaluation in the main process)
+MLM_DATA_PARALLEL_WORKERS: int = 0
+
 # FILES
 
 # Folders structure
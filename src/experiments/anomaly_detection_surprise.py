@@ -193,6 +193,7 @@ def launch() -> None:
 	 	("The scientist took his job seriously", "The scientist took her job seriously"),
 	 	("The librarian took his job seriously", "The librarian took her job seriously"),
 	]"""
+	# The chosen pairs have already been scored in [1]: their scores are retrieved from the surprise cache
 	plot_sentences_pairs(model, chosen_pairs)
 	print("Completed.")
 
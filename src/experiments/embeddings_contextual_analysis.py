@@ -145,14 +145,15 @@ def print_metrics_table(embeddings: dict, embeddings_comparator: EmbeddingsCompa
 	with open(f"{FOLDER_OUTPUT_TABLES}/metrics_lastlevel.{settings.OUTPUT_TABLE_FILE_EXTENSION}", "w") as f:
 		header: str = f"word{col_sep}{embeddings_comparator.names_header()}{col_sep}stat_bergsma{col_sep}stat_bls"
 		print(header, file=f)
-		for word, word_embs in embeddings.items():
-			print(f'Measuring metrics for word "{word}"...', end="")
-			metrics = embeddings_comparator(word_embs)
+		print(f'Measuring metrics for {len(embeddings)} words...', end="")
+		# All the metrics of all the words are computed at once: [# words, # metrics, # layers]
+		measures: torch.Tensor = embeddings_comparator.evaluate_compiled(embeddings)
+		for word, word_metrics in zip(embeddings.keys(), measures):
 			print(word, end=col_sep, file=f)
-			for m in metrics:
+			for m in word_metrics:
 				print(print_tensor_array(m), end=col_sep, file=f)
 			print(f"{occupations_parser.get_percentage(word, stat_name='bergsma')}{col_sep}{occupations_parser.get_percentage(word, stat_name='bls')}", file=f)
-			print("Completed.")
+		print("Completed.")
 	return
 
 
@@ -289,10 +290,11 @@ def launch() -> None:
 	metric_ix = 19
 	metric_name = comparator.names_list()[metric_ix]
 
-	for word, word_embs in occs_embs.items():
-		measures: list[torch.Tensor] = comparator(word_embs)
+	# All the metrics of all the words are computed at once: [# words, # metrics, # layers]
+	measures: torch.Tensor = comparator.evaluate_compiled(occs_embs)
 
-		plotted_measure = measures[metric_ix].detach().numpy()
+	for word, word_measures in zip(occs_embs.keys(), measures):
+		plotted_measure = word_measures[metric_ix].numpy()
 
 		pct_color = cmap(norm(parser.get_percentage(word)))
 		ax.plot(SELECTED_LAYERS, plotted_measure, '.-', color=pct_color, label=word)
@@ -91,7 +91,24 @@ def get_trained_classifier(classifier_class, model_name: str, encoder: WordEncod
                            layers: list[int] | range, layers_labels: list[str]) -> _AbstractGenderClassifier:
 	train_x, train_y = get_labeled_dataset(encoder=encoder, layers=layers, data=gendered_words)
 	valid_x, valid_y = get_labeled_dataset(encoder=encoder, layers=layers, data=gendered_animal_words)
+	return train_classifier(classifier_class, model_name=model_name, layers_labels=layers_labels,
+	                        train_x=train_x, train_y=train_y, valid_x=valid_x, valid_y=valid_y)
 
+
+def train_classifier(classifier_class, model_name: str, layers_labels: list[str],
+                     train_x: list[np.ndarray] | np.ndarray, train_y: list[Gender],
+                     valid_x: list[np.ndarray] | np.ndarray, valid_y: list[Gender]) -> _AbstractGenderClassifier:
+	"""
+	Trains and validates a gender classifier on already computed embeddings.
+	:param classifier_class: The class of the classifier
+	:param model_name: The name of the classifier
+	:param layers_labels: The labels for the layers of the embeddings
+	:param train_x: The training embeddings, of dimensions [# samples, # layers, # features]
+	:param train_y: The training genders
+	:param valid_x: The validation embeddings, of dimensions [# samples, # layers, # features]
+	:param valid_y: The validation genders
+	:return: The trained classifier
+	"""
 	# Training the gender subspace division model
 	print("Training model: ", model_name)
 	classifier = classifier_class(name=model_name, training_embeddings=np.asarray(train_x),
@@ -104,9 +121,10 @@ def get_trained_classifier(classifier_class, model_name: str, encoder: WordEncod
 	return classifier
 
 
-def detect_gender_direction(classifier: _AbstractGenderClassifier, encoder: WordEncoder,
+def detect_gender_direction(classifier: _AbstractGenderClassifier, encoder: WordEncoder | None,
                             layers: list[int] | range, layers_labels: list[str],
-                            folder_output_images: str, folder_output_tables: str) -> None:
+                            folder_output_images: str, folder_output_tables: str,
+                            eval_embeddings: list[np.ndarray] | np.ndarray | None = None) -> None:
 	"""
 	In this experiment we detect the gender direction with a Linear Support Vector Classifier.
 	The gender direction is the orthogonal direction to the hyperplane that best divides the considered two genders.
@@ -118,12 +136,17 @@ def detect_gender_direction(classifier: _AbstractGenderClassifier, encoder: Word
 	:param folder_output_tables: The folder where to put computed tables of results
 	:param folder_output_images: The folder where to put produced images with results' plots
 	:param classifier: The classifier model
+	:param eval_embeddings: The embeddings of the words we want to analyze, if already computed. Otherwise, they're
+	computed with the encoder.
 	:return: None
 	"""
 
 	# The words we want to analyze
 	target_words: list[str] = jobs_parser.get_words_list()
-	eval_x, _ = get_labeled_dataset(encoder=encoder, layers=layers, data=target_words)
+	if eval_embeddings is None:
+		eval_x, _ = get_labeled_dataset(encoder=encoder, layers=layers, data=target_words)
+	else:
+		eval_x = eval_embeddings
 
 	# Analyze components
 	subspace_plotter: GenderSubspacePlotter = GenderSubspacePlotter(model=classifier,
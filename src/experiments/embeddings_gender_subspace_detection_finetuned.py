@@ -10,14 +10,13 @@
 
 import random
 
-import torch
-
 import settings
-from src.experiments.embeddings_gender_subspace_detection import detect_gender_direction, get_trained_classifier
+from src.experiments.embeddings_gender_subspace_detection import detect_gender_direction, train_classifier, \
+	gendered_words, gendered_animal_words
 from src.experiments.mlm_gender_prediction_finetuned import prepare_sentences, train_group
+from src.models.evaluation_scheduler import Checkpoint, CheckpointEvaluationScheduler, ProbeEmbeddingsJob
 from src.models.gender_classifier import GenderLinearSupportVectorClassifier
 from src.models.trained_model_factory import TrainedModelForMaskedLMFactory
-from src.models.word_encoder import WordEncoder
 from src.parsers import jobs_parser
 
 EXPERIMENT_NAME: str = "embeddings_gender_subspace_detection_finetuned"
@@ -40,23 +39,36 @@ def launch() -> None:
 	random.seed(settings.RANDOM_SEED)
 	model_name = settings.DEFAULT_BERT_MODEL_NAME
 	factory = TrainedModelForMaskedLMFactory(model_name=model_name)
+	# The sentences are tokenized once, and the samples are selected from them
+	factory.set_texts_pool(sentences)
 	training_samples: list[int] = [0, 2000, 5000]
 
 	# For every number of training dataset size
+	checkpoints: list[Checkpoint] = []
 	for samples_number in training_samples:
 		sentences_sampled = random.sample(sentences, samples_number)
 		saved_model_ft_path = FOLDER_SAVED_MODELS_EXPERIMENT + f"/gender_subspace_detection_{model_name}_{samples_number}"
-		model = factory.get_model(fine_tuning_text=sentences_sampled, load_or_save_path=saved_model_ft_path)
-		model.to(settings.pt_device)
-		encoder = WordEncoder(tokenizer=factory.tokenizer, model=model)
+		checkpoints.append(Checkpoint(f"trained-{samples_number}", load_or_save_path=saved_model_ft_path,
+		                              fine_tuning_text=sentences_sampled))
+
+	# Computing the embeddings of every checkpoint, loading one model at a time
+	jobs = [
+		ProbeEmbeddingsJob('train', data=gendered_words, layers=LAYERS),
+		ProbeEmbeddingsJob('valid', data=gendered_animal_words, layers=LAYERS),
+		ProbeEmbeddingsJob('eval', data=jobs_parser.get_words_list(), layers=LAYERS),
+	]
+	embeddings = CheckpointEvaluationScheduler(factory=factory, checkpoints=checkpoints, jobs=jobs).run()
+
+	for checkpoint in checkpoints:
+		train_x, train_y = embeddings['train'][checkpoint.name]
+		valid_x, valid_y = embeddings['valid'][checkpoint.name]
+		eval_x, _ = embeddings['eval'][checkpoint.name]
 
 		# Detecting the gender direction
-		clf = get_trained_classifier(classifier_class=GenderLinearSupportVectorClassifier,
-		                             model_name=f"trained-{samples_number}", encoder=encoder,
-		                             layers=LAYERS, layers_labels=LAYERS_LABELS)
-		detect_gender_direction(classifier=clf, encoder=encoder, layers=LAYERS, layers_labels=LAYERS_LABELS,
-		                        folder_output_images=FOLDER_OUTPUT_IMAGES, folder_output_tables=FOLDER_OUTPUT_TABLES)
-
-		# Cleaning CUDA cache
-		torch.cuda.empty_cache()
+		clf = train_classifier(classifier_class=GenderLinearSupportVectorClassifier, model_name=checkpoint.name,
+		                       layers_labels=LAYERS_LABELS,
+		                       train_x=train_x, train_y=train_y, valid_x=valid_x, valid_y=valid_y)
+		detect_gender_direction(classifier=clf, encoder=None, layers=LAYERS, layers_labels=LAYERS_LABELS,
+		                        folder_output_images=FOLDER_OUTPUT_IMAGES, folder_output_tables=FOLDER_OUTPUT_TABLES,
+		                        eval_embeddings=eval_x)
 	return
@@ -41,7 +41,7 @@ def launch() -> None:
 
 	# Retrieving the training dataset
 	gendered_ds = ser.load_dataset('gendered_words.tsv')
-	train_x = np.asarray(gendered_ds['embedding'], dtype=np.float)[:, layers]
+	train_x = np.asarray(gendered_ds['embedding'], dtype=np.float32)[:, layers]
 	train_y = np.asarray(gendered_ds['gender'])
 	print("Training embeddings shape: ", train_x.shape)
 
@@ -66,13 +66,14 @@ def launch() -> None:
 	])
 
 	# Reducing dimensions with reducer
+	# The embeddings are shared with PyTorch without copies, and the reduced embeddings are tensors
 	print("\nReducing embeddings...")
-	reduced_embeddings = reducer.reduce(embeddings)
+	reduced_embeddings: torch.Tensor = reducer.reduce(torch.from_numpy(embeddings))
 	print("Reduced embeddings shape: ", reduced_embeddings.shape)
 
 	for layer_emb, label, spectrum in zip(LayersIterator(reduced_embeddings), layer_indices_labels, gender_spectrum):
 		# Using plotter to visualize embeddings
-		plotter = EmbeddingsScatterPlotter(torch.Tensor(layer_emb))
+		plotter = EmbeddingsScatterPlotter(layer_emb)
 		plotter.colormap = CMAP
 		plotter.colors = spectrum
 		plotter.sizes = 12
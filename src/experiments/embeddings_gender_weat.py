@@ -0,0 +1,67 @@
+#########################################################################
+#                            Dusi's Thesis                              #
+# Algorithmic Discrimination and Natural Language Processing Techniques #
+#########################################################################
+
+# This script measures the association between occupations and gender with the WEAT test, for each layer of BERT.
+# The targets are the occupations with the highest and the lowest percentage of female workers, while the attributes
+# are the female and male words used to detect the gender subspace.
+
+import os
+
+import numpy as np
+
+import settings
+from src.experiments.embeddings_gender_subspace_detection import gendered_words, get_labeled_dataset
+from src.models.association_test import WordEmbeddingAssociationTest
+from src.models.gender_enum import Gender
+from src.models.word_encoder import WordEncoder
+from src.parsers.winogender_occupations_parser import OccupationsParser
+
+EXPERIMENT_NAME: str = "embeddings_gender_weat"
+FOLDER_OUTPUT: str = settings.FOLDER_RESULTS + "/" + EXPERIMENT_NAME
+FOLDER_OUTPUT_TABLES: str = FOLDER_OUTPUT + "/" + settings.FOLDER_TABLES
+
+LAYERS: range = range(0, 13)
+# The number of occupations in each target set
+NUM_OCCUPATIONS: int = 20
+
+
+def print_weat_table(weat: WordEmbeddingAssociationTest, layers: list[int] | range, filename: str) -> None:
+	"""
+	Prints the table (as a TSV file) of the WEAT results, with a row for each layer.
+	:return: None
+	"""
+	col_sep = settings.OUTPUT_TABLE_COL_SEPARATOR
+	os.makedirs(FOLDER_OUTPUT_TABLES, exist_ok=True)
+	with open(f"{FOLDER_OUTPUT_TABLES}/{filename}.{settings.OUTPUT_TABLE_FILE_EXTENSION}", "w") as f:
+		print(col_sep.join(["layer", "effect_size", "p_value", "statistic"]), file=f)
+		for layer, effect_size, p_value, statistic in zip(layers, weat.effect_sizes, weat.p_values, weat.statistics):
+			print(col_sep.join([f"{layer:02d}", str(effect_size), str(p_value), str(statistic)]), file=f)
+
+
+def launch() -> None:
+	# Encoder
+	enc = WordEncoder()
+	layers = LAYERS
+
+	# Targets: the most female-dominated and the most male-dominated occupations
+	parser = OccupationsParser()
+	female_occs = [occ for occ, _ in parser.get_sorted_female_occupations(
+		max_length=NUM_OCCUPATIONS, female_percentage="highest")]
+	male_occs = [occ for occ, _ in parser.get_sorted_female_occupations(
+		max_length=NUM_OCCUPATIONS, female_percentage="lowest")]
+
+	print("Computing the embeddings of targets and attributes...", end="")
+	targets_x, _ = get_labeled_dataset(encoder=enc, layers=layers, data=female_occs)
+	targets_y, _ = get_labeled_dataset(encoder=enc, layers=layers, data=male_occs)
+	attributes_a, _ = get_labeled_dataset(encoder=enc, layers=layers, data=gendered_words[Gender.FEMALE])
+	attributes_b, _ = get_labeled_dataset(encoder=enc, layers=layers, data=gendered_words[Gender.MALE])
+	print("Completed.")
+
+	print("Computing the association test...", end="")
+	weat = WordEmbeddingAssociationTest(targets_x=np.asarray(targets_x), targets_y=np.asarray(targets_y),
+	                                    attributes_a=np.asarray(attributes_a), attributes_b=np.asarray(attributes_b))
+	print_weat_table(weat, layers=layers, filename="weat_occupations_gender")
+	print("Completed.")
+	return
@@ -7,15 +7,16 @@
 # Perplexity is a measure of anomaly for sentences
 
 
-import gc
 import os
 import pickle
 
 import numpy as np
-import torch
 from datasets import Dataset
 
 import settings
+from src.models.evaluation_scheduler import Checkpoint, CheckpointEvaluationScheduler, PseudoLogLikelihoodJob
+from src.models.masked_lm_scorer import MaskedLMScorer
+from src.models.parallel_runner import DataParallelMLMRunner
 from src.models.templates import TemplatesGroup
 from src.models.trained_model_factory import TrainedModelForMaskedLMFactory
 from src.experiments.mlm_gender_prediction_finetuned import eval_group, occupation_token
@@ -28,11 +29,42 @@ FOLDER_OUTPUT_IMAGES: str = FOLDER_OUTPUT + "/" + settings.FOLDER_IMAGES
 FOLDER_OUTPUT_TABLES: str = FOLDER_OUTPUT + "/" + settings.FOLDER_TABLES
 
 
+def prepare_group_sentences(templates_group: TemplatesGroup, occupations: list[str], targets: list[str]) -> list[str]:
+	"""
+	Instantiates all the sentences of a group, in the order [# templates, # occupations, # targets].
+
+	:param templates_group: The group of sentences to analyze.
+	:param occupations: The list of occupations replacing the "$ART_OCC" token.
+	:param targets: The target words "he" and "she"
+	:return: The flat list of sentences
+	"""
+	sentences: list[str] = []
+	for tmpl in templates_group.templates:
+		for occ in occupations:
+			art_occ: str = infer_indefinite_article(occ) + ' ' + occ
+			masked_sentence = tmpl.sentence.replace(occupation_token, art_occ)
+			for targ in targets:
+				sentences.append(masked_sentence.replace(settings.TOKEN_MASK, targ))
+	return sentences
+
+
+def perplexities_from_log_probs(tokens_log_probs: list[np.ndarray]) -> np.ndarray:
+	"""
+	The perplexity of a sentence is the exponential of the average negative log-probability of its tokens.
+	:param tokens_log_probs: The list of the tokens log-probabilities, an array for each sentence.
+	:return: The array of perplexities, one for each sentence
+	"""
+	return np.exp(-np.asarray([np.mean(log_probs) for log_probs in tokens_log_probs]))
+
+
 def compute_perplexity_for_group(model, tokenizer, templates_group: TemplatesGroup, occupations: list[str], targets: list[str]) -> np.ndarray:
 	"""
 	Computes perplexity metric for all the sentences and all the targets given as input.
 	Returns a numpy array with dimensions [# templates, # occupations, # gender]
 
+	All the sentences are evaluated together by the pseudo-log-likelihood engine of the MaskedLMScorer, so the whole
+	group costs a few large batched forward passes.
+
 	:param model: The model used to compute probability and loss of masked words.
 	:param tokenizer: The tokenizer working with that model.
 	:param templates_group: The group of sentences to analyze.
@@ -40,53 +72,38 @@ def compute_perplexity_for_group(model, tokenizer, templates_group: TemplatesGro
 	:param targets: The target words "he" and "she"
 	:return: The numpy array of computed perplexities
 	"""
-	scores: np.ndarray = np.zeros(shape=(len(templates_group.templates), len(occupations), len(targets)))
-	for i, tmpl in enumerate(templates_group.templates):
-		for j, occ in enumerate(occupations):
-			art_occ: str = infer_indefinite_article(occ) + ' ' + occ
-			masked_sentence = tmpl.sentence.replace(occupation_token, art_occ)
-			for k, targ in enumerate(targets):
-				sentence = masked_sentence.replace(settings.TOKEN_MASK, targ)
-				scores[i, j, k] = compute_perplexity_for_text(model, tokenizer, text=sentence)
-	return scores
+	sentences: list[str] = prepare_group_sentences(templates_group, occupations, targets)
+	scorer = MaskedLMScorer(model=model, tokenizer=tokenizer)
+	tokens_log_probs, _ = scorer.pseudo_log_likelihoods(sentences)
+	scores: np.ndarray = perplexities_from_log_probs(tokens_log_probs)
+	return scores.reshape((len(templates_group.templates), len(occupations), len(targets)))
 
 
-def compute_perplexity_for_text(model, tokenizer, text) -> float:
-	tensor_input = tokenizer(text, return_tensors='pt')['input_ids'].to(settings.pt_device)
-	# tensor([[ 101, 2769, 4263,  872,  102]])
-
-	repeat_input = tensor_input.repeat(tensor_input.size(-1) - 2, 1)
-	# tensor([[ 101, 2769, 4263,  872,  102],
-	#         [ 101, 2769, 4263,  872,  102],
-	#         [ 101, 2769, 4263,  872,  102]])
-
-	mask = torch.ones(tensor_input.size(-1) - 1, device='cuda').diag(1)[:-2]
-	# tensor([[0., 1., 0., 0., 0.],
-	#         [0., 0., 1., 0., 0.],
-	#         [0., 0., 0., 1., 0.]])
+def compute_perplexity_for_group_data_parallel(runner: DataParallelMLMRunner, templates_group: TemplatesGroup,
+                                               occupations: list[str], targets: list[str]) -> np.ndarray:
+	"""
+	Computes the same perplexities of "compute_perplexity_for_group", but the (template, occupation, target) grid
+	is split into shards that are evaluated by the worker processes of the runner.
 
-	masked_input = repeat_input.masked_fill(mask == 1, 103).to(settings.pt_device)
-	# tensor([[ 101,  103, 4263,  872,  102],
-	#         [ 101, 2769,  103,  872,  102],
-	#         [ 101, 2769, 4263,  103,  102]])
+	:param runner: The data-parallel runner, holding the model to evaluate.
+	:param templates_group: The group of sentences to analyze.
+	:param occupations: The list of occupations replacing the "$ART_OCC" token.
+	:param targets: The target words "he" and "she"
+	:return: The numpy array of computed perplexities, with dimensions [# templates, # occupations, # gender]
+	"""
+	sentences: list[str] = prepare_group_sentences(templates_group, occupations, targets)
+	scores: np.ndarray = np.exp(-runner.mean_log_probabilities(sentences))
+	return scores.reshape((len(templates_group.templates), len(occupations), len(targets)))
 
-	labels = repeat_input.masked_fill(masked_input != 103, -100).to(settings.pt_device)
-	# tensor([[-100, 2769, -100, -100, -100],
-	#         [-100, -100, 4263, -100, -100],
-	#         [-100, -100, -100,  872, -100]])
 
+def compute_perplexity_for_text(model, tokenizer, text) -> float:
 	"""
-	for token, inp, lab in zip(tensor_input[0], torch.unsqueeze(masked_input, 1), torch.unsqueeze(labels, 1)):
-		res = model(inp, labels=lab)
-		loss = res['loss'].cpu().detach().numpy()
-		print(f"{token}: loss = {loss}")
+	Computes the perplexity of a single sentence.
+	For many sentences, please use "compute_perplexity_for_group" or the MaskedLMScorer directly.
 	"""
-
-	res = model(masked_input, labels=labels)
-	loss = res['loss'].cpu().detach().numpy()
-	# print("Sentence loss: ", loss)
-	score = np.exp(loss)
-	return score
+	scorer = MaskedLMScorer(model=model, tokenizer=tokenizer)
+	tokens_log_probs, _ = scorer.pseudo_log_likelihoods([text])
+	return float(np.exp(-np.mean(tokens_log_probs[0])))
 
 
 def launch() -> None:
@@ -101,33 +118,50 @@ def launch() -> None:
 
 	results = Dataset.from_dict(mapping={'occupation': occs_list})
 
-	for samples_number in training_samples:
-		gc.collect()
-
-		scores_dump_file = settings.FOLDER_SAVED_DATA + '/' + EXPERIMENT_NAME + f'/fine-tuned-{samples_number}-scores.bin'
-		scores: np.ndarray
+	def scores_dump_file(samples_number: int) -> str:
+		return settings.FOLDER_SAVED_DATA + '/' + EXPERIMENT_NAME + f'/fine-tuned-{samples_number}-scores.bin'
 
-		if os.path.exists(scores_dump_file):
-			with open(scores_dump_file, "rb") as f:
-				scores = pickle.load(f)
-		else:
-			# Retrieving saved models from a previous experiment
+	# Retrieving saved models from a previous experiment, only for the scores that have not been computed yet
+	checkpoints: list[Checkpoint] = []
+	checkpoints_samples: list[int] = []
+	for samples_number in training_samples:
+		if not os.path.exists(scores_dump_file(samples_number)):
 			saved_model_ft_path = settings.FOLDER_SAVED_MODELS + f"/mlm_gender_prediction_finetuned/mlm_gender_prediction_{model_name}_{samples_number}"
-			model = factory.get_model(load_or_save_path=saved_model_ft_path)
-
-			print(f"Current model trained on: {samples_number} samples")
-			scores = compute_perplexity_for_group(model=model, tokenizer=factory.tokenizer,
-			                                      templates_group=eval_group, occupations=occs_list,
-			                                      targets=eval_group.targets)
+			checkpoints.append(Checkpoint(f'fine-tuned-{samples_number}', load_or_save_path=saved_model_ft_path))
+			checkpoints_samples.append(samples_number)
+
+	if len(checkpoints) > 0 and settings.MLM_DATA_PARALLEL_WORKERS > 0:
+		# Every checkpoint is evaluated by a pool of workers, each one loading the checkpoint once
+		for checkpoint, samples_number in zip(checkpoints, checkpoints_samples):
+			with DataParallelMLMRunner(model_name=model_name, load_or_save_path=checkpoint.load_or_save_path,
+			                           num_workers=settings.MLM_DATA_PARALLEL_WORKERS) as runner:
+				scores = compute_perplexity_for_group_data_parallel(runner, eval_group, occs_list, eval_group.targets)
+			# Averaging the results for the templates: [# occupations, # gender]
+			with open(scores_dump_file(samples_number), "wb") as f:
+				pickle.dump(np.mean(scores, axis=0), f)
+	elif len(checkpoints) > 0:
+		# The sentences are tokenized once, then every checkpoint is loaded and evaluated once
+		pll_job = PseudoLogLikelihoodJob('pll', prepare_group_sentences(eval_group, occs_list, eval_group.targets))
+		pll_results = CheckpointEvaluationScheduler(factory=factory, checkpoints=checkpoints, jobs=[pll_job]).run()
+		for samples_number in training_samples:
+			if f'fine-tuned-{samples_number}' not in pll_results[pll_job.name]:
+				continue
+			tokens_log_probs, _ = pll_results[pll_job.name][f'fine-tuned-{samples_number}']
+			scores = perplexities_from_log_probs(tokens_log_probs)
+			scores = scores.reshape((len(eval_group.templates), len(occs_list), len(eval_group.targets)))
 			# The ndarray <scores> has dimensions [# templates, # occupations, # gender]
 			# We average the results for the templates:
 			scores = np.mean(scores, axis=0)
 			# Now, the ndarray <scores> has dimensions [# occupations, # gender]
 
 			# Saving a data checkpoint
-			with open(scores_dump_file, "wb") as f:
+			with open(scores_dump_file(samples_number), "wb") as f:
 				pickle.dump(scores, f)
 
+	for samples_number in training_samples:
+		with open(scores_dump_file(samples_number), "rb") as f:
+			scores: np.ndarray = pickle.load(f)
+
 		# Adding scores to the resulting dataset
 		for k, targ in enumerate(eval_group.targets):
 			col_name: str = f'fine-tuned-{samples_number}-{targ}'
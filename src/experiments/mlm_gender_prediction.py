@@ -10,8 +10,12 @@
 import typing
 
 import numpy as np
-from transformers import pipeline
+from scipy import sparse
 
+from src.models.masked_lm_scorer import MaskedLMScorer
+from src.models.parallel_runner import DataParallelMLMRunner
+from src.models.trained_model_factory import TrainedModelForMaskedLMFactory
+from src.parsers import jobs_parser
 from src.parsers.winogender_occupations_parser import OccupationsParser
 from src.models.gender_enum import Gender
 from src.models.templates import Template, TemplatesGroup
@@ -80,11 +84,25 @@ def extract_target_words(templates: dict[str, list[str]]) -> list[str]:
 	return list(targets)
 
 
+def prepare_template_sentences(templates_group: TemplatesGroup, occupations: list[str],
+                               occ_token: str = TOKEN_OCC) -> list[str]:
+	"""
+	Instantiates every template of the group with every occupation.
+	:param templates_group: The group of templates to fill.
+	:param occupations: The occupations to tune the templates.
+	:param occ_token: The occupation token that will be substituted with the words in the occupation list
+	:return: The flat list of sentences, in the order [# templates, # occupations]
+	"""
+	return [tmpl.sentence.replace(occ_token, occ) for tmpl in templates_group.templates for occ in occupations]
+
+
 def compute_scores(model: typing.Any | str, tokenizer: typing.Any | None,
                    templates_group: TemplatesGroup,
                    occupations: list[str], occ_token: str = TOKEN_OCC) -> np.ndarray:
 	"""
 	Computes the scores of the "fill-mask" task for the BERT encoder.
+	All the instantiated sentences are scored in batches, and only the target words are projected out of the
+	[MASK] hidden states (the normalization over the whole vocabulary is still computed).
 	:param occ_token: The occupation token that will be substituted with the words in the occupation list
 	:param model: The model, either a string or a trained model for ML task.
 	:param tokenizer: The tokenizer corresponding to the model. If the model is a string, this is optional.
@@ -94,35 +112,174 @@ def compute_scores(model: typing.Any | str, tokenizer: typing.Any | None,
 	:return: A numpy array of shape: [# templates, # occupations, # target words]
 	"""
 	# Initializing the model
-	if isinstance(model, str):
-		unmasker = pipeline("fill-mask", model=model,
-		                    targets=templates_group.targets,
-		                    top_k=len(templates_group.targets),
-		                    device=0)
+	scorer = MaskedLMScorer(model=model, tokenizer=tokenizer)
+
+	# Instantiating every template with every occupation, in the order of the result
+	sentences: list[str] = prepare_template_sentences(templates_group, occupations, occ_token)
+	print(f"Computing scores for {len(templates_group.templates)} templates and {len(occupations)} occupations")
+	scores: np.ndarray = scorer.score_targets(sentences, targets=templates_group.targets)
+	return scores.reshape((len(templates_group.templates), len(occupations), len(templates_group.targets)))
+
+
+def compute_scores_data_parallel(runner: DataParallelMLMRunner, templates_group: TemplatesGroup,
+                                 occupations: list[str], occ_token: str = TOKEN_OCC) -> np.ndarray:
+	"""
+	Computes the same scores of "compute_scores", but the (template, occupation) grid is split into shards that are
+	scored by the worker processes of the runner.
+	:param runner: The data-parallel runner, holding the model to evaluate.
+	:param templates_group: The group of templates to analyze.
+	:param occupations: The occupations to tune the templates.
+	:param occ_token: The occupation token that will be substituted with the words in the occupation list
+	:return: A numpy array of shape: [# templates, # occupations, # target words]
+	"""
+	sentences: list[str] = prepare_template_sentences(templates_group, occupations, occ_token)
+	scores: np.ndarray = runner.score_targets(sentences, targets=templates_group.targets)
+	return scores.reshape((len(templates_group.templates), len(occupations), len(templates_group.targets)))
+
+
+def compute_reverse_scores(model: typing.Any | str, tokenizer: typing.Any | None,
+                           templates_group: TemplatesGroup,
+                           occupations: list[str], occ_token: str = TOKEN_OCC) -> np.ndarray:
+	"""
+	Computes the scores of the "reverse" fill-mask task: the target word (e.g. "he" or "she") is written in the
+	template, while the occupation position is masked. Then, the probability of every occupation is read for that
+	gendered context.
+	Every occupation made of a single word-piece is read from the same forward pass, so the whole table costs one
+	pass for each template and target, plus a batched evaluation of the multi word-piece occupations.
+	:param model: The model, either a string or a trained model for ML task.
+	:param tokenizer: The tokenizer corresponding to the model. If the model is a string, this is optional.
+	:param templates_group: The group of templates to analyze.
+	:param occupations: The occupations to score in the masked position.
+	:param occ_token: The occupation token of the templates, that will be masked.
+	:return: A numpy array of shape: [# templates, # target words, # occupations]
+	"""
+	scorer = MaskedLMScorer(model=model, tokenizer=tokenizer)
+
+	# Instantiating every template with every target, and masking the occupation
+	contexts: list[str] = [tmpl.sentence.replace(TOKEN_MASK, targ).replace(occ_token, TOKEN_MASK)
+	                       for tmpl in templates_group.templates for targ in templates_group.targets]
+	print(f"Computing reverse scores for {len(contexts)} contexts and {len(occupations)} occupations")
+	scores: np.ndarray = scorer.score_fillers(contexts, words=occupations)
+	return scores.reshape((len(templates_group.templates), len(templates_group.targets), len(occupations)))
+
+
+def print_reverse_table_file(filepath: str, group: TemplatesGroup, occupations: list[str], data: np.ndarray) -> None:
+	"""
+	This function prints a table of the reverse scores for a template group.
+	:param filepath: The file where to print the table
+	:param group: The templates group
+	:param occupations: The occupations list
+	:param data: The 3D tensor of computed scores: [# template, # targets, # occupations]
+	:return: None
+	"""
+	with open(filepath, 'w') as f:
+		header: list[str] = ['template', 'occupation']
+		header.extend(group.targets)
+		print(settings.OUTPUT_TABLE_COL_SEPARATOR.join(header), file=f)
+		for i, tmpl in enumerate(group.templates):
+			for k, occ in enumerate(occupations):
+				row: list[str] = [tmpl.sentence, occ]
+				row.extend([str(score) for score in data[i, :, k]])
+				print(settings.OUTPUT_TABLE_COL_SEPARATOR.join(row), file=f)
+	return
+
+
+def mine_top_k_associations(model: typing.Any | str | None, tokenizer: typing.Any | None,
+                            templates_group: TemplatesGroup, occupations: list[str], k: int = 10,
+                            occ_token: str = TOKEN_OCC, occupations_chunk_size: int = 4096,
+                            runner: DataParallelMLMRunner | None = None) \
+		-> tuple[sparse.csr_matrix, sparse.csr_matrix]:
+	"""
+	Finds which words of the whole vocabulary the model prefers in the [MASK] position, for every occupation.
+	Unlike "compute_scores", the candidate words are not fixed by the targets of the group: for each sentence,
+	the K most probable tokens are extracted with a streaming top-K over the vocabulary.
+
+	The results are aggregated over the templates of the group, for each occupation, into two sparse tables:
+		- The counts table: how many templates have the token among their top-K predictions.
+		- The scores table: the sum of the probabilities of the token, over the templates where it's in the top-K.
+	The per-group aggregation is simply the sum of the rows of these tables.
+
+	:param model: The model, either a string or a trained model for ML task.
+	:param tokenizer: The tokenizer corresponding to the model. If the model is a string, this is optional.
+	:param templates_group: The group of templates to analyze.
+	:param occupations: The occupations to tune the templates.
+	:param k: The number of tokens extracted from each sentence.
+	:param occ_token: The occupation token that will be substituted with the words in the occupation list.
+	:param occupations_chunk_size: The number of occupations whose sentences are instantiated at the same time.
+	:param runner: If given, the sentences are scored by the workers of the data-parallel runner, and the model is
+	not used (the tokenizer is still required).
+	:return: The pair of sparse matrices (counts, scores), both of shape: [# occupations, # vocabulary tokens]
+	"""
+	if runner is None:
+		scorer = MaskedLMScorer(model=model, tokenizer=tokenizer)
+		vocabulary_size: int = scorer.vocabulary_size
 	else:
-		unmasker = pipeline("fill-mask", model=model,
-		                    tokenizer=tokenizer,
-		                    targets=templates_group.targets,
-		                    top_k=len(templates_group.targets),
-		                    device=0)
-
-	# Initializing the result
-	scores: np.ndarray = np.zeros(
-		shape=(len(templates_group.templates), len(occupations), len(templates_group.targets)))
-	# For every template
-	for i, tmpl in enumerate(templates_group.templates):
-		print("Computing scores for template: ", tmpl.sentence)
-		# For every occupation
-		for j, occ in enumerate(occupations):
-			tmpl_occ = tmpl.sentence.replace(occ_token, occ)
-			results = unmasker(tmpl_occ)
+		vocabulary_size: int = len(tokenizer)
+	num_templates: int = len(templates_group.templates)
+	rows: list[np.ndarray] = []
+	cols: list[np.ndarray] = []
+	probs: list[np.ndarray] = []
+
+	for start in range(0, len(occupations), occupations_chunk_size):
+		chunk_occupations: list[str] = occupations[start:start + occupations_chunk_size]
+		print(f"Mining top-{k} tokens for occupations from {start} to {start + len(chunk_occupations)}")
+		# Sentences are ordered by occupation, then by template
+		sentences: list[str] = [tmpl.sentence.replace(occ_token, occ)
+		                        for occ in chunk_occupations for tmpl in templates_group.templates]
+		if runner is None:
+			batches = scorer.iter_top_k(sentences, k=k)
+		else:
+			batches = [(np.arange(len(sentences)), *runner.top_k(sentences, k=k))]
+		for indices, top_ids, top_probs in batches:
+			occupation_indices = start + indices // num_templates
+			rows.append(np.repeat(occupation_indices, top_ids.shape[-1]))
+			cols.append(top_ids.ravel())
+			probs.append(top_probs.ravel())
+
+	# Duplicated entries (i.e. the same token for the same occupation in different templates) are summed
+	shape = (len(occupations), vocabulary_size)
+	rows_arr, cols_arr, probs_arr = np.concatenate(rows), np.concatenate(cols), np.concatenate(probs)
+	counts = sparse.coo_matrix((np.ones_like(rows_arr, dtype=np.int32), (rows_arr, cols_arr)), shape=shape).tocsr()
+	scores = sparse.coo_matrix((probs_arr, (rows_arr, cols_arr)), shape=shape).tocsr()
+	return counts, scores
+
 
-			results_aux: dict = {}
-			for res in results:
-				results_aux[res["token_str"]] = res["score"]
-			# Saving the results for the current template and for the current occupation
-			scores[i][j] = [results_aux[targ] for targ in templates_group.targets]
-	return scores
+def print_top_k_table_files(filepath_prefix: str, tokenizer, occupations: list[str],
+                            counts: sparse.csr_matrix, scores: sparse.csr_matrix, top: int = 10) -> None:
+	"""
+	This function prints the tables of the mined top-K associations: one table for the whole group, and one
+	table with the best tokens for each occupation.
+	:param filepath_prefix: The path of the tables, without the suffix and the extension
+	:param tokenizer: The tokenizer used to convert the token ids into strings
+	:param occupations: The occupations list
+	:param counts: The sparse counts table: [# occupations, # vocabulary tokens]
+	:param scores: The sparse scores table: [# occupations, # vocabulary tokens]
+	:param top: The number of tokens printed for each occupation
+	:return: None
+	"""
+	col_sep = settings.OUTPUT_TABLE_COL_SEPARATOR
+	elem_sep = settings.OUTPUT_TABLE_ARRAY_ELEM_SEPARATOR
+
+	# Group table: the tokens are sorted by their total score
+	group_counts = np.asarray(counts.sum(axis=0)).ravel()
+	group_scores = np.asarray(scores.sum(axis=0)).ravel()
+	found_ids = np.flatnonzero(group_counts)
+	found_ids = found_ids[np.argsort(-group_scores[found_ids], kind='stable')]
+	with open(f'{filepath_prefix}_group.{settings.OUTPUT_TABLE_FILE_EXTENSION}', 'w') as f:
+		print(col_sep.join(['token', 'count', 'score']), file=f)
+		for token, count, score in zip(tokenizer.convert_ids_to_tokens(found_ids.tolist()),
+		                               group_counts[found_ids], group_scores[found_ids]):
+			print(col_sep.join([token, str(count), str(score)]), file=f)
+
+	# Occupations table
+	with open(f'{filepath_prefix}_occupations.{settings.OUTPUT_TABLE_FILE_EXTENSION}', 'w') as f:
+		print(col_sep.join(['occupation', 'tokens', 'scores']), file=f)
+		for j, occ in enumerate(occupations):
+			occ_scores = scores.getrow(j)
+			best = np.argsort(-occ_scores.data, kind='stable')[:top]
+			tokens = tokenizer.convert_ids_to_tokens(occ_scores.indices[best].tolist())
+			print(col_sep.join([occ, elem_sep.join(tokens), elem_sep.join(map(str, occ_scores.data[best]))]), file=f)
+	return
 
 
 def print_table_file(filepath: str, group: TemplatesGroup, occupations: list[str],
@@ -165,48 +322,118 @@ def launch() -> None:
 	parser = OccupationsParser()
 	occs_list: list[str] = parser.occupations_list
 
+	# The same model is used for every group
+	factory = TrainedModelForMaskedLMFactory(model_name=settings.DEFAULT_BERT_MODEL_NAME)
+	model = factory.get_model()
+	# If enabled, the scores are computed by a pool of workers, shared by all the groups
+	runner: DataParallelMLMRunner | None = None
+	if settings.MLM_DATA_PARALLEL_WORKERS > 0:
+		runner = DataParallelMLMRunner(model_name=settings.DEFAULT_BERT_MODEL_NAME,
+		                               num_workers=settings.MLM_DATA_PARALLEL_WORKERS)
+
 	groups = [
 		template_group_pronouns,
 		template_group_personalnames,
 		template_group_relatives,
 	]
 
-	for g_ix, group in enumerate(groups):
-		# Computing scores
-		scores: np.ndarray = compute_scores(templates_group=group, occupations=occs_list)
-
-		# Printing one table for each template
-		print_table_file(
-			filepath=f'{FOLDER_OUTPUT_TABLES}/'
-			         f'group_{group.name}_by_targets.{settings.OUTPUT_TABLE_FILE_EXTENSION}',
-			group=group,
-			occupations=occs_list,
-			parser=parser,
-			data=scores,
-		)
+	try:
+		for g_ix, group in enumerate(groups):
+			# Computing scores
+			if runner is not None:
+				scores: np.ndarray = compute_scores_data_parallel(runner=runner, templates_group=group,
+				                                                  occupations=occs_list)
+			else:
+				scores: np.ndarray = compute_scores(model=model, tokenizer=factory.tokenizer,
+				                                    templates_group=group, occupations=occs_list)
 
-		for i, tmpl in enumerate(group.templates):
-			tmpl_scores = scores[i]
-			# Template scores dimensions: [# occupations, # targets]
-
-			# Plotting the bar scores graph for each template
-			plot_image_bars_by_target(
-				filepath=f'{FOLDER_OUTPUT_IMAGES}/'
-				         f'group_{group.name}_by_targets_{i:02d}.{settings.OUTPUT_IMAGE_FILE_EXTENSION}',
-				template=tmpl,
+			# Printing one table for each template
+			print_table_file(
+				filepath=f'{FOLDER_OUTPUT_TABLES}/'
+				         f'group_{group.name}_by_targets.{settings.OUTPUT_TABLE_FILE_EXTENSION}',
 				group=group,
 				occupations=occs_list,
-				data=tmpl_scores,
+				parser=parser,
+				data=scores,
 			)
 
-			# Plotting the bar scores graph for each template
-			plot_image_bars_by_gender_by_template(
-				filepath=f'{FOLDER_OUTPUT_IMAGES}/'
-				         f'group_{group.name}_by_genders_{i:02d}.{settings.OUTPUT_IMAGE_FILE_EXTENSION}',
-				template=tmpl,
+			for i, tmpl in enumerate(group.templates):
+				tmpl_scores = scores[i]
+				# Template scores dimensions: [# occupations, # targets]
+
+				# Plotting the bar scores graph for each template
+				plot_image_bars_by_target(
+					filepath=f'{FOLDER_OUTPUT_IMAGES}/'
+					         f'group_{group.name}_by_targets_{i:02d}.{settings.OUTPUT_IMAGE_FILE_EXTENSION}',
+					template=tmpl,
+					group=group,
+					occupations=occs_list,
+					data=tmpl_scores,
+				)
+
+				# Plotting the bar scores graph for each template
+				plot_image_bars_by_gender_by_template(
+					filepath=f'{FOLDER_OUTPUT_IMAGES}/'
+					         f'group_{group.name}_by_genders_{i:02d}.{settings.OUTPUT_IMAGE_FILE_EXTENSION}',
+					template=tmpl,
+					group=group,
+					occupations=occs_list,
+					data=tmpl_scores,
+				)
+
+			# Computing the reverse scores: occupations given the gendered context
+			reverse_scores: np.ndarray = compute_reverse_scores(model=model, tokenizer=factory.tokenizer,
+			                                                    templates_group=group, occupations=occs_list)
+			print_reverse_table_file(
+				filepath=f'{FOLDER_OUTPUT_TABLES}/'
+				         f'group_{group.name}_reverse.{settings.OUTPUT_TABLE_FILE_EXTENSION}',
 				group=group,
 				occupations=occs_list,
-				data=tmpl_scores,
+				data=reverse_scores,
 			)
+	finally:
+		if runner is not None:
+			runner.close()
+	return
+
+
+def launch_top_k() -> None:
+	"""
+	Mines the preferred tokens of the whole vocabulary for the full list of job titles, for every group.
+	This is separated from "launch", since it evaluates all the templates for tens of thousands of job titles.
+	"""
+	# The full list of job titles
+	job_titles: list[str] = jobs_parser.get_words_list(jobs_parser.DATASET_JNEIDEL_OCCUPATIONS)
 
+	factory = TrainedModelForMaskedLMFactory(model_name=settings.DEFAULT_BERT_MODEL_NAME)
+	# If enabled, the sentences are scored by a pool of workers, shared by all the groups
+	runner: DataParallelMLMRunner | None = None
+	model = None
+	if settings.MLM_DATA_PARALLEL_WORKERS > 0:
+		runner = DataParallelMLMRunner(model_name=settings.DEFAULT_BERT_MODEL_NAME,
+		                               num_workers=settings.MLM_DATA_PARALLEL_WORKERS)
+	else:
+		model = factory.get_model()
+
+	groups = [
+		template_group_pronouns,
+		template_group_personalnames,
+		template_group_relatives,
+	]
+
+	try:
+		for group in groups:
+			top_k_counts, top_k_scores = mine_top_k_associations(model=model, tokenizer=factory.tokenizer,
+			                                                     templates_group=group, occupations=job_titles,
+			                                                     runner=runner)
+			print_top_k_table_files(
+				filepath_prefix=f'{FOLDER_OUTPUT_TABLES}/group_{group.name}_top_k',
+				tokenizer=factory.tokenizer,
+				occupations=job_titles,
+				counts=top_k_counts,
+				scores=top_k_scores,
+			)
+	finally:
+		if runner is not None:
+			runner.close()
 	return
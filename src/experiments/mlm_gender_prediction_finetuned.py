@@ -6,12 +6,14 @@
 # This experiment does the same things as the other, but with fine-tuned BERT
 
 
+import os
 import random
 
 import numpy as np
 
-from src.experiments.mlm_gender_prediction import compute_scores
+from src.models.evaluation_scheduler import Checkpoint, CheckpointEvaluationScheduler, FillMaskScoresJob
 from src.models.gender_enum import Gender
+from src.models.sweep_runner import FineTuningSweepRunner
 from src.models.trained_model_factory import TrainedModelForMaskedLMFactory
 from src.parsers import jobs_parser
 from src.parsers.article_inference import infer_indefinite_article
@@ -80,6 +82,23 @@ def prepare_sentences(templates_group: TemplatesGroup, occupations: list[str]) -
 	return sentences
 
 
+def print_training_records_table(filepath: str, records: dict[str, list[dict]]) -> None:
+	"""
+	Prints the table of the training records (throughput and peak memory) of the trained checkpoints.
+	:param filepath: The path of the table.
+	:param records: The training records of each checkpoint, by name (see: "FineTuningSweepRunner.run").
+	:return: None
+	"""
+	columns: list[str] = ['profile', 'tokens', 'seconds', 'tokens_per_second', 'peak_memory_bytes']
+	os.makedirs(os.path.dirname(filepath), exist_ok=True)
+	with open(filepath, 'w') as f:
+		print(settings.OUTPUT_TABLE_COL_SEPARATOR.join(['checkpoint'] + columns), file=f)
+		for name, checkpoint_records in records.items():
+			for record in checkpoint_records:
+				row: list[str] = [name] + [str(record[col]) for col in columns]
+				print(settings.OUTPUT_TABLE_COL_SEPARATOR.join(row), file=f)
+
+
 def launch() -> None:
 	# Templates group
 	train_occs_list: list[str] = jobs_parser.get_words_list()
@@ -94,48 +113,43 @@ def launch() -> None:
 	# model_name = "distilbert-base-uncased"
 
 	factory = TrainedModelForMaskedLMFactory(model_name=model_name)
+	# The sentences are tokenized once, and the samples are selected from them
+	factory.set_texts_pool(sentences)
 	training_samples: list[int] = [500, 1000, 2000, 5000, 10000, 20000]
-	models: dict[str, ] = {'base': factory.get_model(training_text=None)}
+	checkpoints: list[Checkpoint] = [Checkpoint('base')]
 	for samples_number in training_samples:
 		sentences_sampled = random.sample(sentences, samples_number)
 		saved_model_ft_path = settings.FOLDER_SAVED_MODELS + f"/mlm_gender_prediction_finetuned/mlm_gender_prediction_{model_name}_{samples_number}"
-		models[f'fine-tuned-{samples_number}'] = factory.get_model(training_text=sentences_sampled,
-		                                                           load_or_save_path=saved_model_ft_path)
+		checkpoints.append(Checkpoint(f'fine-tuned-{samples_number}', load_or_save_path=saved_model_ft_path,
+		                              fine_tuning_text=sentences_sampled))
+
+	# Training the missing checkpoints in parallel
+	training_records = FineTuningSweepRunner(factory=factory).run(checkpoints)
+	if len(training_records) > 0:
+		print_training_records_table(f'{FOLDER_OUTPUT_TABLES}/training_records.{settings.OUTPUT_TABLE_FILE_EXTENSION}',
+		                             records=training_records)
 
 	# Eval
 	eval_occs_list: list[str] = OccupationsParser().occupations_list
 	eval_artoccs_list = list(map(lambda occ: infer_indefinite_article(occ) + ' ' + occ, eval_occs_list))
 
-	# Computing scores for every model
-	scores_by_model: dict[str, np.ndarray] = {}
-	for model_name, model in models.items():
-		scores = compute_scores(model=model, tokenizer=factory.tokenizer,
-		                        templates_group=eval_group, occupations=eval_artoccs_list, occ_token=occupation_token)
-
-		# Grouping scores by occupations by averaging the results for different templates
-		scores_grouped_by_occupations = np.mean(scores, axis=0)
-		# Saving the grouped scores for the model into the main scores array
-		scores_by_model[model_name] = scores_grouped_by_occupations
-
-		"""
-		# Plotting graph for the model
-		plot_image_bars_by_gender(
-			filepath=f'{FOLDER_OUTPUT_IMAGES}/'
-			         f'model_{model_name}_all.{settings.OUTPUT_IMAGE_FILE_EXTENSION}',
-			group=eval_group,
-			occupations=eval_occs_list,
-			data=scores_grouped_by_occupations,
-			title=f"Results of model " + model_name,
-		)"""
+	# Computing scores for every model, loading one model at a time
+	scores_job = FillMaskScoresJob('scores', templates_group=eval_group, occupations=eval_artoccs_list,
+	                               occ_token=occupation_token)
+	results = CheckpointEvaluationScheduler(factory=factory, checkpoints=checkpoints, jobs=[scores_job]).run()
+
+	# Grouping scores by occupations by averaging the results for different templates
+	scores_by_model: dict[str, np.ndarray] = {name: np.mean(scores, axis=0)
+	                                          for name, scores in results[scores_job.name].items()}
 
 	# Printing one table for each model
 	print("Writing table on file...")
 	with open(f'{FOLDER_OUTPUT_TABLES}/predictions_models-compared.{settings.OUTPUT_TABLE_FILE_EXTENSION}', 'w') as f:
 		header: list[str] = ['model', 'occupation']
-		header.extend(eval_group.targets)
+		header.extend(scores_job.targets)
 		print(settings.OUTPUT_TABLE_COL_SEPARATOR.join(header), file=f)
 
-		for model_name in models.keys():
+		for model_name in scores_by_model.keys():
 			scores = scores_by_model[model_name]
 			for j, occ in enumerate(eval_occs_list):
 				row: list[str] = [model_name, occ]
@@ -0,0 +1,105 @@
+#########################################################################
+#                            Dusi's Thesis                              #
+# Algorithmic Discrimination and Natural Language Processing Techniques #
+#########################################################################
+
+# This class implements the Word Embedding Association Test (WEAT, Caliskan et al. 2017) over the layers of a model.
+# Given two sets of target words (X, Y) and two sets of attribute words (A, B), the test measures how much the targets
+# of X are closer to the attributes of A than the targets of Y, with the effect size and a permutation p-value.
+
+import numpy as np
+
+import settings
+
+
+class WordEmbeddingAssociationTest:
+	"""
+	The WEAT test, computed independently for each layer of the embeddings.
+	The cosine similarities between targets and attributes are computed once for all the layers; the permutations of the
+	targets are evaluated all together as a single matrix product.
+	"""
+
+	# The number of random partitions of the targets used to estimate the p-values
+	num_permutations: int = 10000
+
+	def __init__(self, targets_x: np.ndarray, targets_y: np.ndarray,
+	             attributes_a: np.ndarray, attributes_b: np.ndarray):
+		"""
+		All the embeddings have dimensions [# words, # layers, # features].
+		:param targets_x: The embeddings of the first set of targets.
+		:param targets_y: The embeddings of the second set of targets.
+		:param attributes_a: The embeddings of the first set of attributes.
+		:param attributes_b: The embeddings of the second set of attributes.
+		"""
+		targets_x, targets_y = np.asarray(targets_x), np.asarray(targets_y)
+		attributes_a, attributes_b = np.asarray(attributes_a), np.asarray(attributes_b)
+		if len(targets_x) == 0 or len(targets_y) == 0 or len(attributes_a) == 0 or len(attributes_b) == 0:
+			raise AttributeError("The sets of targets and attributes of the association test cannot be empty")
+		self.__num_x: int = len(targets_x)
+		self.__num_y: int = len(targets_y)
+
+		def normalize(embeddings: np.ndarray) -> np.ndarray:
+			embeddings = embeddings.astype(np.float64)
+			norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+			return embeddings / np.maximum(norms, 1e-12)
+
+		targets = normalize(np.concatenate((targets_x, targets_y)))
+		# Cosine similarities between each target and each attribute: [# layers, # targets, # attributes]
+		cos_a = np.einsum('nlf,alf->lna', targets, normalize(attributes_a))
+		cos_b = np.einsum('nlf,alf->lna', targets, normalize(attributes_b))
+		# Association of each target with the attributes: s(w, A, B) = mean_a cos(w, a) - mean_b cos(w, b)
+		self.__associations: np.ndarray = cos_a.mean(axis=-1) - cos_b.mean(axis=-1)
+		self.__p_values: np.ndarray | None = None
+
+	@property
+	def associations(self) -> np.ndarray:
+		"""
+		:return: The associations of the targets (first X, then Y) with the attributes, of dimensions [# layers, # targets]
+		"""
+		return self.__associations
+
+	def __statistics(self, signs: np.ndarray) -> np.ndarray:
+		"""
+		Computes the test statistic s(X, Y, A, B) = sum_x s(x, A, B) - sum_y s(y, A, B) for many partitions at once.
+		:param signs: The partitions of the targets, of dimensions [# partitions, # targets]: +1 for X and -1 for Y.
+		:return: The statistics, of dimensions [# partitions, # layers].
+		"""
+		return signs @ self.__associations.T
+
+	@property
+	def statistics(self) -> np.ndarray:
+		"""
+		:return: The test statistic of each layer, of dimensions [# layers].
+		"""
+		signs = np.concatenate((np.ones(self.__num_x), -np.ones(self.__num_y)))
+		return self.__statistics(signs[np.newaxis])[0]
+
+	@property
+	def effect_sizes(self) -> np.ndarray:
+		"""
+		The effect size of each layer: the difference between the mean associations of X and Y, normalized by the
+		standard deviation of the associations of all the targets.
+		:return: The effect sizes, of dimensions [# layers].
+		"""
+		assoc_x = self.__associations[:, :self.__num_x]
+		assoc_y = self.__associations[:, self.__num_x:]
+		return (assoc_x.mean(axis=-1) - assoc_y.mean(axis=-1)) / self.__associations.std(axis=-1, ddof=1)
+
+	@property
+	def p_values(self) -> np.ndarray:
+		"""
+		The one-sided p-value of each layer: the probability that a random partition of the targets in two sets of the
+		same sizes of X and Y has a test statistic greater or equal than the observed one.
+		The partitions are sampled (with a fixed seed) and shared by all the layers.
+		:return: The p-values, of dimensions [# layers].
+		"""
+		if self.__p_values is None:
+			rng = np.random.default_rng(settings.RANDOM_SEED)
+			signs = np.concatenate((np.ones(self.__num_x), -np.ones(self.__num_y)))
+			# Each row is a random permutation of the labels: [# permutations, # targets]
+			permuted_signs = rng.permuted(np.tile(signs, (self.num_permutations, 1)), axis=1)
+			permuted_statistics = self.__statistics(permuted_signs)
+			# The observed partition is counted as one of the permutations
+			exceeding = np.sum(permuted_statistics >= self.statistics - 1e-12, axis=0)
+			self.__p_values = (exceeding + 1) / (self.num_permutations + 1)
+		return self.__p_values
@@ -0,0 +1,204 @@
+#########################################################################
+#                            Dusi's Thesis                              #
+# Algorithmic Discrimination and Natural Language Processing Techniques #
+#########################################################################
+
+# This class saves the fine-tuned models as differences ("deltas") from their base model.
+# Each tensor delta is stored in the smallest encoding respecting an error budget relative to the scale of the tensor
+# (int8 with per-row scales, float16 or float32), and the tensors which did not change are not stored at all.
+# A model is loaded by adding the memory-mapped deltas to the base.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+MANIFEST_FILE_NAME: str = 'delta_manifest.json'
+FOLDER_TENSORS: str = 'deltas'
+
+# Encodings of the tensors
+ENCODING_UNCHANGED: str = 'unchanged'
+ENCODING_INT8: str = 'int8'
+ENCODING_FLOAT16: str = 'float16'
+ENCODING_FLOAT32: str = 'float32'
+# The tensor is stored as it is, without the base (e.g. for non-floating tensors, or tensors missing in the base)
+ENCODING_FULL: str = 'full'
+# The tensor shares the weights of another tensor (e.g. the MLM decoder tied to the word embeddings)
+ENCODING_TIED: str = 'tied'
+
+
+class DeltaCheckpointStore:
+	"""
+	A store of fine-tuned checkpoints, each one saved as a set of per-tensor deltas from the base model.
+	The base model is identified by a fingerprint of its weights: a checkpoint can be loaded only on the same base.
+
+	The maximum error allowed on every element of a delta is a fraction of the standard deviation of the base tensor
+	("relative_error_budget"), but never less than an absolute floor ("error_budget").
+	"""
+
+	# The maximum error allowed on every element of a delta, as a fraction of the standard deviation of the base tensor
+	relative_error_budget: float = 1e-2
+	# The minimum absolute error allowed on every element of a delta (e.g. for the constant tensors)
+	error_budget: float = 1e-5
+	# The number of elements of each tensor read by the fingerprint
+	fingerprint_samples: int = 4096
+
+	@staticmethod
+	def has_checkpoint(path: str | None) -> bool:
+		"""
+		:return: True if the given folder contains a delta checkpoint.
+		"""
+		return path is not None and os.path.isfile(os.path.join(path, MANIFEST_FILE_NAME))
+
+	def fingerprint(self, state: dict[str, torch.Tensor]) -> str:
+		"""
+		Computes the fingerprint of the weights of a model: the hash of the names and shapes of its tensors, and of a
+		fixed sample of their values (evenly spaced elements), so that it's fast even for large models.
+		:param state: The state dictionary of the model.
+		:return: The fingerprint, as an hexadecimal string.
+		"""
+		digest = hashlib.sha256()
+		for name in sorted(state.keys()):
+			tensor = state[name].detach()
+			digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+			flat = tensor.reshape(-1)
+			step: int = max(1, flat.numel() // self.fingerprint_samples)
+			digest.update(flat[::step].cpu().contiguous().view(torch.uint8).numpy().tobytes())
+		return digest.hexdigest()
+
+	def __error_budget(self, base: np.ndarray) -> float:
+		"""
+		:return: The maximum error allowed on the elements of the delta of a tensor, depending on the base tensor.
+		"""
+		return max(self.error_budget, self.relative_error_budget * float(np.std(base)))
+
+	@staticmethod
+	def __as_rows(array: np.ndarray) -> np.ndarray:
+		"""
+		:return: The array as a matrix, with the first dimension as rows (a vector is a single row).
+		"""
+		return array.reshape((array.shape[0], -1)) if array.ndim >= 2 else array.reshape((1, -1))
+
+	def __encode_delta(self, delta: np.ndarray, budget: float) -> tuple[str, np.ndarray | None, np.ndarray | None]:
+		"""
+		Chooses the smallest encoding of a delta whose error respects the budget.
+		:return: The encoding name, the encoded array (None if unchanged), and the quantization scales of the rows
+		(only for int8).
+		"""
+		if delta.size == 0 or not np.any(delta):
+			return ENCODING_UNCHANGED, None, None
+		# With a symmetric 8-bit quantization, the maximum error is half the quantization step of the row
+		rows = self.__as_rows(delta)
+		scales = np.max(np.abs(rows), axis=1) / 127
+		if float(np.max(scales)) / 2 <= budget:
+			safe_scales = np.where(scales > 0, scales, 1.0)
+			return ENCODING_INT8, np.round(rows / safe_scales[:, np.newaxis]).astype(np.int8), scales.astype(np.float32)
+		half = delta.astype(np.float16)
+		if np.all(np.isfinite(half)) and float(np.max(np.abs(half.astype(np.float32) - delta))) <= budget:
+			return ENCODING_FLOAT16, half, None
+		return ENCODING_FLOAT32, delta, None
+
+	def save(self, model: torch.nn.Module, base_model: torch.nn.Module, path: str, base_model_name: str) -> None:
+		"""
+		Saves a model as the deltas from its base model, and prints the achieved compression ratio.
+		:param model: The fine-tuned model.
+		:param base_model: The base model, from which the model has been fine-tuned.
+		:param path: The folder of the checkpoint.
+		:param base_model_name: The name of the base model, written in the manifest.
+		:return: None
+		"""
+		state: dict[str, torch.Tensor] = model.state_dict()
+		base_state: dict[str, torch.Tensor] = base_model.state_dict()
+		os.makedirs(os.path.join(path, FOLDER_TENSORS), exist_ok=True)
+
+		tensors_manifest: dict[str, dict] = {}
+		names_by_pointer: dict[int, str] = {}
+		full_bytes: int = 0
+		stored_bytes: int = 0
+		for i, (name, tensor) in enumerate(state.items()):
+			entry: dict = {'shape': list(tensor.shape), 'dtype': str(tensor.dtype).replace('torch.', '')}
+			if tensor.data_ptr() in names_by_pointer:
+				entry['encoding'] = ENCODING_TIED
+				entry['tied_to'] = names_by_pointer[tensor.data_ptr()]
+				tensors_manifest[name] = entry
+				continue
+			names_by_pointer[tensor.data_ptr()] = name
+
+			tensor = tensor.detach().cpu()
+			full_bytes += tensor.numel() * tensor.element_size()
+			base_tensor = base_state.get(name)
+			scales = None
+			if base_tensor is None or base_tensor.shape != tensor.shape or not tensor.is_floating_point():
+				if base_tensor is not None and torch.equal(base_tensor.cpu(), tensor):
+					encoding, encoded = ENCODING_UNCHANGED, None
+				else:
+					encoding, encoded = ENCODING_FULL, tensor.numpy()
+			else:
+				base_array = base_tensor.cpu().float().numpy()
+				delta = tensor.float().numpy() - base_array
+				encoding, encoded, scales = self.__encode_delta(delta, budget=self.__error_budget(base_array))
+			entry['encoding'] = encoding
+			if encoded is not None:
+				entry['file'] = f"{FOLDER_TENSORS}/{i}.npy"
+				np.save(os.path.join(path, entry['file']), encoded)
+				stored_bytes += encoded.nbytes
+			if scales is not None:
+				entry['scales_file'] = f"{FOLDER_TENSORS}/{i}_scales.npy"
+				np.save(os.path.join(path, entry['scales_file']), scales)
+				stored_bytes += scales.nbytes
+			tensors_manifest[name] = entry
+
+		manifest = {
+			'base_model_name': base_model_name,
+			'base_fingerprint': self.fingerprint(base_state),
+			'relative_error_budget': self.relative_error_budget,
+			'error_budget': self.error_budget,
+			'compression_ratio': full_bytes / max(1, stored_bytes),
+			'tensors': tensors_manifest,
+		}
+		with open(os.path.join(path, MANIFEST_FILE_NAME), 'w') as f:
+			json.dump(manifest, f, indent=1)
+		print(f"Delta checkpoint saved in {path}: {stored_bytes / 2 ** 20:.1f} MB instead of "
+		      f"{full_bytes / 2 ** 20:.1f} MB (ratio {manifest['compression_ratio']:.1f}x)")
+
+	def load(self, base_model: torch.nn.Module, path: str) -> torch.nn.Module:
+		"""
+		Loads a checkpoint, adding its deltas to the base model.
+		:param base_model: The base model of the checkpoint. It's modified in place.
+		:param path: The folder of the checkpoint.
+		:return: The fine-tuned model.
+		"""
+		with open(os.path.join(path, MANIFEST_FILE_NAME), 'r') as f:
+			manifest = json.load(f)
+		base_state: dict[str, torch.Tensor] = base_model.state_dict()
+		if self.fingerprint(base_state) != manifest['base_fingerprint']:
+			raise AttributeError(f"The checkpoint in {path} was not saved on the given base model "
+			                     f"(expected: <{manifest['base_model_name']}>)")
+
+		with torch.no_grad():
+			for name, entry in manifest['tensors'].items():
+				# The tied tensors are updated with the tensor they're tied to
+				if entry['encoding'] in (ENCODING_UNCHANGED, ENCODING_TIED):
+					continue
+				if name not in base_state:
+					raise AttributeError(f"The checkpoint in {path} contains the tensor <{name}>, "
+					                     f"missing in the base model")
+				# The copy-on-write mapping is writable (as required by PyTorch), but it's never written:
+				# the file pages are read only when the tensor is added to the base
+				values = torch.from_numpy(np.load(os.path.join(path, entry['file']), mmap_mode='c'))
+				if entry['encoding'] == ENCODING_FULL:
+					if base_state[name].shape != values.shape:
+						raise AttributeError(f"The tensor <{name}> of the checkpoint in {path} has shape "
+						                     f"{tuple(values.shape)}, while in the base model it has shape "
+						                     f"{tuple(base_state[name].shape)}")
+					base_state[name].copy_(values)
+					continue
+				delta = values.to(base_state[name].dtype)
+				if entry['encoding'] == ENCODING_INT8:
+					scales = torch.from_numpy(np.load(os.path.join(path, entry['scales_file'])))
+					delta = (delta * scales.to(delta.dtype).unsqueeze(-1)).reshape(base_state[name].shape)
+				base_state[name].add_(delta)
+		base_model.load_state_dict(base_state)
+		return base_model
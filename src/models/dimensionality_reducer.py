@@ -9,17 +9,130 @@ from abc import ABC, abstractmethod
 
 import numpy as np
 import torch
-from sklearn.decomposition import PCA
+from numpy.lib.format import open_memmap
+from sklearn.decomposition import IncrementalPCA
 
+import settings
 from src.models.gender_classifier import _AbstractGenderClassifier
 from src.models.layers_iterator import LayersIterator
 
+# The randomized SVD is used when the components are less than this fraction of the matrix rank (as in Scikit-Learn)
+RANDOMIZED_PCA_MAX_COMPONENTS_RATIO: float = 0.8
+RANDOMIZED_PCA_OVERSAMPLES: int = 10
+RANDOMIZED_PCA_POWER_ITERATIONS: int = 7
+
+
+def _floating_dtype(dtype: np.dtype) -> np.dtype:
+	"""
+	Returns the given dtype if it's a floating-point one, or the dtype of 64-bit floats otherwise.
+	"""
+	return dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float64)
+
+
+def _as_layers_array(embeddings: np.ndarray | torch.Tensor, to_floating: bool = True) -> np.ndarray:
+	"""
+	Returns the embeddings as a floating-point array of dimensions [# samples, # layers, # features].
+	As in "LayersIterator", a 2D array is considered a single layer, and a 1D array a single sample of a single layer.
+	If "to_floating" is False, the dtype is kept: e.g. an out-of-core reducer converts a memory-mapped array one chunk
+	at a time, instead of loading all of it in memory.
+	"""
+	if isinstance(embeddings, torch.Tensor):
+		embeddings = embeddings.detach().cpu().numpy()
+	if to_floating and not np.issubdtype(embeddings.dtype, np.floating):
+		embeddings = embeddings.astype(np.float64)
+	if embeddings.ndim == 1:
+		return embeddings[np.newaxis, np.newaxis]
+	elif embeddings.ndim == 2:
+		return embeddings[:, np.newaxis]
+	elif embeddings.ndim == 3:
+		return embeddings
+	raise AttributeError("Cannot detect embeddings structure into the given array")
+
+
+def _fit_batched_pca(embeddings: np.ndarray, n: int) -> tuple[np.ndarray, np.ndarray]:
+	"""
+	Computes the PCA of every layer at once, with a batched SVD over the layers dimension.
+	If the number of components is small, the SVD is randomized (with a batched range finder), as in Scikit-Learn.
+	The signs of the components are fixed so that the largest coefficient of each component is positive.
+
+	:param embeddings: The training data, of dimensions [# samples, # layers, # features]
+	:param n: The number of components.
+	:return: The mean of each layer [# layers, # features], and the components as projection matrices
+	[# layers, # features, n]. Both keep the input dtype.
+	"""
+	num_samples, num_layers, num_features = embeddings.shape
+	mean = np.mean(embeddings, axis=0)
+	centered = np.swapaxes(embeddings - mean, 0, 1)
+
+	max_rank: int = min(num_samples, num_features)
+	if n < RANDOMIZED_PCA_MAX_COMPONENTS_RATIO * max_rank and max(num_samples, num_features) > 500:
+		rng = np.random.default_rng(settings.RANDOM_SEED)
+		k: int = min(n + RANDOMIZED_PCA_OVERSAMPLES, max_rank)
+		sketch = centered @ rng.standard_normal(size=(num_layers, num_features, k)).astype(embeddings.dtype)
+		for _ in range(RANDOMIZED_PCA_POWER_ITERATIONS):
+			q, _ = np.linalg.qr(sketch)
+			sketch = centered @ (np.swapaxes(centered, 1, 2) @ q)
+		q, _ = np.linalg.qr(sketch)
+		_, _, vh = np.linalg.svd(np.swapaxes(q, 1, 2) @ centered, full_matrices=False)
+	else:
+		_, _, vh = np.linalg.svd(centered, full_matrices=False)
+	components = vh[:, :n]
+	# Deterministic signs: [# layers, n]
+	max_abs_indices = np.argmax(np.abs(components), axis=-1)
+	signs = np.sign(np.take_along_axis(components, max_abs_indices[..., np.newaxis], axis=-1))
+	signs[signs == 0] = 1
+	components = components * signs
+	return mean, np.ascontiguousarray(np.swapaxes(components, 1, 2)).astype(embeddings.dtype, copy=False)
+
+
+def _apply_affine(embeddings: np.ndarray | torch.Tensor, matrix: np.ndarray,
+                  offset: np.ndarray) -> np.ndarray | torch.Tensor:
+	"""
+	Applies an affine transformation (x @ W + b) to a NumPy array or to a PyTorch tensor, keeping its type and dtype.
+	A tensor stays on its device: only the parameters are moved there.
+	:param embeddings: The input, of dimensions [..., M], or [# samples, # layers, M] if the matrix depends on the layer.
+	:param matrix: The matrix W, of dimensions [M, N] or [# layers, M, N].
+	:param offset: The offset b, of dimensions [N] or [# layers, N].
+	:return: The transformed input.
+	"""
+	if isinstance(embeddings, torch.Tensor):
+		matrix_t = torch.as_tensor(matrix).to(device=embeddings.device, dtype=embeddings.dtype)
+		offset_t = torch.as_tensor(offset).to(device=embeddings.device, dtype=embeddings.dtype)
+		if matrix_t.dim() == 2:
+			return torch.matmul(embeddings, matrix_t) + offset_t
+		return torch.einsum('slm,lmn->sln', embeddings, matrix_t) + offset_t
+	matrix = matrix.astype(embeddings.dtype, copy=False) if np.issubdtype(embeddings.dtype, np.floating) else matrix
+	if matrix.ndim == 2:
+		results = np.matmul(embeddings, matrix)
+	else:
+		results = np.einsum('slm,lmn->sln', _as_layers_array(embeddings), matrix)
+	results += offset.astype(results.dtype, copy=False)
+	return results
+
+
+def _project_batched(embeddings: np.ndarray, mean: np.ndarray, projection: np.ndarray) -> np.ndarray:
+	"""
+	Projects the centered embeddings of every layer with the layer matrix, allocating only the result.
+	:param embeddings: The data, of dimensions [# samples, # layers, # features]
+	:param mean: The mean of each layer, of dimensions [# layers, # features]
+	:param projection: The matrix of each layer, of dimensions [# layers, # features, n]
+	:return: The projected data, of dimensions [# samples, # layers, n]
+	"""
+	results = np.einsum('slf,lfn->sln', embeddings, projection)
+	# (x - mean) @ P = x @ P - mean @ P
+	results -= np.einsum('lf,lfn->ln', mean, projection)
+	return results
+
 
 class BaseDimensionalityReducer(ABC):
 	"""
 	The Dimensionality Reducer takes a tensor with some features and reduces this number according to various criteria.
 	"""
 
+	# If True, the reducer processes the embeddings out of core (e.g. one chunk at a time, writing the results on disk):
+	# it's never fused with other reducers, even if it's affine
+	_out_of_core: bool = False
+
 	def __init__(self, from_m: int, to_n: int):
 		"""
 		Initializer for the reducer class.
@@ -40,7 +153,10 @@ class BaseDimensionalityReducer(ABC):
 			raise AttributeError("Cannot count last dimension of object with type: ", type(embeddings))
 
 	@staticmethod
-	def __prepare_input(embeddings: np.ndarray | torch.Tensor) -> np.ndarray | torch.Tensor:
+	def __prepare_input(embeddings: np.ndarray | torch.Tensor | str) -> np.ndarray | torch.Tensor:
+		if isinstance(embeddings, str):
+			# The path of a ".npy" file is memory-mapped, and read only when needed
+			embeddings = np.load(embeddings, mmap_mode='r')
 		if isinstance(embeddings, np.ndarray):
 			embeddings = np.squeeze(embeddings)
 		elif isinstance(embeddings, torch.Tensor):
@@ -67,17 +183,21 @@ class BaseDimensionalityReducer(ABC):
 		return embeddings
 	"""
 
-	def reduce(self, embeddings: np.ndarray | torch.Tensor) -> np.ndarray | torch.Tensor:
+	def reduce(self, embeddings: np.ndarray | torch.Tensor | str) -> np.ndarray | torch.Tensor:
 		"""
 		Applies the transformation of dimensions reduction, along the features' axis.
 		The features' axis will go from length M to length N.
-		:param embeddings: The input tensor, of dimensions [ d1, d2, ..., dk, M ]
+		:param embeddings: The input tensor, of dimensions [ d1, d2, ..., dk, M ], or the path of its ".npy" file
+		(which is memory-mapped)
 		:return: The output tensor, of dimensions [ d1, d2, ..., dk, N ]
 		"""
 		print(f"Reducing features from M = {self.m:3d} to N = {self.n:3d} with: ", type(self))
 		embeddings = self.__prepare_input(embeddings)
 		self.__check_input(embeddings)
-		results = self._reduction_transformation(embeddings)
+		if isinstance(embeddings, torch.Tensor):
+			results = self._tensor_reduction_transformation(embeddings)
+		else:
+			results = self._reduction_transformation(embeddings)
 		self.__check_output(results)
 		return results
 
@@ -85,6 +205,27 @@ class BaseDimensionalityReducer(ABC):
 	def _reduction_transformation(self, embeddings: np.ndarray) -> np.ndarray:
 		pass
 
+	def _tensor_reduction_transformation(self, embeddings: torch.Tensor) -> torch.Tensor:
+		"""
+		Applies the reduction to a PyTorch tensor, returning a tensor of the same dtype on the same device.
+		The affine reductions are computed directly in PyTorch. The other reductions, and the out-of-core ones (which
+		keep their chunked execution and their output file), are computed in NumPy: the tensor is shared with NumPy
+		without copies (if it's on CPU), and so is the result.
+		"""
+		parameters = self._affine_parameters() if not self._out_of_core else None
+		if parameters is not None:
+			return _apply_affine(embeddings, *parameters)
+		results = self._reduction_transformation(embeddings.detach().cpu().numpy())
+		return torch.from_numpy(np.asarray(results)).to(embeddings.device)
+
+	def _affine_parameters(self) -> tuple[np.ndarray, np.ndarray] | None:
+		"""
+		If the reduction is an affine transformation (x @ W + b), returns its parameters; otherwise, returns None.
+		The matrix W has dimensions [M, N] (shared by all the layers) or [# layers, M, N], and the offset b has
+		dimensions [N] or [# layers, N]. The affine reductions can be fused together (see: 'PipelineReducer').
+		"""
+		return None
+
 
 class SelectorReducer(BaseDimensionalityReducer):
 	"""
@@ -98,6 +239,11 @@ class SelectorReducer(BaseDimensionalityReducer):
 	def _reduction_transformation(self, embeddings: np.ndarray) -> np.ndarray:
 		return np.take_along_axis(embeddings, indices=self._selected_features, axis=-1)
 
+	def _affine_parameters(self) -> tuple[np.ndarray, np.ndarray] | None:
+		matrix = np.zeros(shape=(self.m, self.n))
+		matrix[self._selected_features, np.arange(self.n)] = 1.0
+		return matrix, np.zeros(shape=self.n)
+
 
 class MatrixReducer(BaseDimensionalityReducer):
 	"""
@@ -112,22 +258,45 @@ class MatrixReducer(BaseDimensionalityReducer):
 	def _reduction_transformation(self, embeddings: np.ndarray) -> np.ndarray:
 		return np.matmul(embeddings, self.__matrix)
 
+	def _affine_parameters(self) -> tuple[np.ndarray, np.ndarray] | None:
+		return self.__matrix, np.zeros(shape=self.n, dtype=self.__matrix.dtype)
+
+
+class AffineReducer(BaseDimensionalityReducer):
+	"""
+	The reduction of this class is an affine transformation: x @ W + b.
+	The matrix and the offset can be shared by all the layers, or be different for each layer.
+	"""
+
+	def __init__(self, matrix: np.ndarray, offset: np.ndarray):
+		"""
+		:param matrix: The matrix W, of dimensions [M, N] or [# layers, M, N].
+		:param offset: The offset b, of dimensions [N] or [# layers, N].
+		"""
+		from_m, to_n = matrix.shape[-2:]
+		super().__init__(from_m, to_n)
+		self.__matrix = matrix
+		self.__offset = offset
+
+	def _reduction_transformation(self, embeddings: np.ndarray) -> np.ndarray:
+		return _apply_affine(embeddings, self.__matrix, self.__offset)
+
+	def _affine_parameters(self) -> tuple[np.ndarray, np.ndarray] | None:
+		return self.__matrix, self.__offset
+
 
 class PCAReducer(BaseDimensionalityReducer):
 	"""
 	The reduction of this class is made with dynamic PCA.
 	The effect of PCA depends on the given input, and it has no memory of previous results.
 	For a "trained" PCA, please use 'TrainedPCAReducer'.
+	The PCA of all the layers is computed at once (see: "_fit_batched_pca").
 	"""
 
 	def _reduction_transformation(self, embeddings: np.ndarray) -> np.ndarray:
-		it = LayersIterator(embeddings)
-		results = np.zeros(shape=(it.num_samples, it.num_layers, self.n))
-		for layer_emb in it:
-			pca = PCA(n_components=self.n)
-			pca.fit(layer_emb)
-			results[:, it.current_layer_index] = pca.transform(layer_emb)
-		return results
+		embeddings = _as_layers_array(embeddings)
+		mean, components = _fit_batched_pca(embeddings, self.n)
+		return _project_batched(embeddings, mean, components)
 
 
 class TrainedPCAReducer(BaseDimensionalityReducer):
@@ -139,19 +308,87 @@ class TrainedPCAReducer(BaseDimensionalityReducer):
 
 	def __init__(self, train_x: np.ndarray | torch.Tensor, to_n: int):
 		super().__init__(self._count_features(train_x), to_n)
-		self.__pca_list: list[PCA] = []
-		for layer_emb in LayersIterator(train_x):
-			pca = PCA(n_components=self.n)
-			pca.fit(layer_emb)
-			self.__pca_list.append(pca)
+		# The mean [# layers, # features] and the components [# layers, # features, n] of each layer
+		self._mean, self._components = _fit_batched_pca(_as_layers_array(train_x), self.n)
 
 	def _reduction_transformation(self, embeddings: np.ndarray) -> np.ndarray:
-		it = LayersIterator(embeddings)
-		results = np.zeros(shape=(it.num_samples, it.num_layers, self.n))
-		for pca, layer_emb in zip(self.__pca_list, it):
-			results[:, it.current_layer_index] = pca.transform(layer_emb)
+		embeddings = _as_layers_array(embeddings)
+		return _project_batched(embeddings, self._mean.astype(embeddings.dtype, copy=False),
+		                        self._components.astype(embeddings.dtype, copy=False))
+
+	def _affine_parameters(self) -> tuple[np.ndarray, np.ndarray] | None:
+		return self._components, -np.einsum('lf,lfn->ln', self._mean, self._components)
+
+
+class IncrementalPCAReducer(BaseDimensionalityReducer):
+	"""
+	The reduction of this class is made with PCA, trained incrementally on chunks of samples.
+	Unlike 'TrainedPCAReducer', the training set and the embeddings to reduce can be memory-mapped arrays (or the paths
+	of ".npy" files) larger than the memory: they're read one chunk at a time. If an output path is given, the reduced
+	embeddings are written in a memory-mapped ".npy" file, one chunk at a time.
+	"""
+
+	# The number of samples of each chunk
+	chunk_size: int = 4096
+	_out_of_core: bool = True
+
+	def __init__(self, train_x: np.ndarray | str, to_n: int, output_path: str | None = None):
+		"""
+		:param train_x: The training embeddings [# samples, # layers, # features], or the path of their ".npy" file.
+		:param to_n: The number of components.
+		:param output_path: The path of the ".npy" file where the reduced embeddings are written, or None to keep them
+		in memory.
+		"""
+		if isinstance(train_x, str):
+			train_x = np.load(train_x, mmap_mode='r')
+		super().__init__(self._count_features(train_x), to_n)
+		self.__output_path = output_path
+
+		train_x = _as_layers_array(train_x, to_floating=False)
+		dtype: np.dtype = _floating_dtype(train_x.dtype)
+		pca_list: list[IncrementalPCA] = [IncrementalPCA(n_components=self.n) for _ in range(train_x.shape[1])]
+		for chunk in self.__iter_chunks(train_x):
+			for layer, pca in enumerate(pca_list):
+				pca.partial_fit(chunk[:, layer])
+		# The mean [# layers, # features] and the components [# layers, # features, n] of each layer
+		self._mean = np.asarray([pca.mean_ for pca in pca_list], dtype=dtype)
+		self._components = np.ascontiguousarray(np.swapaxes([pca.components_ for pca in pca_list], 1, 2), dtype=dtype)
+
+	def __iter_chunks(self, embeddings: np.ndarray):
+		"""
+		Iterates over the chunks of the embeddings, loading one chunk at a time in memory.
+		Every chunk has at least "n" samples (if possible), as required by the incremental PCA.
+		The chunks of non-floating embeddings are converted to 64-bit floats, one at a time.
+		"""
+		chunk_size: int = max(self.chunk_size, self.n)
+		bounds: list[int] = list(range(0, len(embeddings), chunk_size)) + [len(embeddings)]
+		if len(bounds) > 2 and bounds[-1] - bounds[-2] < self.n:
+			# The last chunk is merged with the previous one
+			del bounds[-2]
+		for start, end in zip(bounds[:-1], bounds[1:]):
+			yield np.asarray(embeddings[start:end]).astype(_floating_dtype(embeddings.dtype), copy=False)
+
+	def _reduction_transformation(self, embeddings: np.ndarray) -> np.ndarray:
+		embeddings = _as_layers_array(embeddings, to_floating=False)
+		dtype: np.dtype = _floating_dtype(embeddings.dtype)
+		shape: tuple[int, int, int] = (len(embeddings), embeddings.shape[1], self.n)
+		if self.__output_path is not None:
+			results = open_memmap(self.__output_path, mode='w+', dtype=dtype, shape=shape)
+		else:
+			results = np.empty(shape=shape, dtype=dtype)
+		mean = self._mean.astype(dtype, copy=False)
+		components = self._components.astype(dtype, copy=False)
+		start: int = 0
+		for chunk in self.__iter_chunks(embeddings):
+			results[start:start + len(chunk)] = _project_batched(chunk, mean, components)
+			start += len(chunk)
+		if isinstance(results, np.memmap):
+			results.flush()
 		return results
 
+	def _affine_parameters(self) -> tuple[np.ndarray, np.ndarray] | None:
+		return self._components, -np.einsum('lf,lfn->ln', self._mean, self._components)
+
 
 class GenderClassifierReducer(BaseDimensionalityReducer):
 	"""
@@ -168,7 +405,7 @@ class GenderClassifierReducer(BaseDimensionalityReducer):
 		self.__selected_features: list[np.ndarray] = []
 		# Select the n most important features FOR EACH LAYER
 		# (assuming n is less than the classifier features dimension)
-		for (indices, _) in classifier.get_most_important_features(cut_zeros=False):
+		for (indices, _) in classifier.get_most_important_features(cut_zeros=False, top_k=self.n):
 			self.__selected_features.append(indices[:self.n])
 
 	def _reduction_transformation(self, embeddings: np.ndarray) -> np.ndarray:
@@ -178,11 +415,22 @@ class GenderClassifierReducer(BaseDimensionalityReducer):
 			results[:, it.current_layer_index] = layer_emb[:, indices]
 		return results
 
+	def _affine_parameters(self) -> tuple[np.ndarray, np.ndarray] | None:
+		num_layers: int = len(self.__selected_features)
+		matrix = np.zeros(shape=(num_layers, self.m, self.n))
+		for layer, indices in enumerate(self.__selected_features):
+			matrix[layer, indices, np.arange(self.n)] = 1.0
+		return matrix, np.zeros(shape=(num_layers, self.n))
+
 
 class PipelineReducer(BaseDimensionalityReducer):
 	"""
 	This reducer aggregates multiple sub-reducers.
 	The reducers must be given in the correct order, with compatible sizes.
+
+	The consecutive affine reducers (e.g. features selection, matrices and trained PCA) are composed when the pipeline
+	is created: each chain is executed as a single 'AffineReducer', without materializing the intermediate arrays.
+	The out-of-core reducers (e.g. 'IncrementalPCAReducer') are never fused, so that they keep their chunked execution.
 	"""
 
 	def __init__(self, reducers: list[BaseDimensionalityReducer]):
@@ -190,13 +438,53 @@ class PipelineReducer(BaseDimensionalityReducer):
 			assert reducers[i-1].n == reducers[i].m
 		self.__reducers = reducers
 		super().__init__(from_m=reducers[0].m, to_n=reducers[-1].n)
+		self.__stages: list[BaseDimensionalityReducer] = self.__fuse_affine_chains(reducers)
 
-	def _reduction_transformation(self, embeddings: np.ndarray) -> np.ndarray:
-		results: np.ndarray = embeddings
-		for red in self.__reducers:
+	@staticmethod
+	def __fuse_affine_chains(reducers: list[BaseDimensionalityReducer]) -> list[BaseDimensionalityReducer]:
+		"""
+		Replaces every chain of (two or more) consecutive affine reducers with a single affine reducer.
+		The composition of x @ W1 + b1 and x @ W2 + b2 is: x @ (W1 @ W2) + (b1 @ W2 + b2).
+		"""
+		stages: list[BaseDimensionalityReducer] = []
+		chain: list[tuple[BaseDimensionalityReducer, tuple[np.ndarray, np.ndarray]]] = []
+
+		def close_chain() -> None:
+			if len(chain) == 1:
+				stages.append(chain[0][0])
+			elif len(chain) > 1:
+				matrix, offset = chain[0][1]
+				for _, (next_matrix, next_offset) in chain[1:]:
+					offset = np.matmul(offset[..., np.newaxis, :], next_matrix)[..., 0, :] + next_offset
+					matrix = np.matmul(matrix, next_matrix)
+				stages.append(AffineReducer(matrix, offset))
+			chain.clear()
+
+		for red in reducers:
+			parameters = red._affine_parameters() if not red._out_of_core else None
+			if parameters is None:
+				close_chain()
+				stages.append(red)
+			else:
+				chain.append((red, parameters))
+		close_chain()
+		return stages
+
+	def _reduction_transformation(self, embeddings: np.ndarray | torch.Tensor) -> np.ndarray | torch.Tensor:
+		results: np.ndarray | torch.Tensor = embeddings
+		for red in self.__stages:
 			print("\t> ", end='')
 			results = red.reduce(results)
 		return results
 
+	def _tensor_reduction_transformation(self, embeddings: torch.Tensor) -> torch.Tensor:
+		# Every stage receives (and returns) a tensor
+		return self._reduction_transformation(embeddings)
+
+	def _affine_parameters(self) -> tuple[np.ndarray, np.ndarray] | None:
+		if len(self.__stages) == 1:
+			return self.__stages[0]._affine_parameters()
+		return None
+
 
 
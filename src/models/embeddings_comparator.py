@@ -33,6 +33,10 @@ class Metric:
 	 `[# dim0, # dim2, # dim2, ..., # dimN]`
 	(Supposing the evaluating functions reduces only the last dimension.
 	If the programmer wants to implement something different, is their responsibility to make things work).
+
+	A metric can also be evaluated from the Gram matrix of its embeddings (i.e. the inner products between every
+	pair of them), without the embeddings themselves: see "evaluate_from_gram". This is used by the compiled mode of
+	the :class:`EmbeddingsComparator`, where the Gram matrix is computed once and shared by all the metrics.
 	"""
 
 	def __init__(self, name: str, computational_function: Callable[[list[Tensor]], Tensor], ids: list[str]):
@@ -61,6 +65,27 @@ class Metric:
 		args = self.__get_args(embeddings)
 		return self.__fun(args)
 
+	@property
+	def ids(self) -> list[str]:
+		return self.__ids
+
+	@property
+	def has_gram_form(self) -> bool:
+		"""
+		:return: True if the metric can be evaluated from the Gram matrix (i.e. the subclass implements
+		"evaluate_from_gram").
+		"""
+		return type(self).evaluate_from_gram is not Metric.evaluate_from_gram
+
+	def evaluate_from_gram(self, gram: Tensor) -> Tensor:
+		"""
+		Evaluates the metric from the Gram matrix of the required embeddings.
+		:param gram: The inner products between the embeddings of the metric ids (in the same order of the ids), of
+		dimensions [# words, # ids, # ids, # layers].
+		:return: The evaluated tensor of the metric, of dimensions [# words, # layers].
+		"""
+		raise NotImplementedError(f"The metric {self} cannot be evaluated from the Gram matrix.")
+
 	def __str__(self) -> str:
 		"""
 		Returns a string describing the metric.
@@ -103,6 +128,31 @@ def cos_simil(x: Tensor, y: Tensor) -> Tensor:
 	return torch.nn.CosineSimilarity(dim=-1)(x, y)
 
 
+def gram_eucl_dist(gram: Tensor, i: int, j: int) -> Tensor:
+	"""
+	Computes the euclidean distance between two vectors from their Gram matrix: ||x - y||^2 = <x,x> + <y,y> - 2 <x,y>
+	:param gram: The Gram matrix, of dimensions [..., # vectors, # vectors, # layers]
+	:param i: The index of the first vector
+	:param j: The index of the second vector
+	:return: The euclidean distance measure, of dimensions [..., # layers]
+	"""
+	squared = gram[..., i, i, :] + gram[..., j, j, :] - 2 * gram[..., i, j, :]
+	return squared.clamp(min=0).sqrt()
+
+
+def gram_cos_simil(gram: Tensor, i: int, j: int) -> Tensor:
+	"""
+	Computes the cosine similarity between two vectors from their Gram matrix: <x,y> / sqrt(<x,x> <y,y>)
+	:param gram: The Gram matrix, of dimensions [..., # vectors, # vectors, # layers]
+	:param i: The index of the first vector
+	:param j: The index of the second vector
+	:return: The cosine similarity measure, of dimensions [..., # layers]
+	"""
+	# As in "torch.nn.CosineSimilarity", the norms are bounded by a small epsilon
+	norms = gram[..., i, i, :].sqrt().clamp(min=1e-8) * gram[..., j, j, :].sqrt().clamp(min=1e-8)
+	return gram[..., i, j, :] / norms
+
+
 class PairEuclideanDistance(Metric):
 	"""
 	Computes the euclidean distance between two vectors.
@@ -113,6 +163,9 @@ class PairEuclideanDistance(Metric):
 		                 computational_function=lambda embs: eucl_dist(embs[0], embs[1]),
 		                 ids=[id0, id1])
 
+	def evaluate_from_gram(self, gram: Tensor) -> Tensor:
+		return gram_eucl_dist(gram, 0, 1)
+
 
 class TripleEuclideanDistance(Metric):
 	"""
@@ -126,6 +179,9 @@ class TripleEuclideanDistance(Metric):
 		                 eucl_dist(embs[0], embs[1]) + eucl_dist(embs[1], embs[2]) + eucl_dist(embs[2], embs[0]),
 		                 ids=[id0, id1, id2])
 
+	def evaluate_from_gram(self, gram: Tensor) -> Tensor:
+		return gram_eucl_dist(gram, 0, 1) + gram_eucl_dist(gram, 1, 2) + gram_eucl_dist(gram, 2, 0)
+
 
 class EuclideanCenterDistance(Metric):
 	"""
@@ -140,6 +196,12 @@ class EuclideanCenterDistance(Metric):
 		                 computational_function=eucl_center_dist,
 		                 ids=list(ids))
 
+	def evaluate_from_gram(self, gram: Tensor) -> Tensor:
+		# With the center c = mean(x_j): ||x_i - c||^2 = <x_i,x_i> - 2 mean_j(<x_i,x_j>) + mean_jk(<x_j,x_k>)
+		squared_norms = torch.diagonal(gram, dim1=-3, dim2=-2)
+		squared = squared_norms - 2 * gram.mean(dim=-2).movedim(-2, -1) + gram.mean(dim=(-3, -2)).unsqueeze(-1)
+		return squared.clamp(min=0).sqrt().sum(dim=-1)
+
 
 class PairCosineSimilarity(Metric):
 	"""
@@ -151,6 +213,9 @@ class PairCosineSimilarity(Metric):
 		                 computational_function=lambda embs: cos_simil(embs[0], embs[1]),
 		                 ids=[id0, id1])
 
+	def evaluate_from_gram(self, gram: Tensor) -> Tensor:
+		return gram_cos_simil(gram, 0, 1)
+
 
 class TripleCosineSimilarity(Metric):
 	"""
@@ -166,6 +231,9 @@ class TripleCosineSimilarity(Metric):
 		                           cos_simil(embs[2], embs[0])),
 		                 ids=[id0, id1, id2])
 
+	def evaluate_from_gram(self, gram: Tensor) -> Tensor:
+		return gram_cos_simil(gram, 0, 1) * gram_cos_simil(gram, 1, 2) * gram_cos_simil(gram, 2, 0)
+
 
 class EmbeddingsComparator:
 	"""
@@ -239,3 +307,40 @@ class EmbeddingsComparator:
 			assert len(merged_embeddings[key].size()) == 2
 		# Computing and returning metrics
 		return [metric(merged_embeddings) for metric in self.__metrics]
+
+	def evaluate_compiled(self, embeddings: dict[str, dict[str, list[Tensor]]]) -> Tensor:
+		"""
+		Computes all the metrics for many words at once (compiled mode).
+		The merged embeddings of all the words are stacked in a tensor of dimensions [# words, # ids, # layers, # features],
+		and the inner products between every pair of ids are computed once (in double precision), for each word and
+		layer. Then, every metric is derived from this Gram tensor (see: "Metric.evaluate_from_gram"), without
+		computing again the distances shared by different metrics. The metrics without a Gram form are evaluated on
+		the stacked embeddings of all the words, with their computational function.
+		:param embeddings: A dictionary associating each word with its embeddings dictionary, as in "__call__".
+		:return: The metrics evaluations, of dimensions [# words, # metrics, # layers], with the same dtype of the
+		embeddings. The words follow the order of the dictionary, the metrics follow the order of insertion.
+		"""
+		# The ids required by the metrics, in order of appearance
+		ids: list[str] = list(dict.fromkeys(i for metric in self.__metrics for i in metric.ids))
+		ids_positions: dict[str, int] = {i: pos for pos, i in enumerate(ids)}
+
+		# Merging embeddings lists: [# words, # ids, # layers, # features]
+		stacked: Tensor = torch.stack([
+			torch.stack([self.__merge_function(word_embs[i]) for i in ids])
+			for word_embs in embeddings.values()])
+		assert len(stacked.size()) == 4
+		stacked = stacked.detach()
+		# Gram tensor: [# words, # ids, # ids, # layers]
+		precise = stacked.double()
+		gram: Tensor = torch.einsum('wilf,wjlf->wijl', precise, precise)
+
+		results: list[Tensor] = []
+		for metric in self.__metrics:
+			if metric.has_gram_form:
+				positions = torch.tensor([ids_positions[i] for i in metric.ids])
+				metric_gram = gram.index_select(1, positions).index_select(2, positions)
+				results.append(metric.evaluate_from_gram(metric_gram).to(stacked.dtype))
+			else:
+				# Every id is associated with the embeddings of all the words: [# words, # layers, # features]
+				results.append(metric({i: stacked[:, ids_positions[i]] for i in metric.ids}).to(stacked.dtype))
+		return torch.stack(results, dim=1)
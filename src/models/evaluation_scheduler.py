@@ -0,0 +1,184 @@
+#########################################################################
+#                            Dusi's Thesis                              #
+# Algorithmic Discrimination and Natural Language Processing Techniques #
+#########################################################################
+
+# This class schedules the evaluation of many metrics over many checkpoints of the same model.
+# The evaluation is "checkpoint-major": every checkpoint is loaded once, all the metrics are computed on it,
+# and then it's removed from memory before loading the next one.
+
+import gc
+from abc import ABC, abstractmethod
+from typing import Any
+
+import numpy as np
+import torch
+from transformers import PreTrainedTokenizerBase
+
+import settings
+from src.experiments.mlm_gender_prediction import prepare_template_sentences
+from src.models.gender_enum import Gender
+from src.models.masked_lm_scorer import EncodedSentences, MaskedLMScorer
+from src.models.templates import TemplatesGroup
+from src.models.trained_model_factory import _AbstractTrainedModelFactory
+from src.models.word_encoder import WordEncoder
+
+
+class Checkpoint:
+	"""
+	A checkpoint of a model, as it's retrieved by a factory: the base model, or a model fine-tuned on some texts.
+	"""
+
+	def __init__(self, name: str, load_or_save_path: str | None = None, fine_tuning_text: list[str] | None = None):
+		"""
+		:param name: The name of the checkpoint, used as a key for the results.
+		:param load_or_save_path: The path of the saved model, to save or to load.
+		:param fine_tuning_text: The texts on which the model should be trained, if it's not found locally.
+		"""
+		self.name = name
+		self.load_or_save_path = load_or_save_path
+		self.fine_tuning_text = fine_tuning_text
+
+
+class _AbstractEvaluationJob(ABC):
+	"""
+	A metric computed on every checkpoint.
+	The inputs depending only on the tokenizer are prepared once, before the first checkpoint is loaded.
+	"""
+
+	def __init__(self, name: str):
+		self.name = name
+
+	def prepare(self, tokenizer: PreTrainedTokenizerBase) -> None:
+		"""
+		Prepares the inputs shared by all the checkpoints (e.g. the tokenized sentences).
+		:param tokenizer: The tokenizer shared by all the checkpoints.
+		:return: None
+		"""
+		pass
+
+	@abstractmethod
+	def run(self, model, tokenizer: PreTrainedTokenizerBase) -> Any:
+		"""
+		Computes the metric for a single checkpoint.
+		:param model: The model of the current checkpoint.
+		:param tokenizer: The tokenizer shared by all the checkpoints.
+		:return: The result of the metric.
+		"""
+		raise NotImplementedError("Cannot run a '_AbstractEvaluationJob' object directly. Please use a child class.")
+
+
+class FillMaskScoresJob(_AbstractEvaluationJob):
+	"""
+	Computes the scores of the "fill-mask" task, as in "mlm_gender_prediction.compute_scores".
+	The result is a numpy array of shape: [# templates, # occupations, # target words]
+	"""
+
+	def __init__(self, name: str, templates_group: TemplatesGroup, occupations: list[str], occ_token: str):
+		super().__init__(name)
+		self.__templates_group = templates_group
+		self.__targets: list[str] = templates_group.targets
+		self.__occupations = occupations
+		self.__sentences: list[str] = prepare_template_sentences(templates_group, occupations, occ_token)
+		self.__encoded: EncodedSentences | None = None
+
+	@property
+	def targets(self) -> list[str]:
+		return self.__targets
+
+	def prepare(self, tokenizer: PreTrainedTokenizerBase) -> None:
+		self.__encoded = EncodedSentences(tokenizer, self.__sentences)
+
+	def run(self, model, tokenizer: PreTrainedTokenizerBase) -> np.ndarray:
+		scores = MaskedLMScorer(model=model, tokenizer=tokenizer).score_targets(self.__encoded, targets=self.__targets)
+		return scores.reshape((len(self.__templates_group.templates), len(self.__occupations), len(self.__targets)))
+
+
+class PseudoLogLikelihoodJob(_AbstractEvaluationJob):
+	"""
+	Computes the pseudo-log-likelihood of a list of sentences.
+	The result is the pair (tokens log-probabilities, sentences PLL) of "MaskedLMScorer.pseudo_log_likelihoods".
+	"""
+
+	def __init__(self, name: str, sentences: list[str]):
+		super().__init__(name)
+		self.__sentences = sentences
+		self.__encoded: EncodedSentences | None = None
+
+	def prepare(self, tokenizer: PreTrainedTokenizerBase) -> None:
+		self.__encoded = EncodedSentences(tokenizer, self.__sentences)
+
+	def run(self, model, tokenizer: PreTrainedTokenizerBase) -> tuple[list[np.ndarray], np.ndarray]:
+		return MaskedLMScorer(model=model, tokenizer=tokenizer).pseudo_log_likelihoods(self.__encoded)
+
+
+class ProbeEmbeddingsJob(_AbstractEvaluationJob):
+	"""
+	Computes the embeddings of some words (merged over their tokens, as in "WordEncoder.embed_word_merged"), used to
+	train or evaluate the gender probes.
+	As in "embeddings_gender_subspace_detection.get_labeled_dataset", the words can be a list or a dictionary with
+	the genders as keys. The result is the pair (embeddings, genders), where the genders are None for a list.
+	"""
+
+	def __init__(self, name: str, data: dict[Gender, list[str]] | list[str], layers: list[int] | range):
+		super().__init__(name)
+		self.__layers = layers
+		if isinstance(data, list):
+			self.__words: list[str] = data
+			self.__genders: list[Gender] | None = None
+		elif isinstance(data, dict):
+			self.__words = [w for words in data.values() for w in words]
+			self.__genders = [gend for gend, words in data.items() for _ in words]
+		else:
+			raise AttributeError(f"Cannot convert data of type {type(data)} to a proper dataset")
+
+	def run(self, model, tokenizer: PreTrainedTokenizerBase) -> tuple[np.ndarray, list[Gender] | None]:
+		encoder = WordEncoder(tokenizer=tokenizer, model=model)
+		with torch.no_grad():
+			embeddings = [encoder.embed_word_merged(w, layers=self.__layers).cpu().numpy() for w in self.__words]
+		return np.asarray(embeddings), self.__genders
+
+
+class CheckpointEvaluationScheduler:
+	"""
+	This class evaluates a list of jobs over a list of checkpoints.
+	The shared inputs of the jobs are prepared once for all the checkpoints. Then, every checkpoint is retrieved from
+	the factory exactly once (trained if necessary), all the jobs are run on it, and the checkpoint is evicted from
+	memory before moving to the next one.
+	"""
+
+	def __init__(self, factory: _AbstractTrainedModelFactory, checkpoints: list[Checkpoint],
+	             jobs: list[_AbstractEvaluationJob], device: torch.device = settings.pt_device):
+		self.__factory = factory
+		self.__checkpoints = checkpoints
+		self.__jobs = jobs
+		self.__device = device
+
+	def run(self) -> dict[str, dict[str, Any]]:
+		"""
+		Runs all the jobs on all the checkpoints.
+		:return: A dictionary with the jobs names as keys; each value is a dictionary associating the checkpoints names
+		with the result of the job for that checkpoint.
+		"""
+		tokenizer = self.__factory.tokenizer
+		print("Preparing the inputs of the evaluation jobs...", end="")
+		for job in self.__jobs:
+			job.prepare(tokenizer)
+		print("Completed.")
+
+		results: dict[str, dict[str, Any]] = {job.name: {} for job in self.__jobs}
+		for checkpoint in self.__checkpoints:
+			print(f"Evaluating checkpoint: {checkpoint.name}")
+			model = self.__factory.get_model(fine_tuning_text=checkpoint.fine_tuning_text,
+			                                 load_or_save_path=checkpoint.load_or_save_path)
+			model.to(self.__device).eval()
+			for job in self.__jobs:
+				print(f"\tRunning job: {job.name}")
+				results[job.name][checkpoint.name] = job.run(model, tokenizer)
+
+			# Evicting the checkpoint before loading the next one
+			del model
+			gc.collect()
+			if torch.cuda.is_available():
+				torch.cuda.empty_cache()
+		return results
@@ -7,12 +7,19 @@
 # For the sake of simplicity and analysis, we'll consider only male and female genders, which
 # is not a socially correct assumption.
 
+import os
 from abc import abstractmethod, ABC
 from enum import IntEnum
 
 import numpy as np
+import torch
+from joblib import Parallel, delayed
 from sklearn import svm
+from sklearn.model_selection import StratifiedKFold
 from sklearn.tree import DecisionTreeClassifier
+from threadpoolctl import threadpool_limits
+
+import settings
 
 
 class _AbstractGenderClassifier(ABC):
@@ -20,10 +27,25 @@ class _AbstractGenderClassifier(ABC):
 	A generic classifier for embeddings, that detects gender (or, if desired, other classes).
 	Cannot be instanced directly, but requires a subclass to work properly.
 	The subclass must specify the type of classifier that work on each level.
+
+	The classifiers of the different layers are independent: they're trained (and used) in parallel by a pool of
+	threads. The BLAS threads of each job are limited, so that the total number of threads does not exceed the CPUs.
 	"""
 
+	# The number of layers processed in parallel; if None, it's the number of layers (up to the number of CPUs)
+	n_jobs: int | None = None
+	# The inverse of the regularization strength, as the "C" parameter of Scikit-Learn (if the classifier supports it)
+	regularization_parameter: float = 1.0
+	# If True, the regularization path is computed separately for each layer (see: "search_regularization")
+	_regularization_path_per_layer: bool = True
+	# If True, the features of each layer are standardized with the mean and the standard deviation of the training
+	# data, both in the training and in the regularization search; the inputs of the predictions are then standardized
+	# in the same way, so that the public methods still take (and return values relative to) the raw embeddings
+	standardize: bool = False
+
 	def __init__(self, name: str, training_embeddings: np.ndarray, training_genders: list[IntEnum] | list[int] | np.ndarray,
-	             layers_labels: list[str] = None, print_summary: bool = False) -> None:
+	             layers_labels: list[str] = None, print_summary: bool = False,
+	             regularization: float | np.ndarray | None = None) -> None:
 		"""
 		Creates an embedding classifier that detects the gender.
 
@@ -33,6 +55,9 @@ class _AbstractGenderClassifier(ABC):
 		:param layers_labels: The list of names for the considered layers, if these do not correspond to the standard
 		indices from 0 to N-1.
 		:param print_summary: If True, prints a brief summary of dimensions.
+		:param regularization: The regularization parameter ("C") of the inner classifiers, as a single value or as a
+		value for each layer [# layers] (e.g. the result of "search_regularization"). If None, the class default
+		("regularization_parameter") is used.
 		"""
 		self.name = name
 		self.__num_features: int
@@ -45,34 +70,220 @@ class _AbstractGenderClassifier(ABC):
 			print("Number of layers: ", num_layers)
 			print("Number of features: ", self.__num_features)
 
+		# The regularization parameter of each layer: [# layers]
+		if regularization is None:
+			regularization = self.regularization_parameter
+		self._regularization: np.ndarray = np.array(np.broadcast_to(np.asarray(regularization, dtype=np.float64),
+		                                                            (num_layers,)))
+
+		# The standardization statistics of each layer: [# layers, # features]
+		self._mean: np.ndarray | None = None
+		self._std: np.ndarray | None = None
+		if self.standardize:
+			self._mean, self._std = _standardization_statistics(training_embeddings)
+			training_embeddings = self._standardized(training_embeddings)
+
 		# Training a classifier for each layer
-		self._classifiers: list = []
-		for layer in range(num_layers):
-			clf = self._instance_new_classifier()
-			train_x = training_embeddings[:, layer]
-			clf.fit(train_x, training_genders)
-			self._classifiers.append(clf)
+		self._classifiers: list = self._fit(training_embeddings, np.asarray(training_genders))
 		assert self.num_layers == num_layers
 		# Layers labels
 		self.__layers_labels = layers_labels
 		if self.__layers_labels is not None:
 			assert len(self.__layers_labels) == self.num_layers
+		self._on_fitted()
 
 	def __str__(self) -> str:
 		return f"Model '{self.name}' with {self.num_layers} classifiers of type {type(self._instance_new_classifier())}"
 
 	@property
 	def classifiers(self) -> list:
+		"""
+		:return: The inner classifiers, one for each layer. If the classifier standardizes the embeddings (see:
+		"standardize"), the inner classifiers work on the standardized features.
+		"""
 		return self._classifiers.copy()
 
 	@property
 	def num_layers(self) -> int:
 		return len(self._classifiers)
 
+	@property
+	def standardization(self) -> tuple[np.ndarray, np.ndarray] | None:
+		"""
+		:return: The mean and the standard deviation of the training features, of dimensions [# layers, # features],
+		or None if the classifier does not standardize the embeddings.
+		"""
+		return (self._mean, self._std) if self._mean is not None else None
+
+	def _standardized(self, embeddings: np.ndarray) -> np.ndarray:
+		"""
+		Standardizes the embeddings [# samples, # layers, # features] with the statistics of the training data, if
+		the classifier standardizes them. Otherwise, returns the embeddings as they are.
+		"""
+		if self._mean is None:
+			return embeddings
+		return (np.asarray(embeddings, dtype=np.float64) - self._mean) / self._std
+
+	@property
+	def regularization(self) -> np.ndarray:
+		"""
+		:return: The regularization parameter ("C") of each layer, of dimensions [# layers].
+		"""
+		return self._regularization
+
 	@abstractmethod
 	def _instance_new_classifier(self):
 		raise NotImplementedError("Cannot instance directly a '_GenderClassifier' object. Please use a child class.")
 
+	def _instance_layer_classifier(self, layer: int):
+		"""
+		Instances a new classifier for the given layer.
+		By default, it's the classifier of "_instance_new_classifier"; the classes supporting the regularization search
+		override it to apply the regularization parameter of the layer.
+		"""
+		return self._instance_new_classifier()
+
+	def _on_fitted(self) -> None:
+		"""
+		Called once, after all the inner classifiers have been trained.
+		The subclasses can override it to precompute the arrays derived from the classifiers.
+		"""
+		pass
+
+	def _fit(self, training_embeddings: np.ndarray, training_genders: np.ndarray) -> list:
+		"""
+		Trains the inner classifiers, one for each layer.
+		By default, a new classifier (see: "_instance_layer_classifier") is trained on each layer, in parallel.
+		The subclasses can override this method to train all the layers together.
+
+		:param training_embeddings: The training data, of dimensions: [# samples, # layers, # features]
+		:param training_genders: The training labels, of dimensions: [# samples]
+		:return: The list of the trained classifiers, one for each layer.
+		"""
+		return self._run_on_layers(
+			lambda layer: self.__fit_classifier(layer, training_embeddings[:, layer], training_genders),
+			training_embeddings.shape[1])
+
+	@classmethod
+	def _instance_regularized_classifier(cls, regularization: float):
+		"""
+		Instances a new classifier for a single layer, with the given regularization parameter.
+		The classes supporting the regularization search must override this method (or "_fit_regularization_path").
+		"""
+		raise AttributeError(f"The classifier {cls.__name__} has no regularization parameter.")
+
+	@classmethod
+	def _fit_regularization_path(cls, train_x: np.ndarray, train_y: np.ndarray, valid_x: np.ndarray,
+	                             valid_y: np.ndarray, regularization_values: np.ndarray) -> np.ndarray:
+		"""
+		Trains the classifiers of some layers for increasing values of the regularization parameter, and validates them.
+		If the classifier has a "warm_start" parameter, the same classifier is refitted along the path, starting each
+		time from the previous solution. The linear SVC and the logistic regression override this method, to train the
+		probes of all the layers together with warm starts.
+
+		:param train_x: The training data, of dimensions [# samples, # layers, # features]
+		:param train_y: The training labels, of dimensions [# samples]
+		:param valid_x: The validation data, of dimensions [# samples, # layers, # features]
+		:param valid_y: The validation labels, of dimensions [# samples]
+		:param regularization_values: The increasing values of the regularization parameter.
+		:return: The validation accuracies, of dimensions [# values, # layers]
+		"""
+		accuracies = np.zeros(shape=(len(regularization_values), train_x.shape[1]))
+		for layer in range(train_x.shape[1]):
+			clf = cls._instance_regularized_classifier(regularization_values[0])
+			warm_start: bool = 'warm_start' in clf.get_params()
+			if warm_start:
+				clf.set_params(warm_start=True)
+			for i, value in enumerate(regularization_values):
+				if not warm_start:
+					clf = cls._instance_regularized_classifier(value)
+				else:
+					clf.set_params(C=value)
+				clf.fit(train_x[:, layer], train_y)
+				accuracies[i, layer] = clf.score(valid_x[:, layer], valid_y)
+		return accuracies
+
+	@classmethod
+	def search_regularization(cls, embeddings: np.ndarray, genders: list[IntEnum] | list[int] | np.ndarray,
+	                          regularization_values: list[float], num_folds: int = 5) -> tuple[np.ndarray, np.ndarray]:
+		"""
+		Searches the best regularization parameter for each layer, with a stratified k-fold cross-validation.
+
+		If the classifier standardizes the embeddings (see: "standardize"), as in the final fit, each fold is
+		standardized with the statistics of its training data, computed once and shared by all the layers and all the
+		values. Then, for each fold (and for each layer, if the classifiers are independent), the classifiers are
+		trained along the regularization path with warm starts, if possible. The folds and the layers are processed
+		in parallel.
+
+		:param embeddings: The data, of dimensions [# samples, # layers, # features]
+		:param genders: The labels, of dimensions [# samples]
+		:param regularization_values: The candidate values of the regularization parameter ("C").
+		:param num_folds: The number of folds of the cross-validation.
+		:return: The best value for each layer [# layers], and the mean validation accuracies of every value
+		(in the given order) for each layer [# values, # layers]. The best values can be given to the classifier as its
+		"regularization" parameter.
+		"""
+		x = np.asarray(embeddings, dtype=np.float64)
+		y = np.asarray(genders)
+		num_layers: int = x.shape[1]
+		values = np.asarray(regularization_values, dtype=np.float64)
+		# The path goes from the strongest to the weakest regularization
+		path_order = np.argsort(values, kind='stable')
+
+		folds = []
+		splitter = StratifiedKFold(n_splits=num_folds, shuffle=True, random_state=settings.RANDOM_SEED)
+		for train_indices, valid_indices in splitter.split(np.zeros(len(y)), y):
+			train_x, valid_x = x[train_indices], x[valid_indices]
+			if cls.standardize:
+				mean, std = _standardization_statistics(train_x)
+				train_x, valid_x = (train_x - mean) / std, (valid_x - mean) / std
+			folds.append((train_x, y[train_indices], valid_x, y[valid_indices]))
+
+		layers_groups: list[slice] = [slice(layer, layer + 1) for layer in range(num_layers)] \
+			if cls._regularization_path_per_layer else [slice(0, num_layers)]
+		tasks = [(fold, group) for fold in range(len(folds)) for group in layers_groups]
+
+		def run_task(fold: int, group: slice) -> np.ndarray:
+			train_x, train_y, valid_x, valid_y = folds[fold]
+			return cls._fit_regularization_path(train_x[:, group], train_y, valid_x[:, group], valid_y,
+			                                    values[path_order])
+
+		n_jobs: int = cls.n_jobs if cls.n_jobs is not None else min(len(tasks), os.cpu_count())
+		n_jobs = max(1, n_jobs)
+		with threadpool_limits(limits=max(1, os.cpu_count() // n_jobs)):
+			results = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(run_task)(fold, group) for fold, group in tasks)
+
+		# Averaging the accuracies of the folds: [# values, # layers]
+		accuracies = np.zeros(shape=(len(folds), len(values), num_layers))
+		for (fold, group), fold_accuracies in zip(tasks, results):
+			accuracies[fold, :, group] = fold_accuracies
+		curves = np.empty(shape=(len(values), num_layers))
+		curves[path_order] = np.mean(accuracies, axis=0)
+		# In case of ties, the strongest regularization is preferred
+		best_values = values[path_order][np.argmax(np.mean(accuracies, axis=0), axis=0)]
+		return best_values, curves
+
+	def __fit_classifier(self, layer: int, train_x: np.ndarray, train_y) -> object:
+		"""
+		Instances and trains a new classifier for a single layer.
+		"""
+		clf = self._instance_layer_classifier(layer)
+		clf.fit(np.ascontiguousarray(train_x), train_y)
+		return clf
+
+	def _run_on_layers(self, function, num_layers: int | None = None) -> list:
+		"""
+		Calls a function for each layer, in parallel.
+		:param function: The function to call, taking the index of the layer as the only parameter.
+		:param num_layers: The number of layers, if different from the current number of classifiers.
+		:return: The list of the results, one for each layer, in order.
+		"""
+		num_layers = num_layers if num_layers is not None else self.num_layers
+		n_jobs: int = self.n_jobs if self.n_jobs is not None else min(num_layers, os.cpu_count())
+		n_jobs = max(1, n_jobs)
+		with threadpool_limits(limits=max(1, os.cpu_count() // n_jobs)):
+			return Parallel(n_jobs=n_jobs, prefer='threads')(delayed(function)(layer) for layer in range(num_layers))
+
 	@property
 	@abstractmethod
 	def features_importance(self) -> np.ndarray:
@@ -99,7 +310,7 @@ class _AbstractGenderClassifier(ABC):
 		"""
 		pass
 
-	def get_most_important_features(self, cut_zeros: bool = True) -> list[tuple[np.ndarray, np.ndarray]]:
+	def get_most_important_features(self, cut_zeros: bool = True, top_k: int | None = None) -> list[tuple[np.ndarray, np.ndarray]]:
 		"""
 		Returns the most important features, with the corresponding importance measure.
 
@@ -113,13 +324,27 @@ class _AbstractGenderClassifier(ABC):
 		If the given parameter is true, the zero-importance features are removed from the result; then the result for
 		that layer may have a dimension inferior to the original number of features.
 
+		If "top_k" is given, only the "top_k" most important features of each layer are selected (and sorted), without
+		sorting all the features.
+
 		:param cut_zeros: If True, removes the zero-importance features from the arrays.
+		:param top_k: The maximum number of features for each layer, or None for all the features.
 		:return: A list of couples representing the indices and the values of the most useful features in the classifier.
 		"""
+		importance: np.ndarray = self.features_importance
+		if top_k is not None and top_k < importance.shape[-1]:
+			candidates_indices = np.argpartition(-importance, top_k - 1, axis=-1)[:, :top_k]
+		else:
+			candidates_indices = np.broadcast_to(np.arange(importance.shape[-1]), importance.shape)
+		candidates_importance = np.take_along_axis(importance, candidates_indices, axis=-1)
+		order = np.argsort(-candidates_importance, axis=-1, kind='stable')
+		all_sorted_indices = np.take_along_axis(candidates_indices, order, axis=-1)
+		all_sorted_importance = np.take_along_axis(candidates_importance, order, axis=-1)
+
 		result: list[tuple[np.ndarray, np.ndarray]] = []
 		for layer in range(self.num_layers):
-			sorted_importance_indices = np.argsort(-self.features_importance[layer], axis=-1)
-			sorted_importance = self.features_importance[layer, sorted_importance_indices]
+			sorted_importance_indices = all_sorted_indices[layer]
+			sorted_importance = all_sorted_importance[layer]
 			if cut_zeros:
 				# Finding the non-zero elements
 				non_zeros_indices = np.argwhere(sorted_importance)
@@ -161,11 +386,9 @@ class _AbstractGenderClassifier(ABC):
 		:return: A numpy array of accuracies, one for each layer
 		"""
 		self._check_classifiers_method("score")
-		accuracies = np.zeros(shape=self.num_layers)
-		for layer in range(self.num_layers):
-			clf = self._classifiers[layer]
-			accuracies[layer] = clf.score(embeddings[:, layer], genders)
-		return accuracies
+		embeddings = self._standardized(embeddings)
+		accuracies = self._run_on_layers(lambda layer: self._classifiers[layer].score(embeddings[:, layer], genders))
+		return np.asarray(accuracies, dtype=np.float64)
 
 	def evaluate(self, evaluation_embeddings: list[np.ndarray], evaluation_genders: list[IntEnum] | list[int]):
 		accuracies = self.score_accuracy(np.asarray(evaluation_embeddings), np.asarray(evaluation_genders))
@@ -184,10 +407,11 @@ class _AbstractGenderClassifier(ABC):
 		The predictions follows the class in the Gender Enumeration.
 		"""
 		self._check_classifiers_method("predict")
+		embeddings = self._standardized(embeddings)
 		predictions = np.zeros(shape=(len(embeddings), self.num_layers), dtype=np.uint8)
-		for layer in range(self.num_layers):
-			clf = self._classifiers[layer]
-			predictions[:, layer] = clf.predict(embeddings[:, layer])
+		layers_predictions = self._run_on_layers(lambda layer: self._classifiers[layer].predict(embeddings[:, layer]))
+		for layer, layer_predictions in enumerate(layers_predictions):
+			predictions[:, layer] = layer_predictions
 		return predictions
 
 	@abstractmethod
@@ -217,39 +441,67 @@ class _AbstractGenderClassifier(ABC):
 		:param embeddings: A numpy array of dimensions [# samples, # layers (= 13), # features (= 768)]
 		:return: A numpy array of intensities for each sample and for each layer. The array has dimensions [# samples, # layers]
 		"""
-		projections = np.zeros(shape=(len(embeddings), self.num_layers), dtype=np.float)
-		for layer in range(self.num_layers):
-			features_importance_for_current_layer = self.features_importance[layer]
-			projections[:, layer] = np.dot(np.abs(embeddings[:, layer]), features_importance_for_current_layer)
-		return projections
+		return np.einsum('slf,lf->sl', np.abs(embeddings), self.features_importance)
 
 
-class GenderLinearSupportVectorClassifier(_AbstractGenderClassifier):
+def _standardization_statistics(embeddings: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+	"""
+	Computes the mean and the standard deviation of each feature of each layer; the constant features have a
+	standard deviation of 1, so that they're only centered.
+	:param embeddings: The embeddings, of dimensions [# samples, # layers, # features]
+	:return: The mean and the standard deviation, of dimensions [# layers, # features]
+	"""
+	embeddings = np.asarray(embeddings, dtype=np.float64)
+	mean = np.mean(embeddings, axis=0)
+	std = np.std(embeddings, axis=0)
+	std[std == 0] = 1.0
+	return mean, std
 
-	def _instance_new_classifier(self):
-		return svm.LinearSVC(dual=False)
+
+class _AbstractLinearGenderClassifier(_AbstractGenderClassifier, ABC):
+	"""
+	A gender classifier whose inner classifiers are linear: each layer has a coefficients vector ("coef_") and an
+	intercept ("intercept_"). After the training, the weights of all the layers are stacked in a single matrix.
+	"""
+
+	def _on_fitted(self) -> None:
+		# The weights of all the layers are frozen in contiguous arrays
+		self._coefficients: np.ndarray = np.ascontiguousarray([clf.coef_[0] for clf in self._classifiers])
+		self._intercepts: np.ndarray = np.ascontiguousarray([clf.intercept_[0] for clf in self._classifiers])
+		if self._mean is not None:
+			# The standardization is folded in the weights, that then apply to the raw embeddings:
+			# w' (x - m) / s + b = (w' / s) x + (b - (w' / s) m)
+			self._coefficients = self._coefficients / self._std
+			self._intercepts = self._intercepts - np.einsum('lf,lf->l', self._coefficients, self._mean)
+		self._importance: np.ndarray = np.abs(self._coefficients)
 
 	@property
 	def features_importance(self) -> np.ndarray:
-		return np.abs(self.coefficients)
+		return self._importance
 
 	@property
 	def features_bias(self) -> np.ndarray:
-		return self.coefficients
+		return self._coefficients
 
 	@property
 	def coefficients(self) -> np.ndarray:
 		"""
-		:return: The coefficients array for each layer.
+		:return: The coefficients array for each layer, of dimensions [# layers, # features].
 		"""
-		return np.asarray([clf.coef_[0] for clf in self._classifiers])
+		return self._coefficients
 
 	@property
 	def intercepts(self) -> np.ndarray:
 		"""
 		:return: The intercept value for each layer.
 		"""
-		return np.asarray([clf.intercept_[0] for clf in self._classifiers])
+		return self._intercepts
+
+	def predict_gender_class(self, embeddings: np.ndarray) -> np.ndarray:
+		# The class is the sign of the projection, as in the "predict" method of the inner classifiers
+		positive = self.predict_gender_spectrum(embeddings) > 0
+		classes = np.asarray([clf.classes_ for clf in self._classifiers])
+		return classes[np.arange(self.num_layers), positive.astype(np.intp)].astype(np.uint8)
 
 	def predict_gender_spectrum(self, embeddings: np.ndarray) -> np.ndarray:
 		"""
@@ -259,7 +511,8 @@ class GenderLinearSupportVectorClassifier(_AbstractGenderClassifier):
 
 		Note: a negative value is associated with the male gender. A positive value signals a female gender.
 
-		In this particular case of Linear SVC, we compute the projection of the embedding over the gender direction.
+		In this particular case of linear classifiers (e.g. Linear SVC), we compute the projection of the embedding over
+		the gender direction.
 		The projection of the embedding has several meaning:
 
 		- geometrically, it's the ratio between the projection of the embedding over the gender direction, and the gender
@@ -268,17 +521,269 @@ class GenderLinearSupportVectorClassifier(_AbstractGenderClassifier):
 		  divides the two classified classes of gender.
 		- algebraically, the scalar product between the embedding and the gender direction, plus the intercept.
 
-		The gender direction corresponds to the coefficients of the trained SVC.
+		The gender direction corresponds to the coefficients of the trained classifier.
 		Each embedding is considered as a group of #layers (=13) distinct embeddings. Each embedding will be
-		processed by the layer-corresponding SVC.
+		processed by the layer-corresponding classifier.
 
 		:param embeddings: A numpy array of dimensions [# samples, # layers (= 13), # features (= 768)]
 		:return: A numpy array of projections for each sample and for each layer. The array has dimensions [# samples, # layers]
 		"""
-		projections = np.zeros(shape=(len(embeddings), self.num_layers), dtype=np.float)
-		for layer, (coefs, intercept) in enumerate(zip(self.coefficients, self.intercepts)):
-			projections[:, layer] = np.dot(embeddings[:, layer], coefs) + intercept
-		return projections
+		return np.einsum('slf,lf->sl', embeddings, self._coefficients) + self._intercepts
+
+
+class GenderLinearSupportVectorClassifier(_AbstractLinearGenderClassifier):
+	"""
+	A linear gender classifier trained with the squared hinge loss, by the Scikit-Learn (Liblinear) linear SVC.
+	Since Liblinear cannot start from a previous solution, the regularization path of the search is computed with the
+	same objective by the batched L-BFGS of PyTorch, for all the layers together and with warm starts; the final
+	classifiers are still trained by Liblinear.
+	"""
+
+	# All the layers are trained together along the regularization path
+	_regularization_path_per_layer: bool = False
+
+	def _instance_new_classifier(self):
+		return self._instance_regularized_classifier(self.regularization_parameter)
+
+	def _instance_layer_classifier(self, layer: int):
+		return self._instance_regularized_classifier(self._regularization[layer])
+
+	@classmethod
+	def _instance_regularized_classifier(cls, regularization: float):
+		return svm.LinearSVC(dual=False, C=regularization)
+
+	@classmethod
+	def _fit_regularization_path(cls, train_x: np.ndarray, train_y: np.ndarray, valid_x: np.ndarray,
+	                             valid_y: np.ndarray, regularization_values: np.ndarray) -> np.ndarray:
+		return _fit_linear_probes_path(train_x, train_y, valid_x, valid_y, regularization_values, loss='squared_hinge')
+
+
+class _LinearLayerProbe:
+	"""
+	A trained linear classifier for a single layer, with the same interface of the Scikit-Learn linear classifiers.
+	"""
+
+	def __init__(self, coefficients: np.ndarray | None = None, intercept: float = 0.0, classes: np.ndarray | None = None):
+		self.coef_: np.ndarray | None = coefficients[np.newaxis] if coefficients is not None else None
+		self.intercept_: np.ndarray = np.asarray([intercept])
+		self.classes_: np.ndarray | None = classes
+
+	def decision_function(self, x: np.ndarray) -> np.ndarray:
+		return x @ self.coef_[0] + self.intercept_[0]
+
+	def predict(self, x: np.ndarray) -> np.ndarray:
+		return self.classes_[(self.decision_function(x) > 0).astype(np.intp)]
+
+	def score(self, x: np.ndarray, y) -> float:
+		return float(np.mean(self.predict(x) == np.asarray(y)))
+
+
+def _fit_linear_probes(x: np.ndarray, y: np.ndarray, regularization: float | np.ndarray, loss: str = 'logistic',
+                       init: tuple[np.ndarray, np.ndarray] | None = None,
+                       max_iter: int = 200, tolerance: float = 1e-6) -> tuple[np.ndarray, np.ndarray]:
+	"""
+	Trains an L2-regularized linear classifier for each layer, all together, with the L-BFGS algorithm.
+	The objective of each layer is the one of Scikit-Learn, according to the loss:
+		- 'logistic': 1/2 ||w||^2 + C * sum(log(1 + exp(-y * (x w + b)))), as the logistic regression.
+		- 'squared_hinge': 1/2 (||w||^2 + b^2) + C * sum(max(0, 1 - y * (x w + b))^2), as the linear SVC (where
+		  Liblinear regularizes the intercept too).
+	Since the layers are independent, minimizing the sum of the objectives minimizes each one of them.
+
+	:param x: The training data, of dimensions: [# samples, # layers, # features]
+	:param y: The binary labels (0 or 1), of dimensions: [# samples]
+	:param regularization: The inverse of the regularization strength ("C"), for all the layers or for each layer.
+	:param loss: The loss function, 'logistic' or 'squared_hinge'.
+	:param init: The initial coefficients [# layers, # features] and intercepts [# layers], e.g. for a warm start.
+	:param max_iter: The maximum number of iterations of L-BFGS.
+	:param tolerance: The tolerance of L-BFGS on the gradient.
+	:return: The coefficients [# layers, # features] and the intercepts [# layers].
+	"""
+	if loss not in ('logistic', 'squared_hinge'):
+		raise AttributeError(f"Unknown loss for the linear probes: '{loss}'")
+	num_samples, num_layers, num_features = x.shape
+	x_t = torch.from_numpy(np.ascontiguousarray(x, dtype=np.float64))
+	signs = torch.from_numpy(2.0 * np.asarray(y, dtype=np.float64) - 1.0)
+	if init is None:
+		weights = torch.zeros((num_layers, num_features), dtype=torch.float64, requires_grad=True)
+		biases = torch.zeros(num_layers, dtype=torch.float64, requires_grad=True)
+	else:
+		weights = torch.tensor(init[0], dtype=torch.float64, requires_grad=True)
+		biases = torch.tensor(init[1], dtype=torch.float64, requires_grad=True)
+	# The inverse of the regularization strength of each layer: [# layers]
+	c_t = torch.from_numpy(np.array(np.broadcast_to(np.asarray(regularization, dtype=np.float64), (num_layers,))))
+	optimizer = torch.optim.LBFGS([weights, biases], lr=1, max_iter=max_iter, tolerance_grad=tolerance,
+	                              tolerance_change=tolerance * 1e-3, line_search_fn='strong_wolfe')
+
+	def closure():
+		optimizer.zero_grad()
+		margins = signs[:, None] * (torch.einsum('slf,lf->sl', x_t, weights) + biases)
+		if loss == 'logistic':
+			losses = torch.nn.functional.softplus(-margins)
+			penalties = torch.sum(weights * weights, dim=1)
+		else:
+			losses = torch.square(torch.relu(1.0 - margins))
+			penalties = torch.sum(weights * weights, dim=1) + biases * biases
+		# The objective is divided by (C * # samples), for a better conditioning
+		objective = losses.mean(dim=0).sum() + torch.sum(0.5 / (c_t * num_samples) * penalties)
+		objective.backward()
+		return objective
+
+	optimizer.step(closure)
+	return weights.detach().numpy(), biases.detach().numpy()
+
+
+def _fit_linear_probes_path(train_x: np.ndarray, train_y: np.ndarray, valid_x: np.ndarray, valid_y: np.ndarray,
+                            regularization_values: np.ndarray, loss: str) -> np.ndarray:
+	"""
+	Trains the linear probes of all the layers along the regularization path, each time starting from the solution of
+	the previous (stronger) regularization, and validates them (see: "_fit_regularization_path").
+	:return: The validation accuracies, of dimensions [# values, # layers]
+	"""
+	classes = np.unique(train_y)
+	accuracies = np.zeros(shape=(len(regularization_values), train_x.shape[1]))
+	solution = None
+	for i, value in enumerate(regularization_values):
+		solution = _fit_linear_probes(train_x, train_y == classes[1], regularization=value, loss=loss, init=solution)
+		coefficients, intercepts = solution
+		predictions = classes[(np.einsum('slf,lf->sl', valid_x, coefficients) + intercepts > 0).astype(np.intp)]
+		accuracies[i] = np.mean(predictions == valid_y[:, np.newaxis], axis=0)
+	return accuracies
+
+
+class GenderLogisticRegressionClassifier(_AbstractLinearGenderClassifier):
+	"""
+	A linear gender classifier trained with the logistic loss.
+	Unlike the other classifiers, the probes of all the layers are trained together, as a single [layers, features]
+	weights tensor, with a full-batch L-BFGS optimization in PyTorch.
+	"""
+
+	# All the layers are trained together, also along the regularization path
+	_regularization_path_per_layer: bool = False
+
+	def _instance_new_classifier(self):
+		return _LinearLayerProbe()
+
+	@classmethod
+	def _fit_regularization_path(cls, train_x: np.ndarray, train_y: np.ndarray, valid_x: np.ndarray,
+	                             valid_y: np.ndarray, regularization_values: np.ndarray) -> np.ndarray:
+		return _fit_linear_probes_path(train_x, train_y, valid_x, valid_y, regularization_values, loss='logistic')
+
+	def _fit(self, training_embeddings: np.ndarray, training_genders: np.ndarray) -> list:
+		classes = np.unique(training_genders)
+		if len(classes) != 2:
+			raise AttributeError(f"Cannot train a binary classifier on {len(classes)} classes: {classes}")
+		coefficients, intercepts = _fit_linear_probes(training_embeddings, training_genders == classes[1],
+		                                              regularization=self._regularization, loss='logistic')
+		return [_LinearLayerProbe(coefs, intercept, classes) for coefs, intercept in zip(coefficients, intercepts)]
+
+
+class _AbstractClosedFormGenderClassifier(_AbstractLinearGenderClassifier, ABC):
+	"""
+	A linear gender classifier whose direction is computed in closed form, from the statistics of the two classes.
+	The direction of all the layers is computed at once, with batched linear algebra over the [samples, layers, features]
+	training array. The intercept places the decision boundary halfway between the means of the two classes.
+	"""
+
+	def _instance_new_classifier(self):
+		return _LinearLayerProbe()
+
+	def _fit(self, training_embeddings: np.ndarray, training_genders: np.ndarray) -> list:
+		classes = np.unique(training_genders)
+		if len(classes) != 2:
+			raise AttributeError(f"Cannot train a binary classifier on {len(classes)} classes: {classes}")
+		x = np.asarray(training_embeddings, dtype=np.float64)
+		x_neg, x_pos = x[training_genders == classes[0]], x[training_genders == classes[1]]
+		directions = self._compute_directions(x_neg, x_pos)
+		# The boundary passes through the midpoint of the two means: [# layers]
+		midpoints = (np.mean(x_neg, axis=0) + np.mean(x_pos, axis=0)) / 2
+		intercepts = -np.einsum('lf,lf->l', directions, midpoints)
+		return [_LinearLayerProbe(coefs, intercept, classes) for coefs, intercept in zip(directions, intercepts)]
+
+	@abstractmethod
+	def _compute_directions(self, x_neg: np.ndarray, x_pos: np.ndarray) -> np.ndarray:
+		"""
+		Computes the direction of each layer, from the negative to the positive class.
+		:param x_neg: The embeddings of the negative class (e.g. male), of dimensions [# samples, # layers, # features]
+		:param x_pos: The embeddings of the positive class (e.g. female), of dimensions [# samples, # layers, # features]
+		:return: The directions, of dimensions [# layers, # features]
+		"""
+		raise NotImplementedError("Cannot compute the directions of an abstract closed-form classifier.")
+
+
+class GenderMeanDifferenceClassifier(_AbstractClosedFormGenderClassifier):
+	"""
+	The gender direction is the difference between the mean embeddings of the two genders.
+	"""
+
+	def _compute_directions(self, x_neg: np.ndarray, x_pos: np.ndarray) -> np.ndarray:
+		return np.mean(x_pos, axis=0) - np.mean(x_neg, axis=0)
+
+
+class GenderShrinkageLDAClassifier(_AbstractClosedFormGenderClassifier):
+	"""
+	The gender direction is the one of the Linear Discriminant Analysis: the difference of the means, whitened by the
+	pooled within-class covariance. Since the features are usually more than the samples, the covariance is shrunk
+	towards a scaled identity matrix.
+	"""
+
+	# The shrinkage intensity, in [0, 1]; if None, it's estimated for each layer with the Ledoit-Wolf formula
+	shrinkage: float | None = None
+
+	@staticmethod
+	def _ledoit_wolf_shrinkage(centered: np.ndarray) -> np.ndarray:
+		"""
+		Computes the Ledoit-Wolf shrinkage of each layer, as in "sklearn.covariance.ledoit_wolf_shrinkage".
+		:param centered: The centered samples, of dimensions [# samples, # layers, # features]
+		:return: The shrinkage intensities, of dimensions [# layers]
+		"""
+		num_samples, _, num_features = centered.shape
+		squared = centered ** 2
+		emp_cov_trace = np.sum(squared, axis=(0, 2)) / num_samples
+		mu = emp_cov_trace / num_features
+		beta_ = np.sum(np.einsum('slf,slg->lfg', squared, squared), axis=(1, 2))
+		delta_ = np.sum(np.einsum('slf,slg->lfg', centered, centered) ** 2, axis=(1, 2)) / num_samples ** 2
+		beta = 1.0 / (num_features * num_samples) * (beta_ / num_samples - delta_)
+		delta = (delta_ - 2.0 * mu * emp_cov_trace + num_features * mu ** 2) / num_features
+		beta = np.minimum(beta, delta)
+		return np.divide(beta, delta, out=np.zeros_like(beta), where=delta > 0)
+
+	def _compute_directions(self, x_neg: np.ndarray, x_pos: np.ndarray) -> np.ndarray:
+		mean_neg, mean_pos = np.mean(x_neg, axis=0), np.mean(x_pos, axis=0)
+		# Pooled within-class covariance of each layer: [# layers, # features, # features]
+		centered = np.concatenate([x_neg - mean_neg, x_pos - mean_pos], axis=0)
+		num_samples, _, num_features = centered.shape
+		covariances = np.einsum('slf,slg->lfg', centered, centered) / num_samples
+		shrinkage = np.full(centered.shape[1], self.shrinkage) if self.shrinkage is not None \
+			else self._ledoit_wolf_shrinkage(centered)
+		# Shrinking towards (trace / # features) * I
+		scales = np.trace(covariances, axis1=1, axis2=2) / num_features
+		covariances *= (1.0 - shrinkage)[:, np.newaxis, np.newaxis]
+		diagonal = np.einsum('lff->lf', covariances)
+		diagonal += (shrinkage * scales)[:, np.newaxis]
+		return np.linalg.solve(covariances, (mean_pos - mean_neg)[..., np.newaxis])[..., 0]
+
+
+class GenderPairedPCAClassifier(_AbstractClosedFormGenderClassifier):
+	"""
+	The gender direction is the first principal component of the differences between paired words, as in
+	Bolukbasi et al. (2016), "Man is to Computer Programmer as Woman is to Homemaker?".
+	The words are paired by their order within each gender (e.g. "he"-"she", "man"-"woman", ...): the training
+	words of the two genders must be given in corresponding order, and in the same number.
+	"""
+
+	def _compute_directions(self, x_neg: np.ndarray, x_pos: np.ndarray) -> np.ndarray:
+		if len(x_neg) != len(x_pos):
+			raise AttributeError(f"Cannot pair {len(x_neg)} embeddings of a class with {len(x_pos)} embeddings of the "
+			                     f"other class: the paired classifier requires the same number of words for each class")
+		# The pairs are centered on their midpoint: the centered vectors are +/- half their difference
+		differences = (x_pos - x_neg) / 2
+		# First right singular vector of each layer: [# layers, # features]
+		_, _, vh = np.linalg.svd(np.swapaxes(differences, 0, 1), full_matrices=False)
+		directions = vh[:, 0]
+		# The sign is chosen so that the direction points towards the positive class
+		signs = np.sign(np.einsum('lf,lf->l', directions, np.mean(differences, axis=0)))
+		signs[signs == 0] = 1
+		return directions * signs[:, np.newaxis]
 
 
 class GenderDecisionTreeClassifier(_AbstractGenderClassifier):
@@ -286,9 +791,32 @@ class GenderDecisionTreeClassifier(_AbstractGenderClassifier):
 	def _instance_new_classifier(self):
 		return DecisionTreeClassifier()
 
+	def _on_fitted(self) -> None:
+		# The split nodes of the trees are compiled in padded arrays of dimensions [# layers, # max split features].
+		# For each layer, every split feature appears once, with the threshold of its last node (as in "thresholds").
+		# The leaves are excluded: their feature index is negative ("TREE_UNDEFINED").
+		layers_splits: list[dict[int, float]] = []
+		for clf in self._classifiers:
+			is_split = clf.tree_.feature >= 0
+			layers_splits.append(dict(zip(clf.tree_.feature[is_split].tolist(), clf.tree_.threshold[is_split].tolist())))
+		max_splits: int = max(1, max(len(splits) for splits in layers_splits))
+		self._split_features: np.ndarray = np.zeros(shape=(self.num_layers, max_splits), dtype=np.intp)
+		self._split_thresholds: np.ndarray = np.zeros(shape=(self.num_layers, max_splits), dtype=np.float64)
+		self._split_mask: np.ndarray = np.zeros(shape=(self.num_layers, max_splits), dtype=bool)
+		for layer, splits in enumerate(layers_splits):
+			self._split_features[layer, :len(splits)] = list(splits.keys())
+			self._split_thresholds[layer, :len(splits)] = list(splits.values())
+			self._split_mask[layer, :len(splits)] = True
+		if self._mean is not None:
+			# The thresholds of the standardized features are brought back to the scale of the raw embeddings
+			layers_indices = np.arange(self.num_layers)[:, np.newaxis]
+			self._split_thresholds = self._split_thresholds * self._std[layers_indices, self._split_features] \
+				+ self._mean[layers_indices, self._split_features]
+		self._importance: np.ndarray = np.asarray([clf.feature_importances_ for clf in self._classifiers])
+
 	@property
 	def features_importance(self) -> np.ndarray:
-		return np.asarray([clf.feature_importances_ for clf in self._classifiers])
+		return self._importance
 
 	@property
 	def features_bias(self) -> np.ndarray:
@@ -302,20 +830,14 @@ class GenderDecisionTreeClassifier(_AbstractGenderClassifier):
 		"""
 		results = np.zeros(shape=self.features_importance.shape)
 		mask = np.zeros(shape=results.shape, dtype=np.uint8)
-
-		for layer in range(self.num_layers):
-			clf = self._classifiers[layer]
-			features = clf.tree_.feature
-			thresholds = clf.tree_.threshold
-			for feature, threshold in zip(features, thresholds):
-
-				results[layer, feature] = threshold
-				mask[layer, feature] = 1.0
+		layers_indices = np.broadcast_to(np.arange(self.num_layers)[:, np.newaxis], self._split_mask.shape)
+		results[layers_indices[self._split_mask], self._split_features[self._split_mask]] = self._split_thresholds[self._split_mask]
+		mask[layers_indices[self._split_mask], self._split_features[self._split_mask]] = 1
 		return results, mask
 
 	def predict_gender_spectrum(self, embeddings: np.ndarray) -> np.ndarray:
 		# Input:                [#samples, #layers, #features]
-		# Thresholds / Mask:    [#layers, #features]
+		# Thresholds / Mask:    [#layers, #split features]
 		# Output:               [#samples, #layers]
 
 		# The gender score is computed with this idea: we take the threshold of the nodes where the decisions happen.
@@ -324,10 +846,9 @@ class GenderDecisionTreeClassifier(_AbstractGenderClassifier):
 		# the threshold, the result will be low. Otherwise, the result will be high.
 		# We sum the distances for each layer and the result is an indication of how "neat" was the classification.
 		# At the end, we multiply the result for the predicted class (+1 = female, -1 = male).
-		thresholds, mask = self.thresholds
-		distances = np.asarray(list(map(
-			lambda sample_tensor: np.sum(np.multiply(np.abs(sample_tensor - thresholds), mask), axis=-1),
-			embeddings)))
+		# Gathering only the split features of each layer: [#samples, #layers, #split features]
+		split_values = embeddings[:, np.arange(self.num_layers)[:, np.newaxis], self._split_features]
+		distances = np.sum(np.abs(split_values - self._split_thresholds) * self._split_mask, axis=-1)
 		# Create a +/-1 array of predictions
 		classes = self.predict_gender_class(embeddings)
 		classes = np.interp(classes, (np.min(classes), np.max(classes)), (-1, +1))
@@ -15,11 +15,8 @@ import torch
 class LayersIterator(Iterable):
 
 	def __init__(self, embeddings: np.ndarray | torch.Tensor):
-		# Converting into numpy array
-		if isinstance(embeddings, torch.Tensor):
-			embeddings = embeddings.detach().numpy()
-
-		self.__embeddings: list[np.ndarray] = []
+		# The layers are views of the given array or tensor, without conversions
+		self.__embeddings: list[np.ndarray | torch.Tensor] = []
 		self.__index = 0
 
 		# Embeddings have no layers dimension AND no samples dimension
@@ -0,0 +1,156 @@
+#########################################################################
+#                            Dusi's Thesis                              #
+# Algorithmic Discrimination and Natural Language Processing Techniques #
+#########################################################################
+
+# This module implements the Low-Rank Adapters (LoRA) for the linear projections of a transformer encoder.
+# The base weights are frozen, and only two small matrices A and B are trained for each projection, so that the
+# adapted weight is: W + (alpha / rank) * B @ A. After the training, the adapters can be merged into the weights.
+
+import math
+import os
+
+import torch
+
+# The names of the adapted projections, for BERT-like models (attention and feed-forward)
+BERT_TARGET_MODULES: tuple[str, ...] = ('query', 'key', 'value', 'dense')
+# The names of the adapted projections, for DistilBERT-like models
+DISTILBERT_TARGET_MODULES: tuple[str, ...] = ('q_lin', 'k_lin', 'v_lin', 'out_lin', 'lin1', 'lin2')
+DEFAULT_TARGET_MODULES: tuple[str, ...] = BERT_TARGET_MODULES + DISTILBERT_TARGET_MODULES
+
+ADAPTERS_FILE_NAME: str = 'lora_adapters.pt'
+
+
+class LoRALinear(torch.nn.Module):
+	"""
+	A linear layer with a frozen base weight and a trainable low-rank update.
+	"""
+
+	def __init__(self, base: torch.nn.Linear, rank: int, alpha: float):
+		"""
+		:param base: The original linear layer, whose parameters are frozen.
+		:param rank: The rank of the update.
+		:param alpha: The scaling numerator of the update; the update is scaled by "alpha / rank".
+		"""
+		super().__init__()
+		if rank <= 0:
+			raise AttributeError(f"The rank of the adapters must be positive, not {rank}")
+		self.base = base
+		self.base.requires_grad_(False)
+		self.rank = rank
+		self.scaling: float = alpha / rank
+		# As in the original LoRA paper: A is random and B is zero, so that the initial update is null
+		self.lora_a = torch.nn.Parameter(torch.empty((rank, base.in_features), dtype=base.weight.dtype))
+		self.lora_b = torch.nn.Parameter(torch.zeros((base.out_features, rank), dtype=base.weight.dtype))
+		torch.nn.init.kaiming_uniform_(self.lora_a, a=math.sqrt(5))
+
+	def forward(self, x: torch.Tensor) -> torch.Tensor:
+		return self.base(x) + (x @ self.lora_a.T @ self.lora_b.T) * self.scaling
+
+	def merged(self) -> torch.nn.Linear:
+		"""
+		Merges the update into the base weight.
+		:return: The base linear layer, with the updated weight.
+		"""
+		with torch.no_grad():
+			self.base.weight += (self.lora_b @ self.lora_a) * self.scaling
+		return self.base
+
+
+def _get_parent(model: torch.nn.Module, module_name: str) -> tuple[torch.nn.Module, str]:
+	"""
+	Returns the parent module of a submodule, and the name of the submodule inside it.
+	"""
+	*parent_path, child_name = module_name.split('.')
+	parent = model.get_submodule('.'.join(parent_path)) if parent_path else model
+	return parent, child_name
+
+
+def apply_lora(model: torch.nn.Module, rank: int, alpha: float,
+               target_modules: tuple[str, ...] = DEFAULT_TARGET_MODULES) -> list[str]:
+	"""
+	Freezes all the parameters of the model, and replaces the target projections of the encoder layers with LoRA layers.
+	Only the linear modules inside the layers of the encoder are adapted (i.e. not the pooler or the MLM head).
+
+	:param model: The model to adapt. It's modified in place.
+	:param rank: The rank of the adapters.
+	:param alpha: The scaling numerator of the adapters.
+	:param target_modules: The names of the adapted linear modules.
+	:return: The full names of the adapted modules.
+	"""
+	model.requires_grad_(False)
+	adapted_names: list[str] = [name for name, module in model.named_modules()
+	                            if isinstance(module, torch.nn.Linear) and '.layer.' in name
+	                            and name.split('.')[-1] in target_modules]
+	if len(adapted_names) == 0:
+		raise AttributeError(f"Cannot find any module to adapt in the model of type {type(model)}")
+	for name in adapted_names:
+		parent, child_name = _get_parent(model, name)
+		setattr(parent, child_name, LoRALinear(getattr(parent, child_name), rank=rank, alpha=alpha))
+	return adapted_names
+
+
+def merge_lora(model: torch.nn.Module) -> torch.nn.Module:
+	"""
+	Merges all the LoRA layers of the model into their base linear layers, restoring the original architecture.
+	The merged model has no inference overhead. Its parameters are left frozen.
+
+	:param model: The adapted model. It's modified in place.
+	:return: The same model, merged.
+	"""
+	lora_names: list[str] = [name for name, module in model.named_modules() if isinstance(module, LoRALinear)]
+	for name in lora_names:
+		parent, child_name = _get_parent(model, name)
+		setattr(parent, child_name, getattr(parent, child_name).merged())
+	return model
+
+
+def save_adapters(model: torch.nn.Module, path: str, base_model_name: str, rank: int, alpha: float) -> None:
+	"""
+	Saves only the adapters weights of a model, with the configuration needed to apply them again.
+
+	:param model: The adapted (not merged) model.
+	:param path: The folder where the adapters file is written.
+	:param base_model_name: The name of the base model, checked when the adapters are loaded.
+	:param rank: The rank of the adapters.
+	:param alpha: The scaling numerator of the adapters.
+	:return: None
+	"""
+	state: dict[str, torch.Tensor] = {name: param.detach().cpu() for name, param in model.named_parameters()
+	                                  if name.endswith('lora_a') or name.endswith('lora_b')}
+	os.makedirs(path, exist_ok=True)
+	torch.save({
+		'base_model_name': base_model_name,
+		'rank': rank,
+		'alpha': alpha,
+		'state': state,
+	}, os.path.join(path, ADAPTERS_FILE_NAME))
+
+
+def has_adapters(path: str | None) -> bool:
+	"""
+	:return: True if the given folder contains saved adapters.
+	"""
+	return path is not None and os.path.isfile(os.path.join(path, ADAPTERS_FILE_NAME))
+
+
+def load_adapters(model: torch.nn.Module, path: str, base_model_name: str, merge: bool = True) -> torch.nn.Module:
+	"""
+	Applies the saved adapters to a base model.
+
+	:param model: The base model, as retrieved from HuggingFace. It's modified in place.
+	:param path: The folder containing the adapters file.
+	:param base_model_name: The name of the base model, which must be the same of the saved adapters.
+	:param merge: If True, the adapters are merged into the base weights. Otherwise, they're applied on the fly.
+	:return: The adapted model.
+	"""
+	checkpoint = torch.load(os.path.join(path, ADAPTERS_FILE_NAME), map_location='cpu')
+	if checkpoint['base_model_name'] != base_model_name:
+		raise AttributeError(f"The adapters in {path} were trained on <{checkpoint['base_model_name']}>, "
+		                     f"not on <{base_model_name}>")
+	apply_lora(model, rank=checkpoint['rank'], alpha=checkpoint['alpha'])
+	missing_keys = set(checkpoint['state'].keys()) - set(name for name, _ in model.named_parameters())
+	if len(missing_keys) > 0:
+		raise AttributeError(f"The adapters in {path} do not match the model: {sorted(missing_keys)[:5]}")
+	model.load_state_dict(checkpoint['state'], strict=False)
+	return merge_lora(model) if merge else model
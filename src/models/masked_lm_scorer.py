@@ -0,0 +1,365 @@
+#########################################################################
+#                            Dusi's Thesis                              #
+# Algorithmic Discrimination and Natural Language Processing Techniques #
+#########################################################################
+
+# This class scores the [MASK] tokens of many sentences with a Masked Language Model, in large batches.
+# Unlike the HuggingFace "fill-mask" pipeline, it never decodes the whole vocabulary for each sentence: only the
+# hidden states of the masked positions are projected over the rows of the requested tokens.
+
+from typing import Any, Iterator
+
+import numpy as np
+import torch
+from transformers import PreTrainedTokenizerBase
+
+import settings
+from src.models.trained_model_factory import TrainedModelForMaskedLMFactory
+
+
+class EncodedSentences:
+	"""
+	A list of sentences tokenized without padding.
+	Since the tokenization only depends on the tokenizer, the same object can be scored by different models (e.g. by
+	different fine-tuned checkpoints of the same base model).
+	"""
+
+	def __init__(self, tokenizer: PreTrainedTokenizerBase, sentences: list[str]):
+		self.sentences: list[str] = sentences
+		self.input_ids: list[list[int]] = tokenizer(sentences, truncation=True)['input_ids']
+		self.pad_token_id: int = tokenizer.pad_token_id
+		self.mask_token_id: int = tokenizer.mask_token_id
+		self.lengths: np.ndarray = np.asarray([len(ids) for ids in self.input_ids], dtype=np.int64)
+
+	@classmethod
+	def from_input_ids(cls, input_ids: list[list[int]], pad_token_id: int, mask_token_id: int) -> 'EncodedSentences':
+		"""
+		Builds the object from already tokenized sentences, e.g. from masked copies of other encoded sentences.
+		"""
+		encoded = cls.__new__(cls)
+		encoded.sentences = None
+		encoded.input_ids = input_ids
+		encoded.pad_token_id = pad_token_id
+		encoded.mask_token_id = mask_token_id
+		encoded.lengths = np.asarray([len(ids) for ids in input_ids], dtype=np.int64)
+		return encoded
+
+	def __len__(self) -> int:
+		return len(self.input_ids)
+
+	def batches(self, max_tokens: int) -> Iterator[tuple[np.ndarray, torch.Tensor, torch.Tensor]]:
+		"""
+		Groups the sentences in padded batches of (approximately) the same length.
+		Each batch contains at most <max_tokens> tokens, padding included; a single sentence longer than the budget
+		still forms a batch on its own.
+
+		:param max_tokens: The token budget of a batch.
+		:return: An iterator of triples (indices of the sentences in the batch, input ids, attention mask), where
+		the two tensors have dimensions [# batch sentences, # batch length].
+		"""
+		# Sorting the sentences by length reduces the padding
+		order = np.argsort(self.lengths, kind='stable')
+		start: int = 0
+		while start < len(order):
+			end: int = start + 1
+			# The sentences are sorted, so the last one of the batch is the longest
+			while end < len(order) and (end - start + 1) * self.lengths[order[end]] <= max_tokens:
+				end += 1
+			indices = order[start:end]
+			batch_length: int = int(self.lengths[indices[-1]])
+			input_ids = torch.full((len(indices), batch_length), fill_value=self.pad_token_id, dtype=torch.long)
+			for row, index in enumerate(indices):
+				input_ids[row, :self.lengths[index]] = torch.as_tensor(self.input_ids[index])
+			yield indices, input_ids, (input_ids != self.pad_token_id).long()
+			start = end
+
+
+class MaskedLMScorer:
+	"""
+	This class computes the probabilities of some tokens in the [MASK] positions of a list of sentences.
+	It runs the encoder of the MLM model on padded batches, then it applies the prediction head only to the masked
+	positions. The normalization over the whole vocabulary is a log-sum-exp computed in chunks of the decoder rows,
+	so the full vocabulary logits are never stored.
+
+	The scorer works on any device; by default it uses the device in the settings (CUDA if available, CPU otherwise).
+	"""
+
+	max_tokens_per_batch: int = 8192
+	vocabulary_chunk_size: int = 8192
+
+	def __init__(self, model: Any | str = settings.DEFAULT_BERT_MODEL_NAME,
+	             tokenizer: PreTrainedTokenizerBase | None = None, device: torch.device = settings.pt_device):
+		"""
+		:param model: The MLM model, or the name of a pre-trained MLM model.
+		:param tokenizer: The tokenizer corresponding to the model. If the model is a string, this is optional.
+		:param device: The device used to compute the scores.
+		"""
+		if isinstance(model, str):
+			factory = TrainedModelForMaskedLMFactory(model_name=model)
+			tokenizer = tokenizer if tokenizer is not None else factory.tokenizer
+			model = factory.get_model()
+		elif tokenizer is None:
+			raise AttributeError("Cannot instance a MaskedLMScorer without the tokenizer and without a valid model name")
+		self.__tokenizer: PreTrainedTokenizerBase = tokenizer
+		self.__device: torch.device = device
+		self.__model = model.to(self.__device).eval()
+		self.__head_transform = self.__get_head_transform(self.__model)
+		self.__decoder: torch.nn.Linear = self.__model.get_output_embeddings()
+
+	@property
+	def tokenizer(self) -> PreTrainedTokenizerBase:
+		return self.__tokenizer
+
+	@property
+	def model(self):
+		return self.__model
+
+	@property
+	def device(self) -> torch.device:
+		return self.__device
+
+	@staticmethod
+	def __get_head_transform(model) -> torch.nn.Module:
+		"""
+		Returns the part of the MLM prediction head that comes before the decoder (the projection over the vocabulary).
+		"""
+		# BERT-like models
+		if hasattr(model, 'cls') and hasattr(model.cls, 'predictions'):
+			return model.cls.predictions.transform
+		# DistilBERT-like models
+		if hasattr(model, 'vocab_transform'):
+			return torch.nn.Sequential(model.vocab_transform, model.activation, model.vocab_layer_norm)
+		raise AttributeError(f"Cannot find the prediction head of the model of type: {type(model)}")
+
+	def encode(self, sentences: list[str] | EncodedSentences) -> EncodedSentences:
+		if isinstance(sentences, EncodedSentences):
+			return sentences
+		return EncodedSentences(self.tokenizer, sentences)
+
+	def get_token_ids(self, words: list[str]) -> list[int]:
+		"""
+		Returns the vocabulary ids of the given words.
+		As in the "fill-mask" pipeline, a word that is split into more word-pieces is represented by the first one.
+		"""
+		token_ids: list[int] = []
+		for word in words:
+			tokens = self.tokenizer.tokenize(word)
+			if len(tokens) == 0:
+				raise AttributeError(f"The word <{word}> cannot be scored: it does not produce any token")
+			if len(tokens) != 1:
+				print(f"The word <{word}> does not exist in the vocabulary: its first token <{tokens[0]}> will be used")
+			token_ids.append(self.tokenizer.convert_tokens_to_ids(tokens[0]))
+		return token_ids
+
+	def iter_mask_states(self, sentences: list[str] | EncodedSentences) \
+			-> Iterator[tuple[np.ndarray, np.ndarray, torch.Tensor]]:
+		"""
+		Computes the hidden states of the masked positions, already transformed by the prediction head.
+
+		:param sentences: The sentences to analyze, as strings or already encoded.
+		:return: An iterator of triples, one for each batch:
+			- The array of indices of the sentences containing the masks, of dimensions [# batch masks].
+			- The array of positions of the masks within their sentences, of dimensions [# batch masks].
+			- The tensor of transformed hidden states, of dimensions [# batch masks, # features].
+		"""
+		encoded = self.encode(sentences)
+		with torch.inference_mode():
+			for indices, input_ids, attention_mask in encoded.batches(self.max_tokens_per_batch):
+				input_ids = input_ids.to(self.device)
+				hidden = self.model.base_model(input_ids=input_ids,
+				                               attention_mask=attention_mask.to(self.device)).last_hidden_state
+				# Selecting only the masked positions: [# batch masks, # features]
+				rows, positions = torch.nonzero(input_ids == encoded.mask_token_id, as_tuple=True)
+				states = self.__head_transform(hidden[rows, positions])
+				yield indices[rows.cpu().numpy()], positions.cpu().numpy(), states
+
+	def project(self, states: torch.Tensor, token_ids: list[int] | torch.Tensor | slice) -> torch.Tensor:
+		"""
+		Computes the logits of the given tokens only.
+		:param states: The transformed hidden states, of dimensions [# masks, # features].
+		:param token_ids: The vocabulary ids of the tokens, or a slice of contiguous vocabulary ids.
+		:return: The logits tensor, of dimensions [# masks, # tokens].
+		"""
+		if not isinstance(token_ids, slice):
+			token_ids = torch.as_tensor(token_ids, device=states.device)
+		logits = states @ self.__decoder.weight[token_ids].T
+		if self.__decoder.bias is not None:
+			logits = logits + self.__decoder.bias[token_ids]
+		return logits
+
+	@property
+	def vocabulary_size(self) -> int:
+		return self.__decoder.weight.shape[0]
+
+	def vocabulary_chunks(self) -> Iterator[slice]:
+		"""
+		Splits the vocabulary ids in contiguous chunks, in order to never compute all the logits at once.
+		"""
+		for start in range(0, self.vocabulary_size, self.vocabulary_chunk_size):
+			yield slice(start, min(start + self.vocabulary_chunk_size, self.vocabulary_size))
+
+	def log_partition(self, states: torch.Tensor) -> torch.Tensor:
+		"""
+		Computes the log-sum-exp of the logits over the whole vocabulary, i.e. the normalization term of the softmax.
+		:param states: The transformed hidden states, of dimensions [# masks, # features].
+		:return: The tensor of dimensions [# masks].
+		"""
+		result = torch.full((len(states),), fill_value=-torch.inf, dtype=states.dtype, device=states.device)
+		for chunk in self.vocabulary_chunks():
+			result = torch.logaddexp(result, torch.logsumexp(self.project(states, chunk), dim=-1))
+		return result
+
+	def log_probabilities(self, states: torch.Tensor, token_ids: torch.Tensor) -> torch.Tensor:
+		"""
+		Computes the log-probability of a single token for each masked position.
+		:param states: The transformed hidden states, of dimensions [# masks, # features].
+		:param token_ids: The vocabulary id of the token to evaluate in each position, of dimensions [# masks].
+		:return: The tensor of log-probabilities, of dimensions [# masks].
+		"""
+		token_ids = token_ids.to(states.device)
+		logits = torch.sum(states * self.__decoder.weight[token_ids], dim=-1)
+		if self.__decoder.bias is not None:
+			logits = logits + self.__decoder.bias[token_ids]
+		return logits - self.log_partition(states)
+
+	def score_targets(self, sentences: list[str] | EncodedSentences, targets: list[str]) -> np.ndarray:
+		"""
+		Computes the probabilities of the target words in the [MASK] position of each sentence.
+		Every sentence must contain exactly one [MASK] token.
+
+		:param sentences: The sentences to analyze, as strings or already encoded.
+		:param targets: The target words.
+		:return: A numpy array of shape [# sentences, # targets], with the probabilities normalized over the whole
+		vocabulary (the same values returned by the "fill-mask" pipeline).
+		"""
+		encoded = self.encode(sentences)
+		target_ids = self.get_token_ids(targets)
+		scores: np.ndarray = np.zeros(shape=(len(encoded), len(targets)))
+		scored: np.ndarray = np.zeros(shape=len(encoded), dtype=bool)
+		for indices, _, states in self.iter_mask_states(encoded):
+			assert len(np.unique(indices)) == len(indices), "Every sentence must contain exactly one mask token"
+			log_probs = self.project(states, target_ids) - self.log_partition(states).unsqueeze(-1)
+			scores[indices] = torch.exp(log_probs).cpu().numpy()
+			scored[indices] = True
+		if not np.all(scored):
+			unscored = np.flatnonzero(~scored)
+			example = encoded.sentences[unscored[0]] if encoded.sentences is not None else encoded.input_ids[unscored[0]]
+			raise AttributeError(f"{len(unscored)} sentences do not contain the mask token, e.g.: <{example}>")
+		return scores
+
+	def iter_top_k(self, sentences: list[str] | EncodedSentences, k: int) \
+			-> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+		"""
+		Finds the K most probable tokens of the whole vocabulary, for the [MASK] position of each sentence.
+		The top-K is computed in a streaming fashion over the vocabulary chunks, so the full logits are never stored.
+
+		:param sentences: The sentences to analyze, with exactly one [MASK] token each.
+		:param k: The number of tokens to find for each sentence.
+		:return: An iterator of triples, one for each batch:
+			- The array of indices of the sentences, of dimensions [# batch sentences].
+			- The array of the top tokens ids, sorted by decreasing probability, of dimensions [# batch sentences, K].
+			- The array of the top tokens probabilities, of dimensions [# batch sentences, K].
+		"""
+		for indices, _, states in self.iter_mask_states(sentences):
+			assert len(np.unique(indices)) == len(indices), "Every sentence must contain exactly one mask token"
+			top_logits = torch.empty((len(states), 0), dtype=states.dtype, device=states.device)
+			top_ids = torch.empty((len(states), 0), dtype=torch.long, device=states.device)
+			log_partition = torch.full((len(states),), fill_value=-torch.inf, dtype=states.dtype, device=states.device)
+			for chunk in self.vocabulary_chunks():
+				chunk_logits = self.project(states, chunk)
+				log_partition = torch.logaddexp(log_partition, torch.logsumexp(chunk_logits, dim=-1))
+				# Merging the current best tokens with the best tokens of the chunk
+				chunk_top_logits, chunk_top_ids = torch.topk(chunk_logits, k=min(k, chunk_logits.shape[-1]), dim=-1)
+				merged_logits = torch.cat([top_logits, chunk_top_logits], dim=-1)
+				merged_ids = torch.cat([top_ids, chunk_top_ids + chunk.start], dim=-1)
+				top_logits, merged_positions = torch.topk(merged_logits, k=min(k, merged_logits.shape[-1]), dim=-1)
+				top_ids = torch.gather(merged_ids, dim=-1, index=merged_positions)
+			top_probs = torch.exp(top_logits - log_partition.unsqueeze(-1))
+			yield indices, top_ids.cpu().numpy(), top_probs.cpu().numpy()
+
+	def score_fillers(self, contexts: list[str], words: list[str]) -> np.ndarray:
+		"""
+		Computes the probability of every word as the filler of the [MASK] token of every context.
+		This is the "reverse" of the targets scoring: here the words can be many (e.g. all the occupations), while the
+		contexts are few.
+
+		The words made of a single word-piece are all read from the same forward pass of their context.
+		A word made of K word-pieces is evaluated by replacing the [MASK] of the context with K masks: its probability
+		is the product of the probabilities of its pieces in the corresponding positions. All these expanded sentences
+		are scored together, in batches.
+
+		:param contexts: The sentences containing exactly one [MASK] token, where the words are placed.
+		:param words: The words to evaluate.
+		:return: A numpy array of shape [# contexts, # words], with the probabilities of the words.
+		"""
+		mask_token: str = self.tokenizer.mask_token
+		words_pieces: list[list[int]] = [self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(w)) for w in words]
+		single_indices = [j for j, pieces in enumerate(words_pieces) if len(pieces) == 1]
+		multi_indices = [j for j, pieces in enumerate(words_pieces) if len(pieces) > 1]
+		log_scores: np.ndarray = np.zeros(shape=(len(contexts), len(words)))
+		# The words without any word-piece (i.e. empty strings) have a null probability
+		log_scores[:, [j for j, pieces in enumerate(words_pieces) if len(pieces) == 0]] = -np.inf
+
+		# Single word-piece words: one forward for each context
+		single_ids = [words_pieces[j][0] for j in single_indices]
+		for indices, _, states in self.iter_mask_states(contexts):
+			assert len(np.unique(indices)) == len(indices), "Every context must contain exactly one mask token"
+			log_probs = self.project(states, single_ids) - self.log_partition(states).unsqueeze(-1)
+			log_scores[np.ix_(indices, single_indices)] = log_probs.cpu().numpy()
+
+		# Multi word-piece words: one expanded sentence for each context and word
+		if len(multi_indices) > 0:
+			expanded_sentences: list[str] = []
+			expanded_pieces: list[list[int]] = []
+			for context in contexts:
+				for j in multi_indices:
+					pieces = words_pieces[j]
+					expanded_sentences.append(context.replace(mask_token, ' '.join([mask_token] * len(pieces))))
+					expanded_pieces.append(pieces)
+			encoded = self.encode(expanded_sentences)
+			# The masks are contiguous: the piece of a mask depends on its offset from the first mask of the sentence
+			first_positions = np.asarray([ids.index(encoded.mask_token_id) for ids in encoded.input_ids])
+			expanded_log_scores: np.ndarray = np.zeros(shape=len(expanded_sentences))
+			for indices, positions, states in self.iter_mask_states(encoded):
+				pieces_ids = torch.as_tensor([expanded_pieces[i][p - first_positions[i]]
+				                              for i, p in zip(indices, positions)])
+				np.add.at(expanded_log_scores, indices, self.log_probabilities(states, pieces_ids).cpu().numpy())
+			log_scores[:, multi_indices] = expanded_log_scores.reshape((len(contexts), len(multi_indices)))
+
+		return np.exp(log_scores)
+
+	def pseudo_log_likelihoods(self, sentences: list[str] | EncodedSentences) -> tuple[list[np.ndarray], np.ndarray]:
+		"""
+		Computes the pseudo-log-likelihood (PLL) of the sentences.
+		For every token of a sentence (except the special tokens at the beginning and at the end) a copy of the sentence
+		is created, with that token replaced by [MASK]. The log-probability of the original token in the masked position
+		is the token score, and the PLL of the sentence is the sum of its tokens scores.
+
+		The masked copies of all the sentences are scored together, in token-budgeted batches.
+
+		:param sentences: The sentences to analyze, as strings or already encoded.
+		:return: A pair (tokens log-probabilities, sentences PLL), where:
+			- The first item is a list with an array for each sentence, of dimensions [# sentence tokens - 2].
+			- The second item is an array of dimensions [# sentences].
+		"""
+		encoded = self.encode(sentences)
+		# Expanding the sentences in their masked copies
+		masked_input_ids: list[list[int]] = []
+		original_ids: list[int] = []
+		offsets: np.ndarray = np.zeros(shape=len(encoded) + 1, dtype=np.int64)
+		for i, ids in enumerate(encoded.input_ids):
+			for position in range(1, len(ids) - 1):
+				masked_input_ids.append(ids[:position] + [encoded.mask_token_id] + ids[position + 1:])
+				original_ids.append(ids[position])
+			offsets[i + 1] = len(masked_input_ids)
+		masked = EncodedSentences.from_input_ids(masked_input_ids, encoded.pad_token_id, encoded.mask_token_id)
+
+		# Computing the log-probability of the original token in each masked copy
+		original_ids_arr = torch.as_tensor(original_ids)
+		log_probs: np.ndarray = np.zeros(shape=len(masked))
+		for indices, _, states in self.iter_mask_states(masked):
+			log_probs[indices] = self.log_probabilities(states, original_ids_arr[indices]).cpu().numpy()
+
+		tokens_log_probs: list[np.ndarray] = [log_probs[offsets[i]:offsets[i + 1]] for i in range(len(encoded))]
+		sentences_pll: np.ndarray = np.asarray([np.sum(tokens) for tokens in tokens_log_probs])
+		return tokens_log_probs, sentences_pll
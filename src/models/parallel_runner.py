@@ -0,0 +1,174 @@
+#########################################################################
+#                            Dusi's Thesis                              #
+# Algorithmic Discrimination and Natural Language Processing Techniques #
+#########################################################################
+
+# This class evaluates MLM metrics over many sentences with a pool of worker processes (data parallelism).
+# Every worker loads its own copy of the model on CPU, with a fixed number of intra-op threads, and scores
+# contiguous shards of the sentences. The partial results are written in a shared memory block.
+# The pool is kept alive between the calls, so the model is loaded only once by each worker.
+
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+
+import settings
+from src.models.masked_lm_scorer import MaskedLMScorer
+from src.models.trained_model_factory import TrainedModelForMaskedLMFactory
+
+# The scorer of the current worker process, created by the pool initializer
+_worker_scorer: MaskedLMScorer | None = None
+
+
+def _init_worker(model_name: str, load_or_save_path: str | None, num_threads: int) -> None:
+	"""
+	Initializes a worker process: pins the number of threads and loads the model.
+	"""
+	global _worker_scorer
+	torch.set_num_threads(num_threads)
+	torch.set_num_interop_threads(1)
+	factory = TrainedModelForMaskedLMFactory(model_name=model_name)
+	model = factory.get_model(load_or_save_path=load_or_save_path)
+	_worker_scorer = MaskedLMScorer(model=model, tokenizer=factory.tokenizer, device=torch.device("cpu"))
+
+
+def _write_shard(shm_name: str, shape: tuple[int, ...], start: int, values: np.ndarray) -> None:
+	"""
+	Writes the results of a shard in the shared memory block, starting from the given row.
+	"""
+	shm = shared_memory.SharedMemory(name=shm_name)
+	try:
+		results = np.ndarray(shape=shape, dtype=np.float64, buffer=shm.buf)
+		results[start:start + len(values)] = values
+	finally:
+		shm.close()
+
+
+def _score_targets_shard(shm_name: str, shape: tuple[int, ...], start: int,
+                         sentences: list[str], targets: list[str]) -> None:
+	_write_shard(shm_name, shape, start, _worker_scorer.score_targets(sentences, targets=targets))
+
+
+def _mean_log_probabilities_shard(shm_name: str, shape: tuple[int, ...], start: int, sentences: list[str]) -> None:
+	tokens_log_probs, _ = _worker_scorer.pseudo_log_likelihoods(sentences)
+	_write_shard(shm_name, shape, start, np.asarray([np.mean(log_probs) for log_probs in tokens_log_probs]))
+
+
+def _top_k_shard(shm_name: str, shape: tuple[int, ...], start: int, sentences: list[str], k: int) -> None:
+	# Each row contains the K tokens ids, followed by their K probabilities
+	values = np.zeros(shape=(len(sentences), 2 * k))
+	for indices, top_ids, top_probs in _worker_scorer.iter_top_k(sentences, k=k):
+		values[indices, :k] = top_ids
+		values[indices, k:] = top_probs
+	_write_shard(shm_name, shape, start, values)
+
+
+class DataParallelMLMRunner:
+	"""
+	This class splits a list of sentences into contiguous shards and scores them with a pool of processes.
+	The results are merged in a single array, in the same order of the sentences.
+
+	The pool is started at the first call and reused by the following ones; it should be closed with "close", or by
+	using the runner as a context manager:
+		with DataParallelMLMRunner(...) as runner:
+			...
+	"""
+
+	# Number of shards for each worker: more shards balance the load, fewer shards reduce the overhead
+	shards_per_worker: int = 4
+
+	def __init__(self, model_name: str = settings.DEFAULT_BERT_MODEL_NAME, load_or_save_path: str | None = None,
+	             num_workers: int | None = None, threads_per_worker: int | None = None):
+		"""
+		:param model_name: The name of the base model.
+		:param load_or_save_path: The path of the saved (fine-tuned) model, or None for the base model.
+		:param num_workers: The number of worker processes. By default, it's the number of CPUs.
+		:param threads_per_worker: The number of intra-op threads of each worker. By default, the CPUs are split evenly.
+		"""
+		self.__model_name = model_name
+		self.__load_or_save_path = load_or_save_path
+		self.__num_workers: int = num_workers if num_workers is not None else os.cpu_count()
+		self.__threads_per_worker: int = threads_per_worker if threads_per_worker is not None \
+			else max(1, os.cpu_count() // self.__num_workers)
+
+		self.__pool = None
+
+		# The model is created (and saved) once, so that the workers only load it
+		if load_or_save_path is not None and not os.path.isdir(load_or_save_path):
+			TrainedModelForMaskedLMFactory(model_name=model_name).get_model(load_or_save_path=load_or_save_path)
+
+	def __enter__(self) -> 'DataParallelMLMRunner':
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback) -> None:
+		self.close()
+
+	def __get_pool(self):
+		"""
+		Returns the pool of workers, starting it if it's not running yet.
+		"""
+		if self.__pool is None:
+			context = multiprocessing.get_context("spawn")
+			self.__pool = context.Pool(processes=self.__num_workers, initializer=_init_worker,
+			                           initargs=(self.__model_name, self.__load_or_save_path, self.__threads_per_worker))
+		return self.__pool
+
+	def close(self) -> None:
+		"""
+		Stops the pool of workers, releasing their models. The runner can still be used: a new pool will be started.
+		"""
+		if self.__pool is not None:
+			self.__pool.close()
+			self.__pool.join()
+			self.__pool = None
+
+	def __run(self, task, shape: tuple[int, ...], sentences: list[str], *args) -> np.ndarray:
+		"""
+		Runs a task over contiguous shards of the sentences, and merges the results.
+		:param task: The function executed by the workers on each shard.
+		:param shape: The shape of the results array; the first dimension must be the number of sentences.
+		:param sentences: The sentences to analyze.
+		:param args: Other arguments for the task.
+		:return: The merged results array.
+		"""
+		assert shape[0] == len(sentences)
+		num_shards: int = min(len(sentences), self.__num_workers * self.shards_per_worker)
+		bounds = np.linspace(0, len(sentences), num=num_shards + 1, dtype=np.int64)
+		shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(np.float64).itemsize))
+		try:
+			self.__get_pool().starmap(task, [(shm.name, shape, int(start), sentences[start:end], *args)
+			                                 for start, end in zip(bounds[:-1], bounds[1:])])
+			results = np.ndarray(shape=shape, dtype=np.float64, buffer=shm.buf).copy()
+		finally:
+			shm.close()
+			shm.unlink()
+		return results
+
+	def score_targets(self, sentences: list[str], targets: list[str]) -> np.ndarray:
+		"""
+		Computes the probabilities of the target words in the [MASK] position of each sentence.
+		See: "MaskedLMScorer.score_targets".
+		:return: A numpy array of shape [# sentences, # targets].
+		"""
+		return self.__run(_score_targets_shard, (len(sentences), len(targets)), sentences, targets)
+
+	def mean_log_probabilities(self, sentences: list[str]) -> np.ndarray:
+		"""
+		Computes the average log-probability of the tokens of each sentence, as in the pseudo-log-likelihood.
+		See: "MaskedLMScorer.pseudo_log_likelihoods".
+		:return: A numpy array of shape [# sentences].
+		"""
+		return self.__run(_mean_log_probabilities_shard, (len(sentences),), sentences)
+
+	def top_k(self, sentences: list[str], k: int) -> tuple[np.ndarray, np.ndarray]:
+		"""
+		Finds the K most probable tokens of the whole vocabulary, for the [MASK] position of each sentence.
+		See: "MaskedLMScorer.iter_top_k".
+		:return: The pair of numpy arrays (tokens ids, probabilities), both of shape [# sentences, K].
+		"""
+		results = self.__run(_top_k_shard, (len(sentences), 2 * k), sentences, k)
+		# The ids are integers, stored exactly in the float64 results
+		return results[:, :k].astype(np.int64), results[:, k:]
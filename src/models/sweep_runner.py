@@ -0,0 +1,101 @@
+#########################################################################
+#                            Dusi's Thesis                              #
+# Algorithmic Discrimination and Natural Language Processing Techniques #
+#########################################################################
+
+# This class trains the checkpoints of a fine-tuning sweep (e.g. the same model trained on samples of different sizes)
+# in parallel, with a pool of processes. The CPU cores are split between the processes, every run is seeded
+# deterministically, and every checkpoint is written atomically in its path.
+
+import multiprocessing
+import os
+import random
+import shutil
+
+import numpy as np
+import torch
+
+import settings
+from src.models.evaluation_scheduler import Checkpoint
+from src.models.trained_model_factory import _AbstractTrainedModelFactory
+
+
+def _train_checkpoint(factory: _AbstractTrainedModelFactory, checkpoint: Checkpoint, seed: int,
+                      num_threads: int) -> tuple[str, list[dict]]:
+	"""
+	Trains and saves a single checkpoint, in a worker process.
+	The model is saved in a temporary folder next to the final path, and then the folder is renamed.
+	:return: The name of the checkpoint, and the training records of the run.
+	"""
+	torch.set_num_threads(num_threads)
+	torch.set_num_interop_threads(1)
+	random.seed(seed)
+	np.random.seed(seed)
+	torch.manual_seed(seed)
+
+	temp_path: str = f"{checkpoint.load_or_save_path}.tmp-{os.getpid()}"
+	factory.training_seed = seed
+	factory.training_output_dir = temp_path + '-trainer'
+	try:
+		factory.get_model(fine_tuning_text=checkpoint.fine_tuning_text, load_or_save_path=temp_path)
+		os.replace(temp_path, checkpoint.load_or_save_path)
+	finally:
+		shutil.rmtree(temp_path, ignore_errors=True)
+		shutil.rmtree(factory.training_output_dir, ignore_errors=True)
+	return checkpoint.name, factory.training_records
+
+
+class FineTuningSweepRunner:
+	"""
+	This class trains the missing checkpoints of a sweep in parallel processes, before their evaluation.
+	Each process trains one checkpoint at a time, with a limited number of threads. The largest runs are started first,
+	while the other processes train the smaller ones.
+	"""
+
+	# The minimum number of threads for each process, used to choose the default number of processes
+	min_threads_per_process: int = 4
+
+	def __init__(self, factory: _AbstractTrainedModelFactory, num_processes: int | None = None):
+		"""
+		:param factory: The factory training the checkpoints. It's copied in every process, with its settings.
+		:param num_processes: The number of parallel trainings. By default, it depends on the number of CPUs.
+		"""
+		self.__factory = factory
+		self.__num_processes = num_processes
+
+	@staticmethod
+	def seed_for(checkpoint: Checkpoint) -> int:
+		"""
+		:return: The seed of the training of a checkpoint, depending on the size of its training sample.
+		"""
+		return settings.RANDOM_SEED + len(checkpoint.fine_tuning_text)
+
+	def run(self, checkpoints: list[Checkpoint]) -> dict[str, list[dict]]:
+		"""
+		Trains and saves all the checkpoints with training texts and a path, but not found on disk.
+		The other checkpoints are ignored: they will be retrieved by the factory as usual.
+		:param checkpoints: The checkpoints of the sweep.
+		:return: The training records of each trained checkpoint, by name.
+		"""
+		pending: list[Checkpoint] = [ckpt for ckpt in checkpoints
+		                             if ckpt.load_or_save_path is not None and not os.path.isdir(ckpt.load_or_save_path)
+		                             and ckpt.fine_tuning_text is not None and len(ckpt.fine_tuning_text) > 0]
+		if len(pending) == 0:
+			return {}
+		# The largest runs first
+		pending.sort(key=lambda ckpt: len(ckpt.fine_tuning_text), reverse=True)
+
+		num_processes: int = self.__num_processes if self.__num_processes is not None \
+			else max(1, os.cpu_count() // self.min_threads_per_process)
+		num_processes = min(num_processes, len(pending))
+		num_threads: int = max(1, os.cpu_count() // num_processes)
+		for ckpt in pending:
+			os.makedirs(os.path.dirname(ckpt.load_or_save_path) or '.', exist_ok=True)
+
+		print(f"Training {len(pending)} checkpoints with {num_processes} processes ({num_threads} threads each)")
+		context = multiprocessing.get_context("spawn")
+		with context.Pool(processes=num_processes, maxtasksperchild=1) as pool:
+			results = pool.starmap(_train_checkpoint, [(self.__factory, ckpt, self.seed_for(ckpt), num_threads)
+			                                           for ckpt in pending], chunksize=1)
+		print("Completed.")
+		return dict(results)
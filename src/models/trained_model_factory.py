@@ -6,26 +6,125 @@
 # This class provides a centralized interface for model training
 # It's specialized for getting the same base model with different fine-tuning
 
+import hashlib
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
 from typing import Generic, TypeVar
 
+import numpy as np
 import pandas as pd
+import torch
 
 import transformers
-from datasets import DatasetDict, Dataset
+from datasets import DatasetDict, Dataset, load_from_disk
 from transformers import AutoTokenizer, AutoModelForMaskedLM, DataCollatorForLanguageModeling, AutoModel, PreTrainedTokenizerBase
 from transformers import TrainingArguments, Trainer
 from transformers.models.auto.auto_factory import _BaseAutoModelClass
 
 import settings
+from src.models import low_rank_adapters
+from src.models.checkpoint_store import DeltaCheckpointStore
 
+try:
+	import psutil
+except ImportError:
+	# Without psutil, the resident memory is read from "/proc" (only on Linux)
+	psutil = None
 
 FOLDER_CHECKPOINTS: str = settings.FOLDER_SAVED + '/factory_checkpoints'
+FOLDER_TOKENIZED_POOLS: str = settings.FOLDER_SAVED_DATA + '/factory_tokenized_pools'
+
+
+def _resident_memory() -> int | None:
+	"""
+	:return: The current resident memory of the process, in bytes, or None if it cannot be measured.
+	"""
+	if psutil is not None:
+		return psutil.Process().memory_info().rss
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError, IndexError):
+		return None
+
+
+class _ResidentMemorySampler(threading.Thread):
+	"""
+	A background thread sampling the resident memory of the process, keeping its peak.
+	"""
+
+	# The interval between two samples, in seconds
+	interval: float = 0.05
+
+	def __init__(self):
+		super().__init__(daemon=True)
+		self.__stop_event = threading.Event()
+		self.start_memory: int | None = _resident_memory()
+		self.peak: int | None = self.start_memory
+
+	def run(self) -> None:
+		while not self.__stop_event.wait(self.interval):
+			self.peak = max(self.peak, _resident_memory())
+
+	def stop(self) -> int | None:
+		"""
+		Stops the sampling, taking a last sample.
+		:return: The peak resident memory, in bytes.
+		"""
+		self.__stop_event.set()
+		self.join()
+		if self.peak is not None:
+			self.peak = max(self.peak, _resident_memory())
+		return self.peak
+
 
 # Generic transformer model
 M = TypeVar("M", bound=_BaseAutoModelClass)
 
 
+class TrainingProfile:
+	"""
+	A set of performance settings for the training of a model.
+	The profiles change the speed and the memory usage of the training, but not its hyperparameters: the effective
+	batch size is "batch_size * gradient_accumulation_steps".
+	"""
+
+	def __init__(self, name: str, batch_size: int = 8, gradient_accumulation_steps: int = 1, bf16: bool = False,
+	             gradient_checkpointing: bool = False, eval_samples: int | None = None,
+	             dataloader_num_workers: int = 0, dataloader_pin_memory: bool = True):
+		"""
+		:param name: The name of the profile.
+		:param batch_size: The number of chunks of each forward pass.
+		:param gradient_accumulation_steps: The number of forward passes accumulated before each optimization step.
+		:param bf16: If True, the training uses the bfloat16 mixed precision (autocast), also on CPU.
+		:param gradient_checkpointing: If True, the activations are recomputed in the backward pass instead of being stored.
+		:param eval_samples: The number of test chunks sampled for the evaluation, or None for the whole test set.
+		:param dataloader_num_workers: The number of processes loading the batches.
+		:param dataloader_pin_memory: If True, the batches are loaded in pinned memory (useful only on GPU).
+		"""
+		self.name = name
+		self.batch_size = batch_size
+		self.gradient_accumulation_steps = gradient_accumulation_steps
+		self.bf16 = bf16
+		self.gradient_checkpointing = gradient_checkpointing
+		self.eval_samples = eval_samples
+		self.dataloader_num_workers = dataloader_num_workers
+		self.dataloader_pin_memory = dataloader_pin_memory
+
+
+# Predefined profiles
+# The same behaviour of the default "TrainingArguments"
+DEFAULT_TRAINING_PROFILE: TrainingProfile = TrainingProfile('default')
+# Training on CPU, with mixed precision and a sampled evaluation
+CPU_TRAINING_PROFILE: TrainingProfile = TrainingProfile('cpu', batch_size=8, bf16=True, eval_samples=512,
+                                                        dataloader_pin_memory=False)
+# Training large models (e.g. "bert-large-uncased") with limited memory, keeping the effective batch size = 8
+LOW_MEMORY_TRAINING_PROFILE: TrainingProfile = TrainingProfile('low-memory', batch_size=2, gradient_accumulation_steps=4,
+                                                               gradient_checkpointing=True, eval_samples=512)
+
+
 class _AbstractTrainedModelFactory(ABC, Generic[M]):
 	"""
 	This class provides an easy interface for transformers models retrieving and training.
@@ -46,6 +145,17 @@ class _AbstractTrainedModelFactory(ABC, Generic[M]):
 	num_proc: int = 4
 	num_epochs: int = 3
 	learning_rate: float = 2e-5
+	# The performance settings of the training; if None, they're chosen from the device (see: "active_training_profile")
+	training_profile: TrainingProfile | None = None
+	training_seed: int = settings.RANDOM_SEED
+	training_output_dir: str = FOLDER_CHECKPOINTS
+	# Parameter-efficient fine-tuning: if the rank is not None, only the low-rank adapters are trained and saved
+	adapter_rank: int | None = None
+	adapter_alpha: float = 16.0
+	# If True, the loaded adapters are merged into the base model; otherwise, they're applied on the fly
+	merge_adapters: bool = True
+	# If not None, the fine-tuned models are saved as deltas from the base model in this store
+	delta_checkpoint_store: DeltaCheckpointStore | None = None
 
 	_texts_feature_name: str = 'texts'
 
@@ -53,6 +163,11 @@ class _AbstractTrainedModelFactory(ABC, Generic[M]):
 		self.__M = model_type
 		self.__model_name: str = model_name
 		self.__tokenizer: PreTrainedTokenizerBase = AutoTokenizer.from_pretrained(self.__model_name)
+		# The tokenized pool of candidate texts, and the row of each text in the pool
+		self.__texts_pool: Dataset | None = None
+		self.__texts_pool_rows: dict[str, int] = {}
+		# The performance records of the training runs
+		self.__training_records: list[dict[str, float | int | str]] = []
 
 	@property
 	def tokenizer(self) -> PreTrainedTokenizerBase:
@@ -66,6 +181,128 @@ class _AbstractTrainedModelFactory(ABC, Generic[M]):
 	def auto_model_class(self):
 		return self.__M
 
+	@property
+	def training_records(self) -> list[dict[str, float | int | str]]:
+		"""
+		The performance records of the training runs of the factory, in order.
+		Each record contains the profile name, the number of training tokens, the duration (in seconds), the
+		throughput (in tokens per second) and the peak memory (in bytes).
+		"""
+		return self.__training_records
+
+	def _record_training(self, model, train_tokens: int, train_function) -> None:
+		"""
+		Runs a training function, recording its throughput and its peak memory.
+		On GPU, the peak memory is the maximum memory allocated by torch during the training. On CPU, it's the increase
+		of the resident memory of the process during the training (the peak sampled during the training, minus the
+		memory before it), so that the memory of the previous runs and of the loaded models is not counted.
+
+		:param model: The model to train.
+		:param train_tokens: The number of tokens processed by the training (for all the epochs).
+		:param train_function: The function running the training, without parameters.
+		:return: None
+		"""
+		on_gpu: bool = torch.cuda.is_available() and next(model.parameters()).is_cuda
+		sampler: _ResidentMemorySampler | None = None
+		if on_gpu:
+			torch.cuda.reset_peak_memory_stats()
+		elif _resident_memory() is not None:
+			sampler = _ResidentMemorySampler()
+			sampler.start()
+		start: float = time.perf_counter()
+		try:
+			train_function()
+		finally:
+			duration: float = time.perf_counter() - start
+			peak_sampled: int | None = sampler.stop() if sampler is not None else None
+
+		if on_gpu:
+			peak_memory: int = torch.cuda.max_memory_allocated()
+		elif peak_sampled is not None:
+			peak_memory = peak_sampled - sampler.start_memory
+		else:
+			peak_memory = -1
+		record = {
+			'profile': self.active_training_profile.name,
+			'tokens': train_tokens,
+			'seconds': duration,
+			'tokens_per_second': train_tokens / duration if duration > 0 else 0.0,
+			'peak_memory_bytes': peak_memory,
+		}
+		self.__training_records.append(record)
+		print(f"Training completed: {record['tokens_per_second']:.1f} tokens/s, peak memory {peak_memory / 2 ** 20:.1f} MB")
+
+	@property
+	def active_training_profile(self) -> TrainingProfile:
+		"""
+		:return: The training profile used by the factory: the chosen one, if any, or the profile of the training device
+		(the CPU profile when CUDA is not available, the default profile otherwise).
+		"""
+		if self.training_profile is not None:
+			return self.training_profile
+		return CPU_TRAINING_PROFILE if settings.pt_device.type == 'cpu' else DEFAULT_TRAINING_PROFILE
+
+	def set_texts_pool(self, texts: list[str]) -> None:
+		"""
+		Sets the pool of candidate texts for the fine-tuning, e.g. all the sentences from which the training
+		samples of a sweep are drawn. The pool is tokenized once and saved on disk as an Arrow dataset, identified by
+		the hash of the tokenizer and of the texts: the next executions will load it directly.
+		When a model is trained on texts contained in the pool, their rows are selected from the pool by index,
+		without tokenizing them again.
+
+		:param texts: The candidate texts for the fine-tuning.
+		:return: None
+		"""
+		pool_path: str = FOLDER_TOKENIZED_POOLS + '/' + self.__texts_pool_hash(texts)
+		if os.path.isdir(pool_path):
+			pool = load_from_disk(pool_path)
+			print(f"Tokenized texts pool found locally in path: {pool_path}")
+		else:
+			print("Tokenizing the texts pool...", end="")
+			pool = self.__tokenize_texts(texts)
+			pool.save_to_disk(pool_path)
+			print("Completed.")
+		self.__texts_pool = pool
+		self.__texts_pool_rows = {}
+		for i, text in enumerate(texts):
+			self.__texts_pool_rows.setdefault(text, i)
+
+	def __texts_pool_hash(self, texts: list[str]) -> str:
+		"""
+		Computes the key of a pool of texts, depending on the tokenizer and on the texts (in order).
+		"""
+		digest = hashlib.sha256()
+		digest.update(f"{type(self.tokenizer).__name__}:{self.tokenizer.name_or_path}:{len(self.tokenizer)}".encode())
+		for text in texts:
+			digest.update(b'\0')
+			digest.update(text.encode())
+		return digest.hexdigest()
+
+	def __tokenize_texts(self, texts: list[str]) -> Dataset:
+		"""
+		Creates a dataset with the given texts, and tokenizes it.
+		"""
+		dataset = Dataset.from_pandas(pd.DataFrame(texts, columns=[self._texts_feature_name]))
+		return dataset.map(
+			function=self._tokenize_function,
+			batched=self.batched,
+			num_proc=self.num_proc,
+			remove_columns=[self._texts_feature_name]
+		)
+
+	def _get_tokenized_dataset(self, texts: list[str]) -> Dataset:
+		"""
+		Returns the tokenized dataset of the given texts.
+		If all the texts are in the pool (see: "set_texts_pool"), their rows are selected from the pool.
+		Otherwise, the texts are tokenized from scratch.
+
+		:param texts: The texts of the dataset.
+		:return: The tokenized dataset, with one row for each text.
+		"""
+		if self.__texts_pool is not None and all(text in self.__texts_pool_rows for text in texts):
+			return self.__texts_pool.select([self.__texts_pool_rows[text] for text in texts])
+		return self.__tokenize_texts(texts)
+
 	def get_model(self, fine_tuning_text: list[str] | None = None, load_or_save_path: str = None, **kwargs) -> M:
 		"""
 		Returns a model of the specific type of the factory.
@@ -76,6 +313,12 @@ class _AbstractTrainedModelFactory(ABC, Generic[M]):
 		With the given parameter "load_or_save_path", you can save your trained model on your local file system
 		and retrieve it in the next executions.
 
+		If the "adapter_rank" of the factory is not None, the model is fine-tuned with low-rank adapters (LoRA), and
+		only the adapters are saved in "load_or_save_path". When they're found, the adapters are applied to the base
+		model from HuggingFace.
+		Similarly, if the factory has a "delta_checkpoint_store", the fine-tuned model is saved as the differences from
+		the base model, and it's loaded by adding them to the base model.
+
 		Note: the model is by default on CPU. If you want to put it on GPU, you should call ".to()" by yourself.
 
 		Note: this method uses the "auto_model_class" abstract property. This property must be overwritten in the
@@ -86,6 +329,21 @@ class _AbstractTrainedModelFactory(ABC, Generic[M]):
 		:param kwargs: Optional parameters passed to the "from_pretrained" method used to retrieve the model.
 		:return: The transformer model of the type declared in the Factory.
 		"""
+		# Checks if the adapters of the model have been saved locally
+		if low_rank_adapters.has_adapters(load_or_save_path):
+			model = self.auto_model_class.from_pretrained(self.model_name, **kwargs)
+			model = low_rank_adapters.load_adapters(model, load_or_save_path, base_model_name=self.model_name,
+			                                        merge=self.merge_adapters)
+			print(f"Adapters for model <{self.model_name}> found locally in path: {load_or_save_path}")
+			return model
+
+		# Checks if the model has been saved locally as deltas from the base model
+		if DeltaCheckpointStore.has_checkpoint(load_or_save_path):
+			store = self.delta_checkpoint_store if self.delta_checkpoint_store is not None else DeltaCheckpointStore()
+			model = store.load(self.auto_model_class.from_pretrained(self.model_name, **kwargs), load_or_save_path)
+			print(f"Model <{self.model_name}> found locally as deltas in path: {load_or_save_path}")
+			return model
+
 		# Checks if the model has been saved locally
 		if load_or_save_path is not None:
 			try:
@@ -96,20 +354,43 @@ class _AbstractTrainedModelFactory(ABC, Generic[M]):
 				print(f"Unable to find the model <{self.model_name}> locally in path: {load_or_save_path} - A new model will be trained from scratch.")
 
 		# Instancing a new model from scratch
-		model = self.auto_model_class.from_pretrained(self.model_name, kwargs)
+		model = self.auto_model_class.from_pretrained(self.model_name, **kwargs)
 		assert model is not None
 
 		# If there are training data, the model is trained on the training_text
 		if fine_tuning_text is not None and len(fine_tuning_text) > 0:
-			model = self.train_model(model, texts=fine_tuning_text)
+			if self.adapter_rank is not None:
+				return self.__train_adapters(model, texts=fine_tuning_text, load_or_save_path=load_or_save_path)
+			model = self.train_model(model, texts=fine_tuning_text, output_dir=self.training_output_dir)
 
 		# At the end, if there's a path, the model is saved
-		if load_or_save_path is not None:
+		if load_or_save_path is not None and self.delta_checkpoint_store is not None:
+			base_model = self.auto_model_class.from_pretrained(self.model_name, **kwargs)
+			self.delta_checkpoint_store.save(model, base_model, load_or_save_path, base_model_name=self.model_name)
+			print(f"Model <{self.model_name}> has been saved locally as deltas in path: {load_or_save_path}")
+		elif load_or_save_path is not None:
 			model.save_pretrained(load_or_save_path)
 			print(f"Model <{self.model_name}> has been saved locally in path: {load_or_save_path}")
 
 		return model
 
+	def __train_adapters(self, model: M, texts: list[str], load_or_save_path: str | None) -> M:
+		"""
+		Trains the low-rank adapters of the model, and saves them in the given path (if any).
+		:return: The trained model, with the adapters merged or applied on the fly (see: "merge_adapters").
+		"""
+		low_rank_adapters.apply_lora(model, rank=self.adapter_rank, alpha=self.adapter_alpha)
+		if self.active_training_profile.gradient_checkpointing:
+			# With frozen embeddings, the checkpointed layers need inputs requiring gradients
+			model.enable_input_require_grads()
+		model = self.train_model(model, texts=texts, output_dir=self.training_output_dir)
+
+		if load_or_save_path is not None:
+			low_rank_adapters.save_adapters(model, load_or_save_path, base_model_name=self.model_name,
+			                                rank=self.adapter_rank, alpha=self.adapter_alpha)
+			print(f"Adapters for model <{self.model_name}> have been saved locally in path: {load_or_save_path}")
+		return low_rank_adapters.merge_lora(model) if self.merge_adapters else model
+
 	@abstractmethod
 	def train_model(self, model: M, texts: list[str], output_dir: str = FOLDER_CHECKPOINTS) -> M:
 		"""
@@ -123,16 +404,15 @@ class _AbstractTrainedModelFactory(ABC, Generic[M]):
 		"""
 		return model
 
-	def __tokenize_function(self, records):
+	def _tokenize_function(self, records):
 		"""
 		This function tokenizes the records of the dataset.
+		The texts are not padded: the padding is added only when the batches are collated, if necessary.
 		:param records: The records of a Dataset.
 		:return: The tokenized input.
 		"""
 		result = self.tokenizer(records[self._texts_feature_name],
-		                        padding='max_length',
-		                        truncation=True,
-		                        max_length=16)
+		                        truncation=True)
 		return result
 
 
@@ -173,9 +453,14 @@ class TrainedModelForMaskedLMFactory(_AbstractTrainedModelFactory[AutoModelForMa
 		:param output_dir: the output directory for the training process
 		:return: The trained model.
 		"""
+		profile: TrainingProfile = self.active_training_profile
 		# Retrieving dataset from texts
 		dataset = self.__create_dataset_from_texts(texts)
+		eval_dataset = dataset['test']
+		if profile.eval_samples is not None and profile.eval_samples < len(eval_dataset):
+			eval_dataset = eval_dataset.shuffle(seed=settings.RANDOM_SEED).select(range(profile.eval_samples))
 		# We'll mask 15% of the tokens of 'input_ids'
+		# The collator pads the chunks dynamically, i.e. up to the longest chunk of each batch
 		data_collator = DataCollatorForLanguageModeling(tokenizer=self.tokenizer, mlm_probability=self.mask_probability)
 
 		# Defining training parameters
@@ -186,15 +471,24 @@ class TrainedModelForMaskedLMFactory(_AbstractTrainedModelFactory[AutoModelForMa
 			num_train_epochs=self.num_epochs,
 			weight_decay=0.01,
 			push_to_hub=False,
+			seed=self.training_seed,
+			per_device_train_batch_size=profile.batch_size,
+			per_device_eval_batch_size=profile.batch_size,
+			gradient_accumulation_steps=profile.gradient_accumulation_steps,
+			bf16=profile.bf16,
+			gradient_checkpointing=profile.gradient_checkpointing,
+			dataloader_num_workers=profile.dataloader_num_workers,
+			dataloader_pin_memory=profile.dataloader_pin_memory,
 		)
 		trainer = Trainer(
 			model=model,
 			args=training_args,
 			train_dataset=dataset['train'],
-			eval_dataset=dataset['test'],
+			eval_dataset=eval_dataset,
 			data_collator=data_collator,
 		)
-		trainer.train()
+		train_tokens: int = self.num_epochs * sum(map(len, dataset['train']['input_ids']))
+		self._record_training(model, train_tokens=train_tokens, train_function=trainer.train)
 		return model
 
 	def __create_dataset_from_texts(self, texts: list[str]) -> DatasetDict:
@@ -206,37 +500,31 @@ class TrainedModelForMaskedLMFactory(_AbstractTrainedModelFactory[AutoModelForMa
 		:param texts: the training data.
 		:return: The dataset dictionary (Train and Test)
 		"""
-		# Composing initial dataset
-		dataset = Dataset.from_pandas(pd.DataFrame(texts, columns=[self._texts_feature_name]))
-		dataset = dataset.train_test_split(test_size=self.test_set_percentage)
+		# Tokenizing the whole dataset (or selecting it from the tokenized pool)
+		tokenized_dataset = self._get_tokenized_dataset(texts)
+		tokenized_dataset = tokenized_dataset.train_test_split(test_size=self.test_set_percentage)
 
-		# Tokenizing the whole dataset
-		tokenized_dataset = dataset.map(
-			function=self.__tokenize_function,
+		# Packing the texts into chunks of equal size (except the last one of each batch)
+		packed_dataset = tokenized_dataset.map(
+			function=self.__pack_function,
 			batched=self.batched,
-			num_proc=self.num_proc,
-			remove_columns=[self._texts_feature_name]
 		)
+		return packed_dataset
 
-		# Dividing into chunks of equal size (and discarding the last one)
-		chunked_dataset = tokenized_dataset.map(
-			function=self.__chunk_function,
-			batched=self.batched,
-			num_proc=self.num_proc,
-		)
-		return chunked_dataset
-
-	def __chunk_function(self, examples):
-		concatenated_examples = {k: sum(examples[k], []) for k in examples.keys()}
-
-		total_length = len(concatenated_examples[list(examples.keys())[0]])
-		# We drop the last chunk if it's smaller than chunk_size
-		total_length = (total_length // self.chunk_size) * self.chunk_size
-		result = {
-			k: [t[i: i + self.chunk_size] for i in range(0, total_length, self.chunk_size)]
-			for k, t in concatenated_examples.items()
-		}
-		result["labels"] = result["input_ids"].copy()
+	def __pack_function(self, examples):
+		"""
+		Concatenates the tokenized texts of a batch and splits them into chunks of "chunk_size" tokens.
+		Since the texts are not padded, the chunks contain only real tokens. The last chunk may be shorter: it will
+		be padded by the collator, together with the other chunks of its training batch.
+		The labels are not stored, because they are created by the MLM collator when the tokens are masked.
+		"""
+		lengths = np.fromiter(map(len, examples['input_ids']), dtype=np.int64, count=len(examples['input_ids']))
+		# The offsets where the chunks begin, in the concatenated sequence
+		chunks_offsets = np.arange(self.chunk_size, int(np.sum(lengths)), self.chunk_size)
+		result = {}
+		for k, values in examples.items():
+			concatenated = np.concatenate(values) if len(values) > 0 else np.zeros(0, dtype=np.int64)
+			result[k] = [chunk.tolist() for chunk in np.split(concatenated, chunks_offsets)]
 		return result
 
 
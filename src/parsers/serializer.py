@@ -64,7 +64,8 @@ class Serializer:
 				if isinstance(embeddings, torch.Tensor):
 					return embeddings
 				elif isinstance(embeddings, np.ndarray):
-					return torch.Tensor(embeddings)
+					# The tensor is float32, as before; a float32 array (only owned by the loader) is shared without copies
+					return torch.from_numpy(embeddings).float()
 			case _:
 				raise AttributeError("Unknown requested type for embeddings array: " + array_type)
 		raise ImportError("Cannot load embeddings as the requested type")